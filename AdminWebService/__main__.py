@@ -0,0 +1,12 @@
+# AdminWebService/__main__.py
+"""
+管理サーバーの起動用エントリポイント: python -m AdminWebService
+
+画像変換のプロセスプール (spawn) は、子プロセスの起動時に親プロセスの __main__ を再実行する。
+admin_server.py を直接起動するとFlaskアプリの初期化などモジュール全体が子プロセスごとに再実行されるが、
+パッケージの __main__ から起動した場合は再実行されない。
+"""
+
+from AdminWebService.admin_server import main
+
+main()
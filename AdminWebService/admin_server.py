@@ -2,16 +2,21 @@
 """MCP31プリンタ管理コンソール - バックエンドAPIサーバー"""
 
 import os
+import re
 import sys
 import uuid
 import subprocess
 import threading
-import queue
 import socket
 import atexit
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from flask import Flask, request, jsonify, send_file, send_from_directory
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
+from PIL import Image
 
 # mDNS/Zeroconf サービスディスカバリ
 try:
@@ -22,27 +27,154 @@ except ImportError:
     print("Warning: zeroconf not installed. Service discovery disabled.")
     print("Install with: pip install zeroconf")
 
+# ICMP Ping (プロセス起動なしでPingを送信)
+try:
+    import icmplib
+    ICMPLIB_AVAILABLE = True
+except ImportError:
+    ICMPLIB_AVAILABLE = False
+    print("Warning: icmplib not installed. Falling back to the ping command.")
+    print("Install with: pip install icmplib")
+
+# 本番用WSGIサーバー
+try:
+    from waitress import serve
+    WAITRESS_AVAILABLE = True
+except ImportError:
+    WAITRESS_AVAILABLE = False
+    print("Warning: waitress not installed. Using the Flask development server.")
+    print("Install with: pip install waitress")
+
+# 高速JSONエンコーダ
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+    print("Warning: orjson not installed. Using the standard json module.")
+    print("Install with: pip install orjson")
+
 # プロジェクトルートをパスに追加
 current_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.dirname(current_dir)
 sys.path.insert(0, project_root)
 
 from AdminWebService import database as db
+from AdminWebService import worker
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    orjsonでエンコード/デコードするJSONプロバイダ。
+    レスポンスの組み立ては DefaultJSONProvider.response() に任せ、dumps/loads だけを置き換える
+    (indent・sort_keys は DefaultJSONProvider と同じく扱う)。
+    """
+
+    def dumps(self, obj, **kwargs) -> str:
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=kwargs.get('default', self.default), option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+if ORJSON_AVAILABLE:
+    app.json = OrjsonProvider(app)
+
 # 設定
-UPLOAD_FOLDER = os.path.join(current_dir, 'uploads')
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'bmp'}
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+UPLOAD_DIR = Path(current_dir) / 'uploads'
+ALLOWED_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'bmp'})
+UPLOAD_DIR.mkdir(exist_ok=True)
 
-# ジョブキュー
-job_queue = queue.Queue()
+# アップロードサイズの上限 (超過時は413)
+MAX_UPLOAD_SIZE = 16 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
 
+# アップロードをディスクに書き出す際のチャンクサイズ
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# サムネイル (アップロードフォルダ内のサブフォルダに保存)
+THUMBNAIL_DIRNAME = 'thumbnails'
+THUMBNAIL_SIZE = (160, 160)
 
 def allowed_file(filename):
     """許可されたファイル拡張子かチェック"""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    _, dot, ext = filename.rpartition('.')
+    return bool(dot) and ext.lower() in ALLOWED_EXTENSIONS
+
+
+def save_upload(file, save_path: Path):
+    """
+    アップロードファイルをチャンク単位でディスクに書き出し、画像として検証する
+    一時ファイル (.part) に書いてからリネームするため、書き込み途中のファイルは見えない
+    :raises ValueError: 画像として読み込めない場合
+    """
+    part_path = save_path.with_name(save_path.name + '.part')
+    try:
+        with open(part_path, 'wb') as f:
+            while chunk := file.stream.read(UPLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+        # 拡張子ではなくファイル内容で画像か判定
+        try:
+            with Image.open(part_path) as img:
+                img.verify()
+        except Exception:
+            raise ValueError("画像ファイルとして読み込めません")
+
+        part_path.replace(save_path)
+    finally:
+        part_path.unlink(missing_ok=True)
+
+
+def is_safe_upload_name(file_name: str) -> bool:
+    """
+    アップロードディレクトリ直下のファイル名かチェック
+    (リクエストで指定されたファイル名で ../ などによりディレクトリ外を読み書きしないようにする)
+    """
+    if secure_filename(file_name) != file_name:
+        return False
+    upload_dir = UPLOAD_DIR.resolve()
+    return (upload_dir / file_name).resolve().parent == upload_dir
+
+
+def thumbnail_path_for(file_name: str) -> Path:
+    """アップロード画像に対応するサムネイルのパス"""
+    return UPLOAD_DIR / THUMBNAIL_DIRNAME / (file_name + '.thumb.png')
+
+
+def create_thumbnail(file_name: str):
+    """
+    アップロード画像から縮小サムネイルを生成
+    :return: サムネイルのパス (生成できなかった場合はNone)
+    """
+    thumb_path = thumbnail_path_for(file_name)
+    try:
+        thumb_path.parent.mkdir(exist_ok=True)
+        with Image.open(UPLOAD_DIR / file_name) as img:
+            img.thumbnail(THUMBNAIL_SIZE)
+            if img.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+                img = img.convert('RGB')
+            img.save(thumb_path, 'PNG', optimize=True)
+        return thumb_path
+    except Exception as e:
+        print(f"Thumbnail generation failed for {file_name}: {e}")
+        return None
+
+
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    """アップロードサイズ超過"""
+    return jsonify({
+        "status": "error",
+        "message": f"ファイルサイズが上限 ({MAX_UPLOAD_SIZE // (1024 * 1024)}MB) を超えています"
+    }), 413
 
 
 # === プリンタ設定 API (/admin/config) ===
@@ -164,11 +296,42 @@ def set_default():
 
 # === プリンタアクション API (/admin/action) ===
 
+# 非特権ICMPソケットが使えない環境ではpingコマンドにフォールバックする
+_icmp_socket_usable = True
+
+# pingコマンド出力から応答時間を抽出する正規表現
+_PING_RE_WIN = re.compile(r'(?:時間|time)\s*[=<]\s*(\d+)ms')
+_PING_RE_NIX = re.compile(r'time=(\d+\.?\d*)')
+
+
 def ping_host(ip_address: str) -> tuple:
     """
     ホストにPingを実行
     Returns: (success: bool, ping_ms: str)
     """
+    global _icmp_socket_usable
+
+    if ICMPLIB_AVAILABLE and _icmp_socket_usable:
+        try:
+            host = icmplib.ping(ip_address, count=1, timeout=3, privileged=False)
+        except icmplib.SocketPermissionError:
+            # net.ipv4.ping_group_range 未設定などで非特権ICMPソケットが作れない
+            _icmp_socket_usable = False
+        except Exception:
+            return False, "N/A"
+        else:
+            if host.is_alive:
+                return True, str(int(host.avg_rtt))
+            return False, "N/A"
+
+    return _ping_command(ip_address)
+
+
+def _ping_command(ip_address: str) -> tuple:
+    """
+    pingコマンドでPingを実行 (icmplibが使えない場合のフォールバック)
+    Returns: (success: bool, ping_ms: str)
+    """
     try:
         # Windows用pingコマンド
         if sys.platform == 'win32':
@@ -181,8 +344,7 @@ def ping_host(ip_address: str) -> tuple:
             if result.returncode == 0:
                 # 応答時間を抽出 (例: "時間=XXms" or "time=XXms")
                 output = result.stdout
-                import re
-                match = re.search(r'[時間|time][=<](\d+)ms', output)
+                match = _PING_RE_WIN.search(output)
                 if match:
                     return True, match.group(1)
                 return True, "1"
@@ -196,8 +358,7 @@ def ping_host(ip_address: str) -> tuple:
                 timeout=5
             )
             if result.returncode == 0:
-                import re
-                match = re.search(r'time=(\d+\.?\d*)', result.stdout)
+                match = _PING_RE_NIX.search(result.stdout)
                 if match:
                     return True, str(int(float(match.group(1))))
                 return True, "1"
@@ -209,6 +370,16 @@ def ping_host(ip_address: str) -> tuple:
         return False, "N/A"
 
 
+def _ping_status(ip_address: str) -> tuple:
+    """
+    Pingを実行し、DB更新用のタプルを返す
+    Returns: (ip_address, status, ping_ms)
+    """
+    success, ping_ms = ping_host(ip_address)
+    status = "OK" if success else "Failure"
+    return ip_address, status, ping_ms
+
+
 @app.route('/admin/action/ping', methods=['POST'])
 def ping_printer():
     """単一プリンタの疎通チェックを実行"""
@@ -246,11 +417,11 @@ def ping_all_printers():
             return jsonify({"status": "success", "message": "登録されたプリンタがありません"})
 
         def ping_all_async():
-            for printer in printers:
-                ip = printer['ip_address']
-                success, ping_ms = ping_host(ip)
-                status = "OK" if success else "Failure"
-                db.update_printer_status(ip, status, ping_ms)
+            # Pingは応答待ちが大半なのでスレッドで並列に実行する
+            with ThreadPoolExecutor(max_workers=min(32, len(printers))) as executor:
+                results = list(executor.map(_ping_status, [p['ip_address'] for p in printers]))
+            # 結果は1トランザクションでまとめて反映する
+            db.update_printer_statuses(results)
 
         thread = threading.Thread(target=ping_all_async)
         thread.start()
@@ -279,24 +450,24 @@ def test_print():
             return jsonify({"status": "error", "message": "IPアドレスが必要です"}), 400
         if not file_name:
             return jsonify({"status": "error", "message": "ファイル名が必要です"}), 400
+        if not is_safe_upload_name(file_name):
+            return jsonify({"status": "error", "message": f"ファイル名 '{file_name}' は使用できません"}), 400
 
         # ファイル存在チェック
-        file_path = os.path.join(UPLOAD_FOLDER, file_name)
-        if not os.path.exists(file_path):
+        file_path = UPLOAD_DIR / file_name
+        if not file_path.is_file():
             return jsonify({"status": "error", "message": f"ファイル '{file_name}' が見つかりません"}), 404
 
         # ジョブ作成
         job_id = str(uuid.uuid4())
-        thumbnail_path = file_path  # サムネイルは元ファイルを使用
-
-        db.add_job(job_id, file_name, ip_address, thumbnail_path)
+        thumbnail_path = thumbnail_path_for(file_name)
+        if not thumbnail_path.is_file():
+            # サムネイルが作れない場合は元ファイルを使用
+            thumbnail_path = create_thumbnail(file_name) or file_path
 
-        # ジョブをキューに追加
-        job_queue.put({
-            "job_id": job_id,
-            "file_path": file_path,
-            "printer_ip": ip_address
-        })
+        # jobsテーブルへの登録がそのままキューへの追加になる
+        db.add_job(job_id, file_name, ip_address, os.fspath(thumbnail_path))
+        worker.notify()
 
         return jsonify({
             "status": "success",
@@ -323,13 +494,18 @@ def upload_test_image():
             filename = secure_filename(file.filename)
             # 同名ファイルがある場合はタイムスタンプを付与
             base, ext = os.path.splitext(filename)
-            save_path = os.path.join(UPLOAD_FOLDER, filename)
-            if os.path.exists(save_path):
+            save_path = UPLOAD_DIR / filename
+            if save_path.exists():
                 timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
                 filename = f"{base}_{timestamp}{ext}"
-                save_path = os.path.join(UPLOAD_FOLDER, filename)
+                save_path = UPLOAD_DIR / filename
+
+            try:
+                save_upload(file, save_path)
+            except ValueError as e:
+                return jsonify({"status": "error", "message": str(e)}), 400
+            create_thumbnail(filename)
 
-            file.save(save_path)
             return jsonify({
                 "status": "success",
                 "message": f"ファイル '{filename}' をアップロードしました"
@@ -340,6 +516,8 @@ def upload_test_image():
                 "message": f"許可されていないファイル形式です。許可: {', '.join(ALLOWED_EXTENSIONS)}"
             }), 400
 
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
@@ -394,19 +572,12 @@ def retry_job():
             return jsonify({"status": "error", "message": "FAILEDステータスのジョブのみ再実行できます"}), 400
 
         # ファイル存在チェック
-        file_path = os.path.join(UPLOAD_FOLDER, job['file_name'])
-        if not os.path.exists(file_path):
+        if not (UPLOAD_DIR / job['file_name']).is_file():
             return jsonify({"status": "error", "message": f"ファイル '{job['file_name']}' が見つかりません"}), 404
 
-        # ステータスをQUEUEDに戻す
+        # ステータスをQUEUEDに戻すとワーカーが再度取得する
         db.update_job_status(job_id, 'QUEUED')
-
-        # ジョブをキューに再追加
-        job_queue.put({
-            "job_id": job_id,
-            "file_path": file_path,
-            "printer_ip": job['printer_ip']
-        })
+        worker.notify()
 
         return jsonify({
             "status": "success",
@@ -419,17 +590,36 @@ def retry_job():
 
 # === データ取得 API (/admin/data) ===
 
+# テストファイル一覧のキャッシュ (フォルダパス, フォルダのmtime, ファイル一覧)
+_test_files_cache = (None, None, [])
+
+
+def list_test_files() -> list:
+    """アップロードフォルダの画像ファイル一覧 (フォルダが変更されるまでキャッシュ)"""
+    global _test_files_cache
+    try:
+        mtime = UPLOAD_DIR.stat().st_mtime_ns
+    except FileNotFoundError:
+        return []
+
+    folder, cached_mtime, files = _test_files_cache
+    if folder == UPLOAD_DIR and cached_mtime == mtime:
+        return files
+
+    with os.scandir(UPLOAD_DIR) as entries:
+        files = sorted(
+            entry.name for entry in entries
+            if allowed_file(entry.name) and entry.is_file()
+        )
+    _test_files_cache = (UPLOAD_DIR, mtime, files)
+    return files
+
+
 @app.route('/admin/data/test_files', methods=['GET'])
 def get_test_files():
     """アップロード済みテストファイル名リストを取得"""
     try:
-        files = []
-        if os.path.exists(UPLOAD_FOLDER):
-            for f in os.listdir(UPLOAD_FOLDER):
-                if allowed_file(f):
-                    files.append(f)
-        files.sort()
-        return jsonify(files)
+        return jsonify(list_test_files())
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
@@ -448,6 +638,24 @@ def get_queue():
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
+@app.route('/admin/batch', methods=['GET'])
+def get_batch():
+    """ダッシュボード更新用にプリンタ・ジョブ・テストファイルを一括取得"""
+    try:
+        with db.shared_connection():
+            printers = db.get_all_printers()
+            jobs = db.get_all_jobs()
+            pending_count = db.get_pending_jobs_count()
+        return jsonify({
+            "printers": printers,
+            "jobs": jobs,
+            "pending_count": pending_count,
+            "files": list_test_files()
+        })
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
 @app.route('/admin/data/thumbnail', methods=['GET'])
 def get_thumbnail():
     """印刷ジョブのサムネイル画像を取得"""
@@ -462,7 +670,8 @@ def get_thumbnail():
 
         thumbnail_path = job.get('thumbnail_path')
         if thumbnail_path and os.path.exists(thumbnail_path):
-            return send_file(thumbnail_path, mimetype='image/png')
+            # ETag/Last-Modifiedで再取得時は304を返す
+            return send_file(thumbnail_path, conditional=True, max_age=3600)
         else:
             # 代替の透明SVG
             svg = '''<svg xmlns="http://www.w3.org/2000/svg" width="100" height="100">
@@ -534,68 +743,6 @@ def serve_static(filename):
     return send_from_directory('static', filename)
 
 
-# === ジョブワーカー ===
-
-def job_worker():
-    """バックグラウンドでジョブを処理するワーカー"""
-    while True:
-        try:
-            job_data = job_queue.get(timeout=1)
-        except queue.Empty:
-            continue
-
-        job_id = job_data['job_id']
-        file_path = job_data['file_path']
-        printer_ip = job_data['printer_ip']
-
-        # ジョブが削除されていないか確認
-        job = db.get_job(job_id)
-        if not job or job['status'] == 'DELETED':
-            job_queue.task_done()
-            continue
-
-        # 処理中に更新
-        db.update_job_status(job_id, 'PROCESSING')
-
-        try:
-            # プリンタドライバを使って印刷
-            from MCP31PRINT.printer_driver import PrinterDriver
-            from MCP31PRINT.image_converter import ImageConverter
-
-            # IPアドレスを指定してドライバを初期化
-            driver = PrinterDriver(printer_ip=printer_ip)
-            print(f"Job {job_id}: Printing to {printer_ip}")
-
-            # 画像を読み込んで印刷
-            from PIL import Image
-            img = Image.open(file_path)
-
-            converter = ImageConverter(default_width=driver.paper_width_dots)
-            # 画像をそのまま印刷
-            driver.print_image(img)
-            driver.print_empty_lines(3)
-            driver.cut_paper()
-
-            db.update_job_status(job_id, 'SUCCESS')
-            print(f"Job {job_id} completed successfully")
-
-        except Exception as e:
-            db.update_job_status(job_id, 'FAILED')
-            print(f"Job {job_id} failed: {e}")
-            import traceback
-            traceback.print_exc()
-
-        finally:
-            job_queue.task_done()
-
-
-def start_worker():
-    """ワーカースレッドを起動"""
-    worker_thread = threading.Thread(target=job_worker, daemon=True)
-    worker_thread.start()
-    print("Job worker started")
-
-
 # === mDNS サービスディスカバリ ===
 
 # グローバル変数でZeroconfインスタンスを保持
@@ -674,21 +821,56 @@ def unregister_mdns_service():
             _service_info = None
 
 
-# === メイン ===
+# === アプリケーション初期化 ===
 
-if __name__ == '__main__':
-    # DB初期化
-    db.init_db()
-    print("Database initialized")
+SERVER_PORT = 5000
+WSGI_THREADS = 16
+
+_app_initialized = False
+_app_init_lock = threading.Lock()
+
+
+def create_app(with_worker: bool = True):
+    """
+    アプリケーションを初期化して返す
+    DB初期化とワーカー起動はプロセスごとに1回だけ行う
+    ワーカーを別プロセス (python -m AdminWebService.worker) で動かす場合は
+    with_worker=False を指定する
+    (例: gunicorn -k gthread -w 2 --threads 8 'AdminWebService.admin_server:create_app(with_worker=False)')
+    """
+    global _app_initialized
 
-    # ワーカー起動
-    start_worker()
+    with _app_init_lock:
+        if not _app_initialized:
+            db.init_db()
+            print("Database initialized")
+            if with_worker:
+                worker.start_worker(os.fspath(UPLOAD_DIR))
+            _app_initialized = True
+    return app
+
+
+# === メイン ===
+
+def main():
+    """管理サーバーを起動 (ジョブワーカーも同じプロセスで動かす)"""
+    create_app()
 
     # mDNSサービス登録
-    register_mdns_service(port=5000)
+    register_mdns_service(port=SERVER_PORT)
 
     # 終了時にサービスを登録解除
     atexit.register(unregister_mdns_service)
 
     # サーバー起動（debugモード無効でワーカーが正しく動作する）
-    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
+    if WAITRESS_AVAILABLE:
+        print(f"Serving with waitress on port {SERVER_PORT} ({WSGI_THREADS} threads)")
+        serve(app, host='0.0.0.0', port=SERVER_PORT, threads=WSGI_THREADS)
+    else:
+        app.run(host='0.0.0.0', port=SERVER_PORT, debug=False, threaded=True)
+
+
+if __name__ == '__main__':
+    # 推奨は python -m AdminWebService (このファイルを直接起動すると、画像変換プロセスの起動時に
+    # このモジュール全体が __mp_main__ として再実行される)
+    main()
@@ -2,24 +2,174 @@
 """データベース管理モジュール"""
 
 import sqlite3
+import functools
 import os
+import queue
+import threading
+import time
 from datetime import datetime
 from contextlib import contextmanager
 
 DATABASE_PATH = os.path.join(os.path.dirname(__file__), 'admin.db')
 
-
-def get_db_connection():
-    """データベース接続を取得"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
+# プールに保持する接続数 (Flaskのリクエストスレッド + ワーカー程度)
+POOL_SIZE = 8
+
+# 接続ごとに一度だけ実行するPRAGMA
+# journal_modeはDBファイルに永続化されるため init_db() で設定する
+_CONNECTION_PRAGMAS = (
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA cache_size=-40000',
+    'PRAGMA busy_timeout=5000',
+)
+
+
+def get_db_connection(path: str = None):
+    """
+    データベース接続を取得
+    パスには "file:" で始まるURI (例: 共有インメモリDBの "file:name?mode=memory&cache=shared") も指定できる
+    """
+    conn = sqlite3.connect(path or DATABASE_PATH, check_same_thread=False, uri=True)
+    for pragma in _CONNECTION_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
+class _ConnPool:
+    """sqlite3接続のプール (LIFOで直近に使った接続を優先して再利用)"""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._closed = False
+
+    def acquire(self):
+        """空き接続を取り出す。なければ新規に開く"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return get_db_connection(self.path)
+
+    def release(self, conn):
+        """接続をプールに戻す。満杯または破棄済みの場合は閉じる"""
+        if self._closed:
+            conn.close()
+            return
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        """保持している全接続を閉じる"""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class _TTLCache:
+    """読み込み頻度の高いクエリ結果を短時間保持するキャッシュ (書き込み時に無効化)"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        # (結果, 取得時刻) をまとめて1つの属性に入れ、他スレッドの invalidate() と競合しても1回の読み込みで一貫した値を得る
+        self._entry = None
+        self._generation = 0
+
+    def get(self, loader):
+        """
+        キャッシュが新しければそれを返し、古ければloader()で取得し直す。
+        返り値は呼び出し元で共有されるため変更しないこと。
+        """
+        now = time.monotonic()
+        entry = self._entry
+        if entry is not None and now - entry[1] < self.ttl:
+            return entry[0]
+        generation = self._generation
+        data = loader()
+        # 読み込み中に無効化された場合は古い結果をキャッシュしない
+        if generation == self._generation:
+            self._entry = (data, now)
+        return data
+
+    def invalidate(self):
+        """キャッシュを破棄"""
+        self._generation += 1
+        self._entry = None
+
+
+# ダッシュボードのポーリングで繰り返し読まれるクエリのキャッシュ
+_PRINTERS_TTL = 2.0
+_PENDING_TTL = 2.0
+_printers_cache = _TTLCache(_PRINTERS_TTL)
+_pending_cache = _TTLCache(_PENDING_TTL)
+
+
+def _invalidate_caches():
+    """全キャッシュを破棄"""
+    _printers_cache.invalidate()
+    _pending_cache.invalidate()
+
+
+def _invalidates(*caches):
+    """書き込み関数の完了 (コミット) 後に指定キャッシュを破棄するデコレータ"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                for cache in caches:
+                    cache.invalidate()
+        return wrapper
+    return decorator
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# shared_connection() で固定したスレッドごとの接続
+_local = threading.local()
+
+
+def _get_pool():
+    """現在のDATABASE_PATHに対応する接続プールを取得"""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.path != DATABASE_PATH:
+            if _pool is not None:
+                _pool.close()
+            _pool = _ConnPool(DATABASE_PATH, POOL_SIZE)
+            _invalidate_caches()
+        return _pool
+
+
+def close_pool():
+    """接続プールを破棄して全接続を閉じる"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+        _invalidate_caches()
+
+
 @contextmanager
 def db_connection():
-    """コンテキストマネージャーでDB接続を管理"""
-    conn = get_db_connection()
+    """コンテキストマネージャーでDB接続を管理 (接続はプールから貸し出す)"""
+    shared = getattr(_local, 'conn', None)
+    if shared is not None:
+        # shared_connection() の中ではコミット/ロールバックは外側に任せる
+        yield shared
+        return
+
+    pool = _get_pool()
+    conn = pool.acquire()
     try:
         yield conn
         conn.commit()
@@ -27,7 +177,107 @@ def db_connection():
         conn.rollback()
         raise
     finally:
-        conn.close()
+        pool.release(conn)
+
+
+@contextmanager
+def shared_connection():
+    """
+    ブロック内のdb_connection()呼び出しで同じ接続を共有する
+    複数のクエリをまとめて実行するAPI (ダッシュボードの一括取得など) で使う
+    """
+    if getattr(_local, 'conn', None) is not None:
+        yield _local.conn
+        return
+
+    with db_connection() as conn:
+        _local.conn = conn
+        try:
+            yield conn
+        finally:
+            _local.conn = None
+
+
+# 日時は UNIX エポックからのミリ秒 (INTEGER) で保存し、読み出し時に文字列へ変換する
+_PRINTERS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS printers (
+        ip_address TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        is_default INTEGER DEFAULT 0,
+        status TEXT DEFAULT 'Unknown',
+        ping_ms TEXT DEFAULT 'N/A',
+        last_check INTEGER,
+        paper_width_dots INTEGER DEFAULT 576
+    )
+'''
+
+_JOBS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS jobs (
+        job_id TEXT PRIMARY KEY,
+        status TEXT DEFAULT 'QUEUED',
+        file_name TEXT,
+        printer_ip TEXT,
+        timestamp INTEGER,
+        thumbnail_path TEXT,
+        claimed_at INTEGER
+    )
+'''
+
+# ワーカーがジョブを取得 (PROCESSING) してから完了を記録するまでの期限 (秒)
+# ワーカーが処理中に強制終了した場合、この時間が過ぎたジョブは別のワーカーが取得し直す
+JOB_LEASE_SECONDS = 600
+
+
+def _now_ms() -> int:
+    """現在時刻 (UNIXエポックからのミリ秒)"""
+    return time.time_ns() // 1_000_000
+
+
+def _format_ms(ms, timespec: str = 'seconds'):
+    """ミリ秒エポックをローカル時刻の文字列に変換 (Noneはそのまま)"""
+    if ms is None:
+        return None
+    return datetime.fromtimestamp(ms / 1000).isoformat(' ', timespec)
+
+
+def _format_printer(printer):
+    """プリンタ行の日時を表示用に変換"""
+    if printer is not None:
+        printer['last_check'] = _format_ms(printer['last_check'])
+    return printer
+
+
+def _format_job(job):
+    """ジョブ行の日時を表示用に変換"""
+    if job is not None:
+        job['timestamp'] = _format_ms(job['timestamp'], 'milliseconds')
+        if 'claimed_at' in job:
+            job['claimed_at'] = _format_ms(job['claimed_at'], 'milliseconds')
+    return job
+
+
+def _migrate_timestamp_column(cursor, table: str, column: str, create_sql: str):
+    """
+    旧形式 (ローカル時刻のTEXT) の日時カラムをミリ秒エポックのINTEGERに移行
+    SQLiteはカラムの型を変更できないため、テーブルを作り直して値を変換する
+    """
+    cursor.execute(f"PRAGMA table_info({table})")
+    info = cursor.fetchall()
+    if any(col[1] == column and col[2].upper() == 'INTEGER' for col in info):
+        return
+
+    columns = [col[1] for col in info]
+    converted = [
+        f"CAST(ROUND((julianday({col}, 'utc') - 2440587.5) * 86400000) AS INTEGER)" if col == column else col
+        for col in columns
+    ]
+    cursor.execute(f'ALTER TABLE {table} RENAME TO {table}_old')
+    cursor.execute(create_sql)
+    cursor.execute(f'''
+        INSERT INTO {table} ({', '.join(columns)})
+        SELECT {', '.join(converted)} FROM {table}_old
+    ''')
+    cursor.execute(f'DROP TABLE {table}_old')
 
 
 def init_db():
@@ -35,18 +285,11 @@ def init_db():
     with db_connection() as conn:
         cursor = conn.cursor()
 
+        # WALモード: 小さなUPDATEごとのfsyncを削減し、読み込みと書き込みを並行させる
+        cursor.execute('PRAGMA journal_mode=WAL')
+
         # プリンタテーブル
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS printers (
-                ip_address TEXT PRIMARY KEY,
-                name TEXT NOT NULL,
-                is_default INTEGER DEFAULT 0,
-                status TEXT DEFAULT 'Unknown',
-                ping_ms TEXT DEFAULT 'N/A',
-                last_check TEXT,
-                paper_width_dots INTEGER DEFAULT 576
-            )
-        ''')
+        cursor.execute(_PRINTERS_TABLE_SQL)
 
         # 既存テーブルにpaper_width_dotsカラムがない場合は追加
         cursor.execute("PRAGMA table_info(printers)")
@@ -55,27 +298,51 @@ def init_db():
             cursor.execute('ALTER TABLE printers ADD COLUMN paper_width_dots INTEGER DEFAULT 576')
 
         # ジョブテーブル
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS jobs (
-                job_id TEXT PRIMARY KEY,
-                status TEXT DEFAULT 'QUEUED',
-                file_name TEXT,
-                printer_ip TEXT,
-                timestamp TEXT,
-                thumbnail_path TEXT
-            )
-        ''')
+        cursor.execute(_JOBS_TABLE_SQL)
+
+        # 日時カラムをミリ秒エポック (INTEGER) に移行
+        _migrate_timestamp_column(cursor, 'printers', 'last_check', _PRINTERS_TABLE_SQL)
+        _migrate_timestamp_column(cursor, 'jobs', 'timestamp', _JOBS_TABLE_SQL)
+
+        # 既存テーブルにclaimed_atカラム (ジョブを取得した日時) がない場合は追加
+        cursor.execute("PRAGMA table_info(jobs)")
+        columns = [col[1] for col in cursor.fetchall()]
+        if 'claimed_at' not in columns:
+            cursor.execute('ALTER TABLE jobs ADD COLUMN claimed_at INTEGER')
+
+        # ジョブテーブルのインデックス
+        # (status, timestamp) は status 単独の検索もカバーするため status 単独の索引は作らない
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_timestamp ON jobs(timestamp DESC)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status_timestamp ON jobs(status, timestamp)')
+
+
+def _rows_to_dicts(cursor, rows) -> list:
+    """行タプルをcursor.descriptionの列名でdictに変換 (列名の取得は1回だけ)"""
+    columns = [col[0] for col in cursor.description]
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def _row_to_dict(cursor, row):
+    """1行をdictに変換 (行がなければNone)"""
+    if row is None:
+        return None
+    return dict(zip([col[0] for col in cursor.description], row))
 
 
 # === プリンタ操作 ===
 
 def get_all_printers():
-    """全プリンタを取得"""
+    """全プリンタを取得 (短時間キャッシュ)。呼び出し元が変更してもキャッシュに影響しないようコピーを返す"""
+    return [dict(p) for p in _printers_cache.get(_fetch_all_printers)]
+
+
+def _fetch_all_printers():
+    """全プリンタをDBから取得"""
     with db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM printers ORDER BY is_default DESC, name ASC')
         rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+        return [_format_printer(p) for p in _rows_to_dicts(cursor, rows)]
 
 
 def get_printer(ip_address: str):
@@ -84,20 +351,22 @@ def get_printer(ip_address: str):
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM printers WHERE ip_address = ?', (ip_address,))
         row = cursor.fetchone()
-        return dict(row) if row else None
+        return _format_printer(_row_to_dict(cursor, row))
 
 
+@_invalidates(_printers_cache)
 def add_printer(name: str, ip_address: str, paper_width_dots: int = 576):
     """プリンタを追加"""
     with db_connection() as conn:
         cursor = conn.cursor()
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        now = _now_ms()
         cursor.execute('''
             INSERT INTO printers (ip_address, name, is_default, status, ping_ms, last_check, paper_width_dots)
             VALUES (?, ?, 0, 'Unknown', 'N/A', ?, ?)
         ''', (ip_address, name, now, paper_width_dots))
 
 
+@_invalidates(_printers_cache)
 def update_printer(ip_address: str, name: str = None, paper_width_dots: int = None):
     """プリンタ情報を更新"""
     with db_connection() as conn:
@@ -119,6 +388,7 @@ def update_printer(ip_address: str, name: str = None, paper_width_dots: int = No
         return False
 
 
+@_invalidates(_printers_cache)
 def delete_printer(ip_address: str):
     """プリンタを削除"""
     with db_connection() as conn:
@@ -127,6 +397,7 @@ def delete_printer(ip_address: str):
         return cursor.rowcount > 0
 
 
+@_invalidates(_printers_cache)
 def set_default_printer(ip_address: str):
     """デフォルトプリンタを設定"""
     with db_connection() as conn:
@@ -138,11 +409,12 @@ def set_default_printer(ip_address: str):
         return cursor.rowcount > 0
 
 
+@_invalidates(_printers_cache)
 def update_printer_status(ip_address: str, status: str, ping_ms: str):
     """プリンタのステータスを更新"""
     with db_connection() as conn:
         cursor = conn.cursor()
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        now = _now_ms()
         cursor.execute('''
             UPDATE printers
             SET status = ?, ping_ms = ?, last_check = ?
@@ -150,6 +422,22 @@ def update_printer_status(ip_address: str, status: str, ping_ms: str):
         ''', (status, ping_ms, now, ip_address))
 
 
+@_invalidates(_printers_cache)
+def update_printer_statuses(statuses: list):
+    """
+    複数プリンタのステータスを1トランザクションで更新
+    :param statuses: (ip_address, status, ping_ms) のリスト
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        now = _now_ms()
+        cursor.executemany('''
+            UPDATE printers
+            SET status = ?, ping_ms = ?, last_check = ?
+            WHERE ip_address = ?
+        ''', [(status, ping_ms, now, ip_address) for ip_address, status, ping_ms in statuses])
+
+
 # === ジョブ操作 ===
 
 def get_all_jobs():
@@ -158,11 +446,16 @@ def get_all_jobs():
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM jobs ORDER BY timestamp DESC')
         rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+        return [_format_job(j) for j in _rows_to_dicts(cursor, rows)]
 
 
 def get_pending_jobs_count():
-    """待機中ジョブ数を取得"""
+    """待機中ジョブ数を取得 (短時間キャッシュ)"""
+    return _pending_cache.get(_fetch_pending_jobs_count)
+
+
+def _fetch_pending_jobs_count():
+    """待機中ジョブ数をDBから取得"""
     with db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('QUEUED', 'PROCESSING')")
@@ -175,20 +468,22 @@ def get_job(job_id: str):
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,))
         row = cursor.fetchone()
-        return dict(row) if row else None
+        return _format_job(_row_to_dict(cursor, row))
 
 
+@_invalidates(_pending_cache)
 def add_job(job_id: str, file_name: str, printer_ip: str, thumbnail_path: str = None):
     """ジョブを追加"""
     with db_connection() as conn:
         cursor = conn.cursor()
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+        now = _now_ms()
         cursor.execute('''
             INSERT INTO jobs (job_id, status, file_name, printer_ip, timestamp, thumbnail_path)
             VALUES (?, 'QUEUED', ?, ?, ?, ?)
         ''', (job_id, file_name, printer_ip, now, thumbnail_path))
 
 
+@_invalidates(_pending_cache)
 def update_job_status(job_id: str, status: str):
     """ジョブステータスを更新"""
     with db_connection() as conn:
@@ -203,7 +498,44 @@ def get_queued_jobs():
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM jobs WHERE status = 'QUEUED' ORDER BY timestamp ASC")
         rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+        return [_format_job(j) for j in _rows_to_dicts(cursor, rows)]
+
+
+@_invalidates(_pending_cache)
+def claim_next_job(lease_seconds: float = JOB_LEASE_SECONDS):
+    """
+    最も古いQUEUEDジョブを取得してPROCESSINGに更新
+    条件付きUPDATEで取得するため、複数ワーカーが同じジョブを取ることはない
+    取得から lease_seconds 以上経っても完了していないPROCESSINGのジョブ
+    (取得したワーカーが処理中に終了したもの) も取得し直す
+    :return: 取得したジョブ (なければNone)
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        while True:
+            now = _now_ms()
+            cursor.execute('''
+                SELECT * FROM jobs
+                WHERE status = 'QUEUED'
+                   OR (status = 'PROCESSING' AND (claimed_at IS NULL OR claimed_at < ?))
+                ORDER BY timestamp ASC LIMIT 1
+            ''', (now - int(lease_seconds * 1000),))
+            job = _row_to_dict(cursor, cursor.fetchone())
+            if not job:
+                return None
+            # 読み込んだ時点から状態も取得日時も変わっていない場合だけ取得する
+            cursor.execute(
+                "UPDATE jobs SET status = 'PROCESSING', claimed_at = ? "
+                "WHERE job_id = ? AND status = ? AND claimed_at IS ?",
+                (now, job['job_id'], job['status'], job['claimed_at'])
+            )
+            if cursor.rowcount == 1:
+                if job['status'] == 'PROCESSING':
+                    print(f"Job {job['job_id']}: Reclaiming job whose worker did not finish it")
+                job['status'] = 'PROCESSING'
+                job['claimed_at'] = now
+                return _format_job(job)
+            # 他のワーカーが先に取得した場合は次のジョブを探す
 
 
 # 初期化
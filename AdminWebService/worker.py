@@ -0,0 +1,191 @@
+# AdminWebService/worker.py
+"""
+印刷ジョブワーカー
+
+jobsテーブルをキューとして使い、QUEUEDのジョブを1件ずつ取得して印刷する。
+ジョブの取得はDB上の条件付きUPDATEで行うため、複数のワーカーが同時に動いても
+同じジョブを二重に印刷しない。
+
+管理サーバーとは別プロセスとして起動できる:
+    python -m AdminWebService.worker
+"""
+
+import os
+import sys
+import signal
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# プロジェクトルートをパスに追加
+current_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(current_dir)
+sys.path.insert(0, project_root)
+
+from AdminWebService import database as db
+from MCP31PRINT.printer_driver import PrinterDriver, build_raster
+
+UPLOAD_FOLDER = os.path.join(current_dir, 'uploads')
+
+# キューが空のときの待機時間 (秒)
+# 同じプロセス内で追加されたジョブは notify() で即座に起こすため、
+# この間隔は別プロセス (管理サーバー) から追加されたジョブを拾うためだけに使う
+POLL_INTERVAL = 1.0
+
+# 新しいジョブの追加・停止要求でワーカーを起こすイベント
+_wake_event = threading.Event()
+
+# 画像変換 (CPU負荷が高い) を行うプロセス数
+# 別プロセスで変換することでFlaskのリクエストスレッドとGILを取り合わない
+CONVERSION_WORKERS = 2
+
+_conv_pool = None
+_conv_pool_lock = threading.Lock()
+
+# プリンタIPごとのドライバ (ジョブごとに作り直さない)
+_drivers = {}
+_drivers_lock = threading.Lock()
+
+
+def get_driver(printer_ip: str) -> PrinterDriver:
+    """プリンタIPに対応するドライバを取得 (なければ作成してキャッシュ)"""
+    with _drivers_lock:
+        driver = _drivers.get(printer_ip)
+        if driver is None:
+            driver = _drivers[printer_ip] = PrinterDriver(printer_ip=printer_ip)
+        return driver
+
+
+def convert_image(file_path: str, paper_width_dots: int) -> bytes:
+    """画像ファイルをラスターコマンドに変換 (変換プロセスで実行するためモジュール関数にしておく)"""
+    return build_raster(file_path, paper_width_dots)
+
+
+def _get_conv_pool() -> ProcessPoolExecutor:
+    """画像変換用のプロセスプールを取得 (初回呼び出し時に作成)"""
+    global _conv_pool
+    with _conv_pool_lock:
+        if _conv_pool is None:
+            # スレッドを持つプロセスからのforkを避けるためspawnで起動する
+            _conv_pool = ProcessPoolExecutor(
+                max_workers=CONVERSION_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _conv_pool
+
+
+def shutdown_conv_pool():
+    """画像変換用のプロセスプールを終了"""
+    global _conv_pool
+    with _conv_pool_lock:
+        if _conv_pool is not None:
+            _conv_pool.shutdown()
+            _conv_pool = None
+
+
+def _discard_conv_pool(pool: ProcessPoolExecutor):
+    """
+    使えなくなったプロセスプールを破棄し、次のジョブで作り直させる
+    (変換プロセスが異常終了するとプールは BrokenProcessPool のままになるため)。
+    他のスレッドがすでに作り直している場合は、新しいプールはそのまま残す。
+    """
+    global _conv_pool
+    with _conv_pool_lock:
+        if _conv_pool is pool:
+            _conv_pool = None
+    pool.shutdown(wait=False)
+
+
+def process_job(job: dict, upload_folder: str = UPLOAD_FOLDER):
+    """取得済み (PROCESSING) のジョブを1件印刷する"""
+    job_id = job['job_id']
+    printer_ip = job['printer_ip']
+    file_path = os.path.join(upload_folder, job['file_name'])
+
+    try:
+        driver = get_driver(printer_ip)
+        print(f"Job {job_id}: Printing to {printer_ip}")
+
+        # 画像の変換は別プロセスで行い、このスレッドはプリンタへの送信だけを行う
+        pool = _get_conv_pool()
+        try:
+            raster = pool.submit(convert_image, file_path, driver.paper_width_dots).result()
+        except BrokenProcessPool:
+            # 変換プロセスが異常終了した (メモリ不足でのkill、デコーダのクラッシュなど)
+            _discard_conv_pool(pool)
+            raise
+        with driver.session():
+            driver.print_raster(raster)
+            driver.print_empty_lines(3)
+            driver.cut_paper()
+
+        db.update_job_status(job_id, 'SUCCESS')
+        print(f"Job {job_id} completed successfully")
+
+    except Exception as e:
+        db.update_job_status(job_id, 'FAILED')
+        print(f"Job {job_id} failed: {e}")
+        import traceback
+        traceback.print_exc()
+
+
+def notify():
+    """新しいジョブが追加されたことをワーカーに通知"""
+    _wake_event.set()
+
+
+def stop(stop_event: threading.Event):
+    """ワーカーに停止を要求 (待機中でもすぐに抜ける)"""
+    stop_event.set()
+    _wake_event.set()
+
+
+def job_worker(upload_folder: str = UPLOAD_FOLDER, stop_event: threading.Event = None):
+    """jobsテーブルからジョブを取得して処理するワーカー (キューが空の間は通知を待つ)"""
+    stop_event = stop_event or threading.Event()
+
+    while not stop_event.is_set():
+        # 取得前にクリアしておき、取得〜待機の間に来た通知を取りこぼさない
+        _wake_event.clear()
+        try:
+            job = db.claim_next_job()
+        except Exception as e:
+            print(f"Failed to fetch next job: {e}")
+            job = None
+
+        if not job:
+            _wake_event.wait(POLL_INTERVAL)
+            continue
+
+        process_job(job, upload_folder)
+
+
+def start_worker(upload_folder: str = UPLOAD_FOLDER) -> threading.Thread:
+    """ワーカースレッドを起動"""
+    worker_thread = threading.Thread(target=job_worker, args=(upload_folder,), daemon=True)
+    worker_thread.start()
+    print("Job worker started")
+    return worker_thread
+
+
+def main():
+    """ワーカーを単独プロセスとして実行"""
+    db.init_db()
+    print("Database initialized")
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop(stop_event))
+
+    print("Job worker started")
+    try:
+        job_worker(stop_event=stop_event)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown_conv_pool()
+    print("Job worker stopped")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# _imaging.py
+# 印刷用の画像処理 (グレースケール変換・ディザリング・ビットパック)。build_raster() から使う。
+
+from PIL import Image
+import numpy as np
+import itertools
+import os
+
+# Numba (任意): インストールされていればグレースケール変換・ディザリングをJITコンパイルしたカーネルで行う
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+_debug_dump_ids = itertools.count(1)
+
+
+def debug_dumper():
+    """
+    処理途中の画像を保存する関数を返す (デバッグ用)。
+    ファイル名に呼び出しごとの番号を付け、同時に印刷しても互いに上書きしない。
+    """
+    prefix = f"debug_{os.getpid()}_{next(_debug_dump_ids)}"
+
+    def save(img: Image.Image, name: str):
+        img.save(f"{prefix}_{name}.png")
+    return save
+
+
+# BT.709 Luma の変換行列 (Image.convert("L", matrix) 用)
+BT709_LUMA_MATRIX = (0.2126, 0.7152, 0.0722, 0)
+
+# ガンマ補正の指数: (x ** (1 / 2.2)) ** 1.5 == x ** ((1 / 2.2) * 1.5)
+GAMMA_EXPONENT = (1 / 2.2) * 1.5
+
+# ガンマ補正テーブル (輝度0〜255 -> 補正後の値)
+# GAMMA_LUT[i] == round((((i / 255) ** (1 / 2.2)) ** 1.5) * 255) == round((i / 255) ** GAMMA_EXPONENT * 255)
+GAMMA_LUT = bytes(round((((i / 255) ** (1 / 2.2)) ** 1.5) * 255) for i in range(256))
+_GAMMA_LUT_ARRAY = np.frombuffer(GAMMA_LUT, dtype=np.uint8)
+
+
+if NUMBA_AVAILABLE:
+    @numba.njit(parallel=True, cache=True)
+    def _gamma_luma_kernel(rgb, lut, out):
+        """BT.709 Luma + ガンマ補正 (行ごとに並列実行)"""
+        height, width = out.shape
+        for y in numba.prange(height):
+            for x in range(width):
+                luma = 0.2126 * rgb[y, x, 0] + 0.7152 * rgb[y, x, 1] + 0.0722 * rgb[y, x, 2]
+                out[y, x] = lut[np.int64(np.rint(luma))]
+
+    @numba.njit(cache=True)
+    def _fs_dither_pack_kernel(rgb, lut, out, offset):
+        """
+        BT.709 Luma + ガンマ補正 + Floyd–Steinberg ディザリング + ビットパックを1パスで行う。
+        黒 (ドットを印字) の画素を out の offset ドット目以降のビットに立てる。
+        誤差は現在行と次の行の2行分だけを交互に使い回す。
+        """
+        height, width = rgb.shape[0], rgb.shape[1]
+        err = np.zeros((2, width + 2), dtype=np.float32) # 左右に1画素ずつ余白
+        for y in range(height):
+            cur = err[y & 1]
+            nxt = err[(y + 1) & 1]
+            nxt[:] = 0.0
+            for x in range(width):
+                luma = 0.2126 * rgb[y, x, 0] + 0.7152 * rgb[y, x, 1] + 0.0722 * rgb[y, x, 2]
+                value = np.float32(lut[np.int64(np.rint(luma))]) + cur[x + 1]
+                if value < 128.0:
+                    bit = x + offset
+                    out[y, bit >> 3] |= np.uint8(0x80 >> (bit & 7))
+                    e = value
+                else:
+                    e = value - np.float32(255.0)
+                cur[x + 2] += e * np.float32(7 / 16)
+                nxt[x] += e * np.float32(3 / 16)
+                nxt[x + 1] += e * np.float32(5 / 16)
+                nxt[x + 2] += e * np.float32(1 / 16)
+
+
+def _bt709_gamma_luma(img: Image.Image) -> Image.Image:
+    """
+    RGB/RGBA画像をBT.709 Luma + ガンマ補正したグレースケール (L) 画像に変換する。
+    輝度を0〜255に丸めてからGAMMA_LUTで補正するため、画素ごとのpow計算は行わない。
+    Numbaがあればカーネルで、なければPillowの変換行列とpoint()でC実装のまま計算する。
+    """
+    if NUMBA_AVAILABLE:
+        rgb = np.asarray(img)
+        out = np.empty(rgb.shape[:2], dtype=np.uint8)
+        _gamma_luma_kernel(rgb, _GAMMA_LUT_ARRAY, out)
+        return Image.fromarray(out, 'L')
+
+    if img.mode == "RGBA":
+        img = img.convert("RGB") # 変換行列はRGBのみ対応 (透過は合成済み)
+    return img.convert("L", BT709_LUMA_MATRIX).point(GAMMA_LUT)
+
+
+def _raster_layout(width: int, paper_width_dots: int, alignment: int = 0) -> tuple[int, int]:
+    """
+    幅を8の倍数にするパディングとアライメントの余白から、画像の配置を決める。
+    開始位置はバイト境界 (8の倍数) に切り捨てるため、余白はラスターデータのゼロのバイトになる。
+    :return: (画像の開始位置 (ドット, 8の倍数), ラスターの幅 (ドット, 8の倍数))
+    """
+    padded_width = (width + 7) & ~7
+
+    offset = 0
+    total_width = padded_width
+    if alignment == 1 and paper_width_dots > padded_width: # Center
+        offset = ((paper_width_dots - padded_width) // 2) & ~7
+        total_width = paper_width_dots
+    elif alignment == 2 and paper_width_dots > padded_width: # Right
+        offset = (paper_width_dots - padded_width) & ~7
+        total_width = paper_width_dots
+    return offset, (total_width + 7) & ~7
+
+
+def _raster_buffer(height: int, width_bytes: int, header_size: int) -> tuple[bytearray, np.ndarray]:
+    """
+    先頭にコマンドヘッダー分の領域を空けた、ゼロ (印字しない) で初期化済みのバッファを確保する。
+    :return: (バッファ全体, ラスターデータ部分を (行, バイト) で書き込めるビュー)
+    """
+    buf = bytearray(header_size + height * width_bytes)
+    rows = np.frombuffer(buf, dtype=np.uint8, offset=header_size).reshape(height, width_bytes)
+    return buf, rows
+
+
+def _dither_pack_raster(img: Image.Image, paper_width_dots: int, alignment: int = 0, header_size: int = 0) -> tuple[bytearray, int, int]:
+    """
+    RGB/RGBA画像をNumbaカーネルでグレースケール化・ディザリングし、ラスターデータに直接パックする。
+    Numbaがインストールされている場合のみ使用できる。
+    :param header_size: バッファの先頭に空けておくバイト数 (コマンドヘッダー用)
+    :return: (header_size バイト + ラスターデータ, パディング後の幅 (ドット), 高さ (ドット))
+    """
+    rgb = np.asarray(img)
+    height, width = rgb.shape[:2]
+    offset, total_width = _raster_layout(width, paper_width_dots, alignment)
+    buf, rows = _raster_buffer(height, total_width // 8, header_size)
+    _fs_dither_pack_kernel(rgb, _GAMMA_LUT_ARRAY, rows, offset)
+    return buf, total_width, height
+
+
+def _pack_raster(img: Image.Image, paper_width_dots: int, alignment: int = 0, header_size: int = 0) -> tuple[bytearray, int, int]:
+    """
+    1ビット画像をラスターデータ (1 = ドットを印字) にパックする。
+    白黒を反転した画像だけをパックし、アライメントの余白はバイト単位でずらして書き込む。
+    パディングと余白は印字しない (白) ビットになる。
+    :param header_size: バッファの先頭に空けておくバイト数 (コマンドヘッダー用)
+    :return: (header_size バイト + ラスターデータ, パディング後の幅 (ドット), 高さ (ドット))
+    """
+    ink = ~np.asarray(img, dtype=bool) # 白 (True) を反転し、黒をドットとして印字
+    height, width = ink.shape
+    offset, total_width = _raster_layout(width, paper_width_dots, alignment)
+
+    buf, rows = _raster_buffer(height, total_width // 8, header_size)
+    left_bytes = offset // 8
+    rows[:, left_bytes:left_bytes + (width + 7) // 8] = np.packbits(ink, axis=1) # 行末の端数ビットは0で埋まる
+    return buf, total_width, height
+
+
+def prepare_for_print(img: Image.Image, paper_width_dots: int, alignment: int = 0, dump=None, header_size: int = 0) -> tuple[int, int, bytearray]:
+    """
+    読み込み済みの画像を印刷用のラスターデータに変換する。
+    透過の合成・紙幅へのリサイズ・グレースケール変換・ディザリング・ビットパックをまとめて行う。
+    :param img: PIL.Image オブジェクト
+    :param paper_width_dots: 用紙幅のドット数
+    :param alignment: 画像の水平アライメント (0: 左寄せ, 1: 中央寄せ, 2: 右寄せ)
+    :param dump: 処理途中の画像を保存する関数 (debug_dumper() の戻り値)。Noneなら保存しない
+    :param header_size: 戻り値のバッファの先頭に空けておくバイト数 (呼び出し側がコマンドヘッダーを書き込む)
+    :return: (幅 (バイト), 高さ (ドット), header_size バイト + ラスターデータのバッファ)
+    """
+    width, height = img.size
+
+    # 2. RGBA (透過) 画像の処理
+    if img.mode == "RGBA":
+        bg = Image.new("RGBA", (width, height), (255, 255, 255, 255))
+        img = Image.alpha_composite(bg, img)
+        if dump:
+            dump(img, "02_rgba_processed")
+    # 3. リサイズ (プリンターの紙幅に合わせる)
+    if width > paper_width_dots:
+        img = img.resize((paper_width_dots, height * paper_width_dots // width), Image.Resampling.LANCZOS)
+        width, height = img.size
+        if dump:
+            dump(img, "03_resized")
+    if NUMBA_AVAILABLE and img.mode in ("RGB", "RGBA"):
+        # 4〜8. グレースケール変換・ディザリング・ビットパックをNumbaカーネルの1パスで行う
+        data, width, height = _dither_pack_raster(img, paper_width_dots, alignment, header_size)
+    else:
+        # 4. グレースケール変換 (BT.709 Luma + ガンマ補正)
+        if img.mode == "RGB" or img.mode == "RGBA":
+            img = _bt709_gamma_luma(img)
+            if dump:
+                dump(img, "04_grayscale_l")
+        elif img.mode not in ("1", "L"):
+            img = img.convert("L")
+            if dump:
+                dump(img, "04_grayscale_l")
+
+        # 5. モノクロ1ビット変換 (PillowのDitheringに切り替え)
+        if img.mode == "L":
+            img = img.convert('1', dither=Image.Dither.FLOYDSTEINBERG)
+            if dump:
+                dump(img, "05_monochrome_1bit")
+        # 6〜8. 反転・8の倍数へのパディング・アライメント・ビットパックを1回で行う
+        data, width, height = _pack_raster(img, paper_width_dots, alignment, header_size)
+    if dump:
+        dump(Image.frombytes("1", (width, height), bytes(data[header_size:])), "07_aligned")
+
+    return width // 8, height, data
@@ -1,35 +1,55 @@
 # image_converter.py
 
 from PIL import Image, ImageDraw, ImageFont
+import functools
 import io
 
+# text_to_bitmap_cached() で保持する画像の数
+TEXT_CACHE_SIZE = 128
+
+def load_font(font_path: str = None, font_size: int = 24):
+    """
+    フォントを読み込む (読み込めない場合はPillowのデフォルトフォント)。
+    .ttc の解析は重いため、複数の ImageConverter で使う場合は一度だけ読み込んで font 引数で渡す。
+    """
+    try:
+        if font_path:
+            return ImageFont.truetype(font_path, font_size)
+        else:
+            print("警告: フォントパスが指定されていません。Pillowのデフォルトフォントを使用します。")
+            print("日本語表示には適切なTrueTypeフォントを指定してください。")
+            return ImageFont.load_default()
+    except IOError:
+        print(f"エラー: フォントファイル '{font_path}' が見つからないか、読み込めません。")
+        print("Pillowのデフォルトフォントを使用します。")
+        return ImageFont.load_default()
+    except Exception as e:
+        print(f"フォントの読み込み中に予期せぬエラーが発生しました: {e}")
+        return ImageFont.load_default()
+
 class ImageConverter:
-    def __init__(self, font_path: str = None, font_size: int = 24, default_width: int = 576):
+    def __init__(self, font_path: str = None, font_size: int = 24, default_width: int = 576, font=None):
         """
         :param font_path: 使用するフォントファイルのパス (例: 'arial.ttf', 'Osaka.ttf' など)
         :param font_size: フォントサイズ
         :param default_width: 生成する画像のデフォルト幅 (プリンターの紙幅に合わせる)
+        :param font: 読み込み済みのフォント (load_font() の戻り値)。指定した場合は font_path から読み込まない
         """
         self.font_path = font_path
         self.font_size = font_size
         self.default_width = default_width
-        self.font = self._load_font()
+        self.font = font if font is not None else self._load_font()
+        # ヘッダー/フッターのように同じ文字列を繰り返し描画する場合用のキャッシュ (フォント・幅はインスタンスごとに固定)
+        self.text_to_bitmap_cached = functools.lru_cache(maxsize=TEXT_CACHE_SIZE)(self._text_to_bitmap_for_cache)
 
     def _load_font(self):
-        try:
-            if self.font_path:
-                return ImageFont.truetype(self.font_path, self.font_size)
-            else:
-                print("警告: フォントパスが指定されていません。Pillowのデフォルトフォントを使用します。")
-                print("日本語表示には適切なTrueTypeフォントを指定してください。")
-                return ImageFont.load_default()
-        except IOError:
-            print(f"エラー: フォントファイル '{self.font_path}' が見つからないか、読み込めません。")
-            print("Pillowのデフォルトフォントを使用します。")
-            return ImageFont.load_default()
-        except Exception as e:
-            print(f"フォントの読み込み中に予期せぬエラーが発生しました: {e}")
-            return ImageFont.load_default()
+        return load_font(self.font_path, self.font_size)
+
+    def _text_to_bitmap_for_cache(self, text: str) -> Image.Image:
+        """
+        text_to_bitmap_cached() の実体。同じ文字列には同じ画像オブジェクトを返すため、呼び出し側で変更しないこと。
+        """
+        return self.text_to_bitmap(text)
 
     def text_to_bitmap(self, text: str, output_path: str = None) -> Image.Image:
         """
@@ -126,7 +146,7 @@ class ImageConverter:
         """
         バイト列形式の画像データをPIL.Imageオブジェクトに変換する。
         必要に応じて、画像を90度回転させて、より大きな表示領域に収まるようにする。
-        :param image_bytes: 画像のバイト列データ (PNG, JPEGなどのファイルデータ)
+        :param image_bytes: 画像のバイト列データ (PNG, JPEGなどのファイルデータ、bytes/memoryview)
         :param auto_rotate_for_max_size: Trueの場合、画像の幅がデフォルト幅より小さいが、
                                          高さを幅として回転するとデフォルト幅に近づく場合、画像を90度回転させる。
                                          デフォルトはFalse（回転させない）。
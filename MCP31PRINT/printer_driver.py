@@ -1,11 +1,19 @@
 # printer_driver.py
 
 from escpos.printer import Network
-from PIL import Image, ImageOps
+from PIL import Image
+import codecs
+import errno
+import functools
 import io
+import os
+import select
 import time
 import socket
-from struct import pack
+import struct
+from contextlib import contextmanager
+
+from MCP31PRINT._imaging import debug_dumper, prepare_for_print
 
 # local_configから設定をインポート（存在しない場合はデフォルト値を使用）
 try:
@@ -18,6 +26,64 @@ except ImportError:
     DEFAULT_PRINTER_PORT = 9100
     DEFAULT_PAPER_WIDTH_DOTS = 576
 
+# StarPRNTラスターコマンドのヘッダー: ESC GS S 1 + xL xH (幅バイト数) + yL yH (高さドット数) + 0x00
+RASTER_COMMAND_PREFIX = b'\x1B\x1D\x53\x01' # ESC GS S 1
+RASTER_HEADER = struct.Struct("<4sHHB")
+
+# 環境変数 MCP31_DEBUG_DUMP=1 の場合のみ、印刷時に処理途中の画像を debug_*.png として保存する
+DEBUG_DUMP = bool(int(os.environ.get("MCP31_DEBUG_DUMP", "0")))
+
+
+def build_raster(image_input: str | io.BytesIO | Image.Image, paper_width_dots: int, alignment: int = 0, debug: bool = False) -> bytearray:
+    """
+    画像をStarPRNTのラスターコマンド (ESC GS S 1) に変換する。
+    プリンタとの通信を行わないため、別プロセスでの変換にも使える。
+    :param image_input: 画像ファイルのパス (str) または BytesIO オブジェクト、PIL.Image オブジェクト
+    :param paper_width_dots: 用紙幅のドット数
+    :param alignment: 画像の水平アライメント (0: 左寄せ, 1: 中央寄せ, 2: 右寄せ)
+    :param debug: Trueの場合は各処理段階の画像を debug_<pid>_<番号>_*.png として保存
+    :return: プリンタにそのまま送信できるラスターコマンドのバイト列
+    """
+    dump = debug_dumper() if debug else None
+
+    # 1. 画像の読み込みと初期処理
+    if isinstance(image_input, str) or isinstance(image_input, io.BytesIO):
+        img = Image.open(image_input)
+        # JPEGは紙幅以上の範囲で縮小しながらデコードさせる (1/2, 1/4, 1/8)。その他の形式では何もしない
+        img.draft(None, (paper_width_dots, 1))
+        img.load() # ここで1回だけデコードし、以降はメモリ上の画素を使う
+    elif isinstance(image_input, Image.Image):
+        img = image_input
+    else:
+        raise TypeError("image_input must be a file path (str), BytesIO, or PIL.Image object.")
+
+    if dump:
+        dump(img, "01_initial")
+
+    # 2〜8. 印刷用のラスターデータに変換 (先頭にコマンドヘッダー分の領域を空けたバッファに直接書き込む)
+    x_bytes_val, y_dots_val, command = prepare_for_print(img, paper_width_dots, alignment, dump, RASTER_HEADER.size)
+
+    # 9. StarPRNTラスターコマンドの組み立て (ESC GS S 1 コマンド形式)
+    # Command: ESC GS S 1 xL xH yL yH [data]
+    # xL, xH: image width in bytes (LSB first)
+    # yL, yH: image height in dots (LSB first)
+    # ESC GS S 1 コマンドは p1-p4 (データ長) を持ちません
+    RASTER_HEADER.pack_into(command, 0, RASTER_COMMAND_PREFIX, x_bytes_val, y_dots_val, 0)
+    return command
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoder(encoding: str):
+    """エンコーディング名からエンコード関数を取得 (codecsの検索を呼び出しごとに行わない)"""
+    return codecs.getencoder(encoding)
+
+
+# ESC a n で1回に紙送りできる最大行数
+MAX_FEED_LINES = 127
+
+# プリンターソケットの送信バッファサイズ (ラスターデータを分割せずにカーネルへ渡す)
+SEND_BUFFER_SIZE = 1 << 20
+
 
 class PrinterDriver:
     def __init__(self, printer_ip: str = None, printer_port: int = None, paper_width_dots: int = None):
@@ -31,6 +97,8 @@ class PrinterDriver:
         self.paper_width_dots = paper_width_dots or DEFAULT_PAPER_WIDTH_DOTS
         self.printer = None
         self.connection_timeout = 5 # 接続試行時のタイムアウト (秒)
+        self._owns_connection = False # 各メソッド内の _connect() が開いた接続なら True (session() 中は False)
+        self._tx_buf: bytearray | None = None # session() 中の送信バッファ
 
     def _connect(self) -> bool:
         """
@@ -45,11 +113,12 @@ class PrinterDriver:
         try:
             print(f"DEBUG: Connecting to printer at {self.printer_ip}:{self.printer_port}...")
             self.printer = Network(self.printer_ip, self.printer_port)
-            
-            self.printer._raw(b'\x1B\x40') # プリンター初期化コマンド
-            time.sleep(0.5) # プリンターがコマンドを処理するのを待つ
+            self.printer.device = self._open_socket(self.printer.timeout)
+
+            self._raw(b'\x1B\x40') # プリンター初期化コマンド
 
             print("DEBUG: Connection established and printer initialized.")
+            self._owns_connection = True
             return True
         except socket.timeout:
             print(f"ERROR: 接続タイムアウト - プリンター ({self.printer_ip}:{self.printer_port}) への接続がタイムアウトしました。")
@@ -65,6 +134,35 @@ class PrinterDriver:
             self.printer = None
             return False
 
+    def _open_socket(self, send_timeout: float) -> socket.socket:
+        """
+        プリンターへのソケットを開く内部関数。
+        Nagleを無効化 (TCP_NODELAY) し送信バッファを広げたうえで、
+        ノンブロッキングで接続して connection_timeout 秒だけ select() で待つ。
+        :param send_timeout: 接続後の送受信のタイムアウト (秒)
+        :raises socket.timeout: 接続がタイムアウトした場合
+        :raises OSError: 接続に失敗した場合
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+            sock.setblocking(False)
+            err = sock.connect_ex((self.printer_ip, self.printer_port))
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise OSError(err, os.strerror(err))
+            _, writable, _ = select.select([], [sock], [], self.connection_timeout)
+            if not writable:
+                raise socket.timeout(f"connect to {self.printer_ip}:{self.printer_port} timed out")
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise OSError(err, os.strerror(err))
+            sock.settimeout(send_timeout)
+            return sock
+        except BaseException:
+            sock.close()
+            raise
+
     def _disconnect(self):
         """
         プリンターとの接続を切断する内部関数。
@@ -77,6 +175,63 @@ class PrinterDriver:
                 print(f"ERROR: プリンター切断時にエラーが発生しました: {e}")
             finally:
                 self.printer = None # 必ず None に設定
+                self._owns_connection = False
+
+    def _raw(self, data: bytes):
+        """
+        コマンドを送信する内部関数。
+        session() 中は送信バッファに追加し、ブロックの終了時にまとめて送信する。
+        """
+        if self._tx_buf is not None:
+            self._tx_buf += data
+        else:
+            self.printer._raw(data)
+
+    def _flush(self):
+        """送信バッファに溜まったコマンドを1回の送信でプリンターに送る"""
+        if self._tx_buf:
+            self.printer._raw(self._tx_buf)
+            self._tx_buf = bytearray()
+
+    def _release(self):
+        """
+        各メソッドの終了時に呼ぶ内部関数。
+        そのメソッド内の _connect() で開いた接続だけを切断し、session() 中の接続は維持する。
+        """
+        if self._owns_connection:
+            self._disconnect()
+
+    @contextmanager
+    def session(self):
+        """
+        複数の印刷コマンドで1つの接続を使い回すコンテキストマネージャ。
+        ブロック内の print_* / cut_paper などは接続・初期化・切断を行わない。
+        送信するコマンドはバッファに溜め、ブロックを正常に抜けたときに1回で送信する
+        (例外で抜けた場合は送信せずに破棄する)。
+
+            with driver.session():
+                driver.print_image(img)
+                driver.print_empty_lines(3)
+                driver.cut_paper()
+
+        :raises ConnectionError: プリンタへの接続に失敗した場合
+        """
+        opened = self.printer is None
+        buffering = self._tx_buf is None # 入れ子の場合は外側のブロックで送信する
+        if buffering:
+            self._tx_buf = bytearray()
+        try:
+            if not self._connect():
+                raise ConnectionError(f"プリンタ {self.printer_ip}:{self.printer_port} への接続に失敗しました")
+            self._owns_connection = False # ブロック内のメソッドでは切断しない
+            yield self
+            if buffering:
+                self._flush()
+        finally:
+            if buffering:
+                self._tx_buf = None
+            if opened:
+                self._disconnect()
 
     def check_connection(self) -> bool:
         """
@@ -86,7 +241,7 @@ class PrinterDriver:
         print(f"プリンター {self.printer_ip}:{self.printer_port} への接続をチェック中...")
         if self._connect():
             print("プリンターへの接続に成功しました。")
-            self._disconnect() # 接続チェックのみなので、すぐに切断
+            self._release() # 接続チェックのみなので、すぐに切断
             return True
         else:
             print("プリンターへの接続に失敗しました。")
@@ -103,7 +258,8 @@ class PrinterDriver:
             return settings
 
         try:
-            self.printer._raw(b'\x1D\x49\x41') 
+            self._raw(b'\x1D\x49\x41') 
+            self._flush() # 応答を読む前にバッファを送信
             time.sleep(0.5) 
 
             # _read()はNetworkクラスのプライベートメソッドなので、
@@ -140,7 +296,7 @@ class PrinterDriver:
             print(f"ERROR: 予期せぬエラー - プリンター設定読み込み中にエラーが発生しました: {e}")
             settings['status'] = f"エラー: 予期せぬエラー: {e}"
         finally:
-            self._disconnect()
+            self._release()
         return settings
 
     def _send_raw_command(self, command: bytes) -> bool:
@@ -152,8 +308,7 @@ class PrinterDriver:
         if not self._connect(): # 各操作前に接続を試みる
             return False
         try:
-            self.printer._raw(command)
-            time.sleep(0.1) # コマンド送信後、少し待つ
+            self._raw(command)
             return True
         except socket.timeout:
             print(f"ERROR: コマンド送信タイムアウト - プリンター ({self.printer_ip}:{self.printer_port}) へのコマンド送信がタイムアウトしました。")
@@ -165,7 +320,7 @@ class PrinterDriver:
             print(f"ERROR: 予期せぬエラー - コマンド送信中にエラーが発生しました: {e}")
             return False
         finally:
-            self._disconnect() # 各操作後に切断
+            self._release() # 各操作後に切断 (session() 中を除く)
 
     def print_text_raw(self, text: str, encoding: str = 'shift_jis'):
         """
@@ -173,20 +328,17 @@ class PrinterDriver:
         詳細なエラー情報を出力。
         :param text: 印刷する文字列
         :param encoding: 文字列のエンコーディング (e.g., 'shift_jis', 'cp932')
+                         表現できない文字は '?' に置き換えて印刷する
         """
         if not self._connect():
             return
 
         try:
-            encoded_text = text.encode(encoding)
-            self.printer._raw(encoded_text)
-            self.printer._raw(b'\x0A') # 改行コード (LF) を追加
+            encoded_text, _ = _get_encoder(encoding)(text, 'replace')
+            self._raw(encoded_text + b'\x0A') # 改行コード (LF) を付けて1回で送信
             print(f"テキスト '{text}' を印刷しました。")
-            time.sleep(1) # テキスト印刷後、少し待つ
-        except UnicodeEncodeError as e:
-            print(f"ERROR: 文字列のエンコードに失敗しました ({encoding}): {e}")
-            print("DEBUG: 指定されたエンコーディングで文字列が表現できない可能性があります。")
-            return 0
+        except LookupError as e:
+            print(f"ERROR: 不明なエンコーディングです ({encoding}): {e}")
         except socket.timeout:
             print(f"ERROR: テキスト印刷タイムアウト - プリンター ({self.printer_ip}:{self.printer_port}) へのテキスト送信がタイムアウトしました。")
         except socket.error as e:
@@ -194,7 +346,7 @@ class PrinterDriver:
         except Exception as e:
             print(f"ERROR: 予期せぬエラー - テキスト印刷中にエラーが発生しました: {e}")
         finally:
-            self._disconnect()
+            self._release()
 
     def print_image(self, image_input: str | io.BytesIO | Image.Image, alignment: int = 0): # alignmentは0:Left, 1:Center, 2:Right
         """
@@ -208,94 +360,10 @@ class PrinterDriver:
             raise ConnectionError(f"プリンタ {self.printer_ip}:{self.printer_port} への接続に失敗しました")
 
         try:
-            self.printer._raw(b'\x1B\x40') # プリンター初期化コマンド
-            time.sleep(1) # 初期化コマンドが処理されるのを待つ
-            
-            # 1. 画像の読み込みと初期処理
-            if isinstance(image_input, str) or isinstance(image_input, io.BytesIO):
-                img = Image.open(image_input)
-            elif isinstance(image_input, Image.Image):
-                img = image_input
-            else:
-                raise TypeError("image_input must be a file path (str), BytesIO, or PIL.Image object.")
-            
-            img.save("debug_01_initial.png")
-            width, height = img.size
-
-            # 2. RGBA (透過) 画像の処理
-            if img.mode == "RGBA":
-                bg = Image.new("RGBA", (width, height), (255, 255, 255, 255))
-                img = Image.alpha_composite(bg, img)
-                img.save("debug_02_rgba_processed.png")
-            # 3. リサイズ (プリンターの紙幅に合わせる)
-            if width > self.paper_width_dots:
-                img = img.resize((self.paper_width_dots, height * self.paper_width_dots // width), Image.Resampling.LANCZOS)
-                width, height = img.size
-                img.save("debug_03_resized.png")
-            # 4. グレースケール変換 (BT.709 Luma + ガンマ補正)
-            if img.mode == "RGB" or img.mode == "RGBA":
-                new_img = Image.new("L", img.size)
-                img_data = img.getdata()
-                new_img.putdata([round((((0.2126 * pixel[0] + 0.7152 * pixel[1] + 0.0722 * pixel[2]) / 255) ** (1 / 2.2)) ** 1.5 * 255) for pixel in img_data])
-                img = new_img
-                img.save("debug_04_grayscale_l.png")
-            elif img.mode not in ("1", "L"):
-                img = img.convert("L")
-                img.save("debug_04_grayscale_l.png") 
-
-            # 5. モノクロ1ビット変換 (PillowのDitheringに切り替え)
-            if img.mode == "L":
-                img = img.convert('1', dither=Image.Dither.FLOYDSTEINBERG)
-                img.save("debug_05_monochrome_1bit.png")
-            img = ImageOps.invert(img)
-            # 6. 幅を8の倍数にパディング (プリンター要件)
-            if width % 8 != 0:
-                padded_width = width + (8 - width % 8)
-                padded_img = Image.new("1", (padded_width, height), 1) # 白でパディング
-                padded_img.paste(img, (0, 0))
-                img = padded_img
-                width, height = img.size
-                img.save("debug_06_padded.png")
-            
-            # 7. アライメント (余白を追加して位置調整)
-            if alignment == 1: # Center
-                padding_x = (self.paper_width_dots - width) // 2
-                if padding_x > 0:
-                    img = ImageOps.expand(img, (padding_x, 0, self.paper_width_dots - width - padding_x, 0), fill=1) # 白でパディング
-                    width, height = img.size
-                    img.save("debug_07_aligned.png")
-            
-            elif alignment == 2: # Right
-                padding_x = self.paper_width_dots - width
-                if padding_x > 0:
-                    img = ImageOps.expand(img, (padding_x, 0, 0, 0), fill=1) # 白でパディング
-                    width, height = img.size
-                    img.save("debug_07_aligned.png")
-
-            # 8. 画像データをバイト列に変換
-            data = img.tobytes()
-            
-            # 9. StarPRNTラスターコマンドの組み立てと送信 (ESC GS S 1 コマンド形式)
-            # Command: ESC GS S 1 xL xH yL yH [data]
-            # xL, xH: image width in bytes (LSB first)
-            # yL, yH: image height in dots (LSB first)
-            
-            x_bytes_val = width // 8
-            y_dots_val = height
-
-            # コマンドプレフィックスを ESC GS S 1 に変更
-            command_prefix = b'\x1B\x1D\x53\x01' # ESC GS S 1
-            
-            # struct.pack を使用してリトルエンディアンでパック
-            # ESC GS S 1 コマンドは p1-p4 (データ長) を持ちません
-            x_bytes = pack("<H", x_bytes_val) # 2バイトのunsigned short (xL xH)
-            y_bytes = pack("<H", y_dots_val) # 2バイトのunsigned short (yL yH)
-
-            full_command = command_prefix + x_bytes + y_bytes + b"\x00" + data
-            self.printer._raw(full_command)
+            full_command = build_raster(image_input, self.paper_width_dots, alignment, debug=DEBUG_DUMP)
+            self._raw(full_command)
             #self.printer._raw(b'\x0A')
             print("画像をラスターモードで印刷しました。")
-            time.sleep(1) # 画像印刷後、十分な待ち時間を設ける
 
         except FileNotFoundError:
             print(f"ERROR: 画像ファイルが見つかりません。")
@@ -306,7 +374,60 @@ class PrinterDriver:
             import traceback
             traceback.print_exc()
         finally:
-            self._disconnect()
+            self._release()
+
+    def print_images(self, images, padding: int = 1, alignment: int = 0):
+        """
+        複数の画像を1枚に結合せず、上から順にラスターコマンドに変換して印刷する。
+        紙幅×合計の高さの結合画像は作らない。images にジェネレーターを渡せば、
+        取り出した画像はラスターに変換した時点で手放せる (保持し続けるかは呼び出し側次第)。
+        session() 中は変換したラスター (1ドット1ビット) がブロックの終了まで送信バッファに溜まる。
+        :param images: PIL.Image オブジェクトのイテラブル (ジェネレーターでもよい)
+        :param padding: 画像間の余白 (ドット)
+        :param alignment: 画像の水平アライメント (0: 左寄せ, 1: 中央寄せ, 2: 右寄せ)
+        :raises ConnectionError: プリンタへの接続に失敗した場合
+        """
+        if not self._connect():
+            raise ConnectionError(f"プリンタ {self.printer_ip}:{self.printer_port} への接続に失敗しました")
+
+        try:
+            width_bytes = self.paper_width_dots // 8
+            for i, img in enumerate(images):
+                if i and padding:
+                    # 画像間の余白は白 (ゼロ) のラスターデータとして送る
+                    self._raw(RASTER_HEADER.pack(RASTER_COMMAND_PREFIX, width_bytes, padding, 0) + bytes(width_bytes * padding))
+                self._raw(build_raster(img, self.paper_width_dots, alignment, debug=DEBUG_DUMP))
+            print("画像をラスターモードで印刷しました。")
+
+        except TypeError as e:
+            print(f"ERROR: 画像入力の型が不正です: {e}")
+        except Exception as e:
+            print(f"ERROR: 画像印刷中に予期せぬエラーが発生しました: {e}")
+            import traceback
+            traceback.print_exc()
+        finally:
+            self._release()
+
+    def print_raster(self, raster_command: bytes):
+        """
+        build_raster() で変換済みのラスターコマンドを送信する。
+        画像変換を別プロセスで行い、送信だけをこのドライバで行う場合に使う。
+        :param raster_command: ESC GS S 1 で始まるラスターコマンドのバイト列
+        :raises ConnectionError: プリンタへの接続に失敗した場合
+        """
+        if not self._connect():
+            raise ConnectionError(f"プリンタ {self.printer_ip}:{self.printer_port} への接続に失敗しました")
+
+        try:
+            self._raw(raster_command)
+            print("画像をラスターモードで印刷しました。")
+        except Exception as e:
+            print(f"ERROR: ラスターデータ送信中に予期せぬエラーが発生しました: {e}")
+            import traceback
+            traceback.print_exc()
+        finally:
+            self._release()
+
     def print_image_from_bytes(self, image_bytes: bytes, alignment: int = 0):
         """
         バイト列形式の画像データをStarPRNTプリンターのラスターコマンドで印刷する。
@@ -319,108 +440,18 @@ class PrinterDriver:
             raise ConnectionError(f"プリンタ {self.printer_ip}:{self.printer_port} への接続に失敗しました")
 
         try:
-            self.printer._raw(b'\x1B\x40') # プリンター初期化コマンド
-            time.sleep(1) # 初期化コマンドが処理されるのを待つ
-            print("DEBUG: Printer initialized before image printing from bytes.")
-            
-            # バイト列からPIL.Imageオブジェクトを作成
-            img_io = io.BytesIO(image_bytes)
-            img = Image.open(img_io)
-            
-            print(f"DEBUG: Image received from bytes. Initial mode: {img.mode}, size: {img.size}")
-            # デバッグのためにPIL Imageオブジェクトを保存
-            img.save("debug_bytes_initial.png")
-
-            width, height = img.size
-
-            # 以降の画像処理は print_image と同じ
-            # 2. RGBA (透過) 画像の処理
-            if img.mode == "RGBA":
-                bg = Image.new("RGBA", (width, height), (255, 255, 255, 255))
-                img = Image.alpha_composite(bg, img)
-                print("DEBUG: RGBA image alpha-composited with white background from bytes.")
-                img.save("debug_bytes_rgba_processed.png")
-            # 3. リサイズ (プリンターの紙幅に合わせる)
-            if width > self.paper_width_dots:
-                img = img.resize((self.paper_width_dots, height * self.paper_width_dots // width), Image.Resampling.LANCZOS)
-                width, height = img.size
-                print(f"DEBUG: Image resized to fit paper width from bytes: {img.size}")
-                img.save("debug_bytes_resized.png")
-            # 4. グレースケール変換 (BT.709 Luma + ガンマ補正)
-            if img.mode == "RGB" or img.mode == "RGBA":
-                new_img = Image.new("L", img.size)
-                img_data = img.getdata()
-                new_img.putdata([round((((0.2126 * pixel[0] + 0.7152 * pixel[1] + 0.0722 * pixel[2]) / 255) ** (1 / 2.2)) ** 1.5 * 255) for pixel in img_data])
-                img = new_img
-                print("DEBUG: RGB/RGBA image converted to L (Luma) with gamma correction from bytes.")
-                img.save("debug_bytes_grayscale_l.png")
-            elif img.mode not in ("1", "L"):
-                img = img.convert("L")
-                print(f"DEBUG: Image converted to L (Grayscale) from {img.mode} from bytes.")
-                img.save("debug_bytes_grayscale_l.png") 
-
-            # 5. モノクロ1ビット変換 (PillowのDitheringに切り替え)
-            if img.mode == "L":
-                img = img.convert('1', dither=Image.Dither.FLOYDSTEINBERG)
-                print("DEBUG: Image converted to 1-bit monochrome with Pillow's FLOYDSTEINBERG dithering from bytes.")
-                img.save("debug_bytes_monochrome_1bit.png")
-            
-            img = ImageOps.invert(img)
-            img.save("debug_bytes_monochrome_1bit_inverted.png") # 反転後のデバッグ画像を保存
-
-            # 6. 幅を8の倍数にパディング (プリンター要件)
-            if width % 8 != 0:
-                padded_width = width + (8 - width % 8)
-                padded_img = Image.new("1", (padded_width, height), 1) # 白でパディング
-                padded_img.paste(img, (0, 0))
-                img = padded_img
-                width, height = img.size
-                print(f"DEBUG: Image padded to width {width} (multiple of 8) from bytes.")
-                img.save("debug_bytes_padded.png")
-            
-            # 7. アライメント (余白を追加して位置調整)
-            if alignment == 1: # Center
-                padding_x = (self.paper_width_dots - width) // 2
-                if padding_x > 0:
-                    img = ImageOps.expand(img, (padding_x, 0, self.paper_width_dots - width - padding_x, 0), fill=1) # 白でパディング
-                    width, height = img.size
-                    print(f"DEBUG: Image centered with padding {padding_x} from bytes.")
-                    img.save("debug_bytes_aligned.png")
-            
-            elif alignment == 2: # Right
-                padding_x = self.paper_width_dots - width
-                if padding_x > 0:
-                    img = ImageOps.expand(img, (padding_x, 0, 0, 0), fill=1) # 白でパディング
-                    width, height = img.size
-                    print(f"DEBUG: Image right-aligned with padding {padding_x} from bytes.")
-                    img.save("debug_bytes_aligned.png")
-
-            # 8. 画像データをバイト列に変換 (プリンター用)
-            data = img.tobytes()
-            print(f"DEBUG: Image data converted to bytes for printer. Length: {len(data)} bytes.")
-            print(f"DEBUG: First 20 bytes of printer data: {data[:20].hex()}")
-            
-            # 9. StarPRNTラスターコマンドの組み立てと送信 (ESC GS S 1 コマンド形式)
-            x_bytes_val = width // 8
-            y_dots_val = height
-
-            command_prefix = b'\x1B\x1D\x53\x01' # ESC GS S 1
-            
-            x_bytes = pack("<H", x_bytes_val) 
-            y_bytes = pack("<H", y_dots_val) 
-
-            full_command = command_prefix + x_bytes + y_bytes + b"\x00" + data
-            self.printer._raw(full_command)
-            self.printer._raw(b'\x0A') # 改行コード (LF) を追加
+            # バイト列からPIL.Imageオブジェクトを作成し、print_image と同じ処理でラスターコマンドに変換
+            full_command = build_raster(io.BytesIO(image_bytes), self.paper_width_dots, alignment, debug=DEBUG_DUMP)
+            self._raw(full_command)
+            self._raw(b'\x0A') # 改行コード (LF) を追加
             print("バイト列から画像をラスターモードで印刷しました。")
-            time.sleep(2) # 画像印刷後、十分な待ち時間を設ける
 
         except Exception as e:
             print(f"ERROR: バイト列からの画像印刷中に予期せぬエラーが発生しました: {e}")
             import traceback
             traceback.print_exc()
         finally:
-            self._disconnect()
+            self._release()
     def print_empty_lines(self, num_lines: int):
         """
         指定された行数だけ空白行を印刷して紙送りを行う。
@@ -431,14 +462,16 @@ class PrinterDriver:
             raise ConnectionError(f"プリンタ {self.printer_ip}:{self.printer_port} への接続に失敗しました")
         try:
             print(f"DEBUG: Printing {num_lines} empty lines for paper feed.")
-            for _ in range(num_lines):
-                self.printer._raw(b'\x0A') # LF (改行) を送信
+            # ESC a n (n行の紙送り、n = 1〜127)。StarPRNTでは ESC d n はカットコマンドのため使わない
+            command = bytearray()
+            for remaining in range(num_lines, 0, -MAX_FEED_LINES):
+                command += b'\x1B\x61' + bytes((min(remaining, MAX_FEED_LINES),))
+            self._raw(command)
             print(f"{num_lines}行の空白行を印刷しました。")
-            time.sleep(num_lines * 0.1) # 各行の印刷に少し時間をかける
         except Exception as e:
             print(f"ERROR: 空白行印刷中にエラーが発生しました: {e}")
         finally:
-            self._disconnect()
+            self._release()
     def cut_paper(self, mode: str = 'full'):
         """
         紙をカットする (StarPRNTコマンド)。
@@ -458,9 +491,8 @@ class PrinterDriver:
                 print("ERROR: 無効なカットモードです。'full' または 'partial' を指定してください。")
                 return
 
-            self.printer._raw(command)
+            self._raw(command)
             print(f"用紙カットコマンド '{mode}' を送信しました。")
-            time.sleep(0.5) # カット動作が完了するのを待つ
         except socket.timeout:
             print(f"ERROR: 用紙カットタイムアウト - プリンター ({self.printer_ip}:{self.printer_port}) へのコマンド送信がタイムアウトしました。")
         except socket.error as e:
@@ -468,4 +500,4 @@ class PrinterDriver:
         except Exception as e:
             print(f"ERROR: 予期せぬエラー - 用紙カット中にエラーが発生しました: {e}")
         finally:
-            self._disconnect()
+            self._release()
@@ -9,7 +9,7 @@ project_root = os.path.join(current_dir, '..')
 if project_root not in sys.path:
     sys.path.append(project_root)
 
-from common.network_utils import serialize_data 
+from common.network_utils import serialize_data, send_message, SOCKET_BUFFER_SIZE
 #from client.config import ClientConfig # 必要であれば
 
 try:
@@ -36,8 +36,9 @@ class FileSenderClient:
 
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
                 s.connect((self.server_ip, self.server_port))
-                s.sendall(serialized_data + b"<END_OF_TRANSMISSION>")
+                send_message(s, serialized_data)
             print("データが正常に送信されました。")
             return True
         except socket.error as e:
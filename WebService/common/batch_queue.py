@@ -0,0 +1,41 @@
+# common/batch_queue.py
+
+import threading
+from collections import deque
+
+
+class BatchQueue:
+    """
+    溜まっているアイテムをまとめて取り出せるスレッドセーフなキュー。
+    取り出し側は1回のロックで溜まっているアイテムをすべて受け取るため、
+    アイテムごとにロックを取り直したり、起こされ直したりしない。
+    """
+
+    def __init__(self):
+        self._items = deque()
+        self._not_empty = threading.Condition(threading.Lock())
+
+    def put(self, item):
+        """アイテムを1件追加する"""
+        self.put_many((item,))
+
+    def put_many(self, items):
+        """複数のアイテムを1回のロックでまとめて追加する"""
+        with self._not_empty:
+            self._items.extend(items)
+            self._not_empty.notify()
+
+    def drain(self, timeout=None):
+        """
+        溜まっているアイテムをすべて取り出す。空の場合は追加されるまで (timeout 秒まで) 待つ。
+        返り値: 追加された順のアイテムの deque (タイムアウトした場合は空)
+        """
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._items, timeout):
+                return deque()
+            items, self._items = self._items, deque()
+            return items
+
+    def qsize(self):
+        """取り出されていないアイテムの数"""
+        return len(self._items)
@@ -1,29 +1,108 @@
 # common/network_utils.py
 
 import json
-import base64
-import os # _process_content でのパス存在チェックに使用
+import binascii
+import re
+import socket
+import struct
 
-def _process_content(content_type, content_data):
+# orjson (任意): インストールされていればJSONのエンコード/デコードに使う
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# バイナリ形式のデータの先頭に付ける識別子 (これで始まらないデータは従来のJSON形式として扱う)
+BINARY_MAGIC = b"MCP31BIN\x01"
+
+# バイナリ形式の各画像の前に付ける長さ (4バイト、ビッグエンディアン)
+_BLOB_LENGTH = struct.Struct(">I")
+
+# 画像データとして受け付ける型 (BytesIO.getbuffer() や受信バッファのmemoryviewもコピーせずにそのまま送れる)
+_BYTES_LIKE = (bytes, bytearray, memoryview)
+
+# バイナリ形式のJSONヘッダーの終わり (memoryviewには find() がないため正規表現で探す)
+_META_END = re.compile(b"\n")
+
+# 送信データの先頭に付けるフレームヘッダー (識別子4バイト + データ長4バイト、ビッグエンディアン)
+# 受信側はデータ長の分だけ読めばよく、終端マーカーを探す必要がない
+FRAME_TAG = b"MCPF"
+_FRAME_HEADER = struct.Struct("!4sI")
+
+# 送信データの終端マーカー (フレームヘッダーを付けない従来のクライアント用)
+END_OF_TRANSMISSION = b"<END_OF_TRANSMISSION>"
+
+# 受信バッファの初期サイズ (足りなくなったら倍に広げる)
+RECV_BUFFER_SIZE = 64 * 1024
+
+# フレームヘッダーで受け付けるデータ長の上限
+# データ長はクライアントが送ってくる値のため、受信前にその大きさのバッファを確保しないよう上限を設ける
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# ソケットの送受信バッファサイズ (画像を含むデータを少ないシステムコールで送受信する)
+SOCKET_BUFFER_SIZE = 1 << 20
+
+# 受信の最小バイト数 (これだけ溜まるか接続が閉じられるまでrecvから戻らない)
+RECV_LOWAT = 64 * 1024
+
+# 接続後、データが届くまで accept() に渡さずに待つ秒数 (TCP_DEFER_ACCEPT、Linuxのみ)
+DEFER_ACCEPT_SECONDS = 5
+
+def _json_dumps(obj):
+    """オブジェクトをJSONのバイト列にエンコードする"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+def _json_loads(data):
+    """JSONのバイト列 (bytes/memoryview) をデコードする (文字列へのデコードは行わない)"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(bytes(data))
+
+def _b64encode(data):
+    """バイト列をBase64の文字列にする (Base64はASCIIのみなので 'ascii' でデコードする)"""
+    return binascii.b2a_base64(data, newline=False).decode('ascii')
+
+def _process_path_content(path):
+    """画像ファイルのパスからバイト列を読み込むヘルパー関数 (存在確認はせず、読み込みの失敗で判定する)"""
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError as e:
+        print(f"Error reading image file '{path}': {e}")
+        return None
+
+def _load_image_content(content_type, content_data, allow_paths=False):
+    """
+    ヘッダー/フッターの画像コンテンツをバイト列として取得するヘルパー関数。
+    バイト列 (bytes/bytearray/memoryview) はそのまま返し、ファイルパス (str) は allow_paths=True の場合だけ読み込む。
+    """
+    if isinstance(content_data, _BYTES_LIKE):
+        return content_data
+    if isinstance(content_data, str):
+        if allow_paths:
+            return _process_path_content(content_data)
+        print(f"Error: Image content for type '{content_type}' must be bytes, not a file path: '{content_data}'. "
+              "Read the file before sending, or pass allow_paths=True.")
+        return None
+    print(f"Warning: Invalid image content data for type '{content_type}': {type(content_data)}")
+    return None
+
+def _process_bytes_content(content_bytes):
+    """画像のバイト列をJSONに含めるBase64文字列に変換するヘルパー関数"""
+    return _b64encode(content_bytes)
+
+def _process_content(content_type, content_data, allow_paths=False):
     """ヘッダー/フッターのコンテンツを処理し、JSONに含める形式に変換するヘルパー関数"""
     if content_type == "text":
         return content_data
     elif content_type == "image":
-        # content_data が既にバイトデータであることを想定
-        if isinstance(content_data, bytes):
-            return base64.b64encode(content_data).decode('utf-8')
-        # もしパスが渡された場合のために、互換性を持たせる（ただし、本来は呼び出し元でバイト化すべき）
-        elif isinstance(content_data, str) and os.path.exists(content_data):
-            try:
-                with open(content_data, "rb") as f:
-                    image_bytes = f.read()
-                    return base64.b64encode(image_bytes).decode('utf-8')
-            except IOError as e:
-                print(f"Error reading image file '{content_data}': {e}")
-                return None
-        else:
-            print(f"Warning: Invalid image content data for type '{content_type}': {type(content_data)}")
-            return None
+        image_bytes = _load_image_content(content_type, content_data, allow_paths)
+        if image_bytes is not None:
+            return _process_bytes_content(image_bytes)
+        return None
     return None
 
 def _deprocess_content(content_type, encoded_content):
@@ -32,17 +111,96 @@ def _deprocess_content(content_type, encoded_content):
         return encoded_content
     elif content_type == "image":
         if encoded_content:
-            return base64.b64decode(encoded_content.encode('utf-8'))
+            return binascii.a2b_base64(encoded_content)
     return None
 
+def _serialize_binary(header, body_text, body_image_bytes_list, footer, allow_paths=False):
+    """
+    画像をBase64にせずにシリアライズする。
+    形式: BINARY_MAGIC + JSONヘッダー + b"\\n" + (4バイトの長さ + 画像バイト列) の繰り返し
+    画像はヘッダー画像、本文画像、フッター画像の順に並べ、JSONヘッダーには画像の枚数だけを入れる。
+    """
+    meta = {
+        "header": None,
+        "body_text": body_text,
+        "body_images": 0,
+        "footer": None
+    }
+    blobs = {"header": [], "body": [], "footer": []}
+
+    for key, content in (("header", header), ("footer", footer)):
+        if not (content and "type" in content and "content" in content):
+            continue
+        if content["type"] == "image":
+            image_bytes = _load_image_content(content["type"], content["content"], allow_paths)
+            if image_bytes is not None:
+                meta[key] = {"type": "image"}
+                blobs[key].append(image_bytes)
+        elif content["type"] == "text":
+            meta[key] = {"type": "text", "content": content["content"]}
+
+    if body_image_bytes_list:
+        for img_bytes in body_image_bytes_list:
+            if isinstance(img_bytes, _BYTES_LIKE): # バイト列であることを確認
+                blobs["body"].append(img_bytes)
+            else:
+                print(f"Warning: Expected bytes for body image, but got {type(img_bytes)}. Skipping.")
+    meta["body_images"] = len(blobs["body"])
+
+    parts = [BINARY_MAGIC, _json_dumps(meta), b"\n"]
+    for blob in blobs["header"] + blobs["body"] + blobs["footer"]:
+        parts.append(_BLOB_LENGTH.pack(memoryview(blob).nbytes)) # memoryviewの len() は要素数のためバイト数で数える
+        parts.append(blob)
+    return b"".join(parts)
+
+def _deserialize_binary(data):
+    """
+    _serialize_binary() の形式のデータを復元する。
+    画像は受信バッファをコピーせず、data を参照するmemoryviewのまま返す
+    (画像が参照されている間は data も解放されない)。
+    """
+    view = memoryview(data)
+    match = _META_END.search(view, len(BINARY_MAGIC))
+    if match is None:
+        raise ValueError("Missing metadata terminator in binary payload")
+    newline = match.start()
+    meta = _json_loads(view[len(BINARY_MAGIC):newline])
+    offset = newline + 1
+
+    def next_blob():
+        nonlocal offset
+        (length,) = _BLOB_LENGTH.unpack_from(view, offset)
+        start = offset + _BLOB_LENGTH.size
+        offset = start + length
+        if offset > len(view):
+            raise ValueError("Truncated image data in binary payload")
+        return view[start:offset]
+
+    def content_of(part):
+        if not part:
+            return None
+        if part.get("type") == "image":
+            return {"type": "image", "content": next_blob()}
+        return {"type": part.get("type"), "content": part.get("content")}
+
+    header_data = content_of(meta.get("header"))
+    body_image_bytes_list = [next_blob() for _ in range(meta.get("body_images", 0))]
+    footer_data = content_of(meta.get("footer"))
+    return header_data, meta.get("body_text") or "", body_image_bytes_list, footer_data
+
 # serialize_data 関数の引数を変更: body_image_paths -> body_image_bytes_list
-def serialize_data(header=None, body_text=None, body_image_bytes_list=None, footer=None):
+def serialize_data(header=None, body_text=None, body_image_bytes_list=None, footer=None, binary=True, allow_paths=False):
     """
-    ヘッダー、本文（テキストと画像バイトリスト）、フッターをJSON形式でシリアライズします。
-    header/footer: {"type": "text" or "image", "content": "文字列" or "画像ファイルパス"}
+    ヘッダー、本文（テキストと画像バイトリスト）、フッターをシリアライズします。
+    header/footer: {"type": "text" or "image", "content": "文字列" or 画像バイトデータ}
     body_image_bytes_list: [画像バイトデータ1, 画像バイトデータ2, ...]
+    画像バイトデータは bytes/bytearray/memoryview のいずれでもよい
+    binary: Trueの場合は画像をBase64にしないバイナリ形式、Falseの場合は従来のJSON形式
+    allow_paths: Trueの場合はヘッダー/フッターの画像に画像ファイルパスも指定できる
     """
-    
+    if binary:
+        return _serialize_binary(header, body_text, body_image_bytes_list, footer, allow_paths)
+
     data = {
         "header": None,
         "body_text": body_text,
@@ -52,7 +210,7 @@ def serialize_data(header=None, body_text=None, body_image_bytes_list=None, foot
 
     # ヘッダーの処理
     if header and "type" in header and "content" in header:
-        processed_header_content = _process_content(header["type"], header["content"])
+        processed_header_content = _process_content(header["type"], header["content"], allow_paths)
         if processed_header_content is not None:
             data["header"] = {
                 "type": header["type"],
@@ -62,32 +220,37 @@ def serialize_data(header=None, body_text=None, body_image_bytes_list=None, foot
     # 本文画像の処理: ここでファイル読み込みは行わず、既にバイト列が渡されていることを想定
     if body_image_bytes_list:
         for img_bytes in body_image_bytes_list:
-            if isinstance(img_bytes, bytes): # バイト列であることを確認
-                data["body_images"].append(base64.b64encode(img_bytes).decode('utf-8'))
+            if isinstance(img_bytes, _BYTES_LIKE): # バイト列であることを確認
+                data["body_images"].append(_process_bytes_content(img_bytes))
             else:
                 print(f"Warning: Expected bytes for body image, but got {type(img_bytes)}. Skipping.")
 
 
     # フッターの処理
     if footer and "type" in footer and "content" in footer:
-        processed_footer_content = _process_content(footer["type"], footer["content"])
+        processed_footer_content = _process_content(footer["type"], footer["content"], allow_paths)
         if processed_footer_content is not None:
             data["footer"] = {
                 "type": footer["type"],
                 "content": processed_footer_content
             }
             
-    return json.dumps(data).encode('utf-8')
+    return _json_dumps(data)
 
-# deserialize_data は変更なし
 def deserialize_data(json_data_bytes):
     """
-    JSON形式のバイト文字列をデシリアライズして、ヘッダー、本文（テキストと画像リスト）、フッターを取得します。
+    シリアライズされたバイト文字列 (bytes/bytearray/memoryview) をデシリアライズして、ヘッダー、本文（テキストと画像リスト）、フッターを取得します。
+    バイナリ形式 (BINARY_MAGIC で始まる) と従来のJSON形式のどちらも受け付けます。
     返り値: header_data, body_text, body_image_bytes_list, footer_data
     header_data/footer_data: {"type": "text" or "image", "content": "文字列" or バイトデータ}
     body_image_bytes_list: [画像バイト1, 画像バイト2, ...]
+    画像のバイトデータは、バイナリ形式では json_data_bytes を参照するmemoryview、従来のJSON形式ではbytes
     """
-    data = json.loads(json_data_bytes.decode('utf-8'))
+    view = memoryview(json_data_bytes)
+    if view[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+        return _deserialize_binary(view)
+
+    data = _json_loads(view)
     
     header_data = None
     if data.get("header"):
@@ -101,7 +264,7 @@ def deserialize_data(json_data_bytes):
     body_image_bytes_list = []
     if "body_images" in data and isinstance(data["body_images"], list):
         for img_base64 in data["body_images"]:
-            body_image_bytes_list.append(base64.b64decode(img_base64.encode('utf-8')))
+            body_image_bytes_list.append(binascii.a2b_base64(img_base64))
             
     footer_data = None
     if data.get("footer"):
@@ -110,4 +273,110 @@ def deserialize_data(json_data_bytes):
             "content": _deprocess_content(data["footer"].get("type"), data["footer"].get("content"))
         }
             
-    return header_data, body_text, body_image_bytes_list, footer_data
\ No newline at end of file
+    return header_data, body_text, body_image_bytes_list, footer_data
+
+def _recv_exactly(conn, view):
+    """view がいっぱいになるまで受信する。返り値: 受信したバイト数 (途中で閉じられた場合は len(view) 未満)"""
+    received = 0
+    while received < len(view):
+        with view[received:] as rest:
+            n = conn.recv_into(rest)
+        if not n:
+            break
+        received += n
+    return received
+
+def _receive_until_marker(conn, buf, size, marker):
+    """
+    終端マーカー (またはクローズ) まで buf の size バイト目以降に受信する (従来の形式)。
+    受信済みのデータを毎回コピーしないよう、倍々に広げるbytearrayへ recv_into で直接書き込み、
+    マーカーは新しく受信した範囲 (と直前のマーカー長分) だけを探す。
+    マーカーまでのデータが MAX_FRAME_SIZE を超える場合は ValueError を送出する (バッファはそれ以上広げない)。
+    """
+    limit = MAX_FRAME_SIZE + len(marker)
+    while True:
+        if size == len(buf):
+            if size >= limit:
+                raise ValueError(f"Data too large: no end marker within {MAX_FRAME_SIZE} bytes")
+            buf.extend(bytes(min(len(buf), limit - len(buf))))
+        with memoryview(buf)[size:] as view:
+            received = conn.recv_into(view)
+        if not received:
+            break
+        end = buf.find(marker, max(0, size - len(marker) + 1), size + received)
+        size += received
+        if end != -1:
+            size = end
+            break
+    del buf[size:]
+    return buf
+
+def receive_message(conn, marker=END_OF_TRANSMISSION, initial_size=RECV_BUFFER_SIZE):
+    """
+    ソケットから1件分のデータを受信します。
+    フレームヘッダーで始まる場合はデータ長ちょうどのbytearrayを確保してそこへ直接受信し、
+    そうでなければ従来の形式として終端マーカー (またはクローズ) までを受信します。
+    データ長が MAX_FRAME_SIZE を超える場合は ValueError を送出します
+    (フレームヘッダーの場合はバッファを確保せず、従来の形式の場合は上限を超えてバッファを広げない)。
+    返り値: 受信データ (bytearray、そのまま deserialize_data に渡せる)
+    """
+    buf = bytearray(max(initial_size, _FRAME_HEADER.size))
+    with memoryview(buf)[:_FRAME_HEADER.size] as view:
+        size = _recv_exactly(conn, view)
+
+    if size == _FRAME_HEADER.size and buf.startswith(FRAME_TAG):
+        _, length = _FRAME_HEADER.unpack_from(buf)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Framed data too large: {length} bytes (max {MAX_FRAME_SIZE})")
+        payload = bytearray(length)
+        with memoryview(payload) as view:
+            if _recv_exactly(conn, view) < length:
+                raise ConnectionError(f"Connection closed before receiving {length} bytes of framed data")
+        return payload
+
+    return _receive_until_marker(conn, buf, size, marker)
+
+def configure_listen_socket(sock):
+    """
+    待ち受けソケットの受信バッファを広げ、データが届いた接続だけを accept() で受け取るようにする
+    (TCP_DEFER_ACCEPT、対応していないプラットフォームでは設定しない)。
+    受け付けた接続はこの設定を引き継ぐため、listen() の前に呼ぶ。
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    if hasattr(socket, "TCP_DEFER_ACCEPT"):
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT, DEFER_ACCEPT_SECONDS)
+        except OSError as e:
+            print(f"Warning: Failed to set socket option TCP_DEFER_ACCEPT: {e}")
+
+def configure_accepted_socket(conn):
+    """
+    受け付けた接続に、まとまったデータが届くまで起こさない設定 (SO_RCVLOWAT) と
+    即時ACK (TCP_QUICKACK、Linuxのみ) を設定する。対応していないプラットフォームでは何もしない。
+    """
+    options = [(socket.SOL_SOCKET, getattr(socket, "SO_RCVLOWAT", None), RECV_LOWAT),
+               (socket.IPPROTO_TCP, getattr(socket, "TCP_QUICKACK", None), 1)]
+    for level, option, value in options:
+        if option is None:
+            continue
+        try:
+            conn.setsockopt(level, option, value)
+        except OSError as e:
+            print(f"Warning: Failed to set socket option {option}: {e}")
+
+def send_message(sock, data):
+    """
+    シリアライズ済みのデータをフレームヘッダー (データ長) 付きで送信します。
+    ヘッダーとデータを連結するとデータ全体のコピーが発生するため、sendmsg で1回の書き込みとしてまとめて送る
+    (別々に送ると、小さいヘッダーのACK待ちでデータの送信が遅れることがある)。
+    """
+    header = _FRAME_HEADER.pack(FRAME_TAG, len(data))
+    if not hasattr(sock, "sendmsg"): # Windows
+        sock.sendall(header + data)
+        return
+    sent = sock.sendmsg([header, data])
+    if sent < len(header):
+        sock.sendall(header[sent:])
+        sent = len(header)
+    with memoryview(data) as view:
+        sock.sendall(view[sent - len(header):])
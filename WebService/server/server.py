@@ -2,19 +2,29 @@ import socket
 import threading
 import os
 import sys
-import queue # queueモジュールをインポート
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.join(current_dir, '..')
 sys.path.append(project_root)
 
-from datetime import datetime
-from common.network_utils import deserialize_data
+from common.batch_queue import BatchQueue
+from common.network_utils import deserialize_data, receive_message, configure_listen_socket, configure_accepted_socket
 from .config import BaseServerConfig
 
-from MCP31PRINT.printer_driver import PrinterDriver
-from MCP31PRINT.image_converter import ImageConverter
+from MCP31PRINT.printer_driver import PrinterDriver, DEFAULT_PRINTER_IP
+from MCP31PRINT.image_converter import ImageConverter, load_font
 FONT_PATH='/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc'
+FONT_SIZE=30
+
+# ヘッダー/フッターのコンテンツの種類ごとの変換処理
+# ヘッダー/フッターの文字列は毎回ほぼ同じなので、描画結果をキャッシュから使う
+_SECTION_HANDLERS = {
+    "text": lambda converter, content: converter.text_to_bitmap_cached(content),
+    "image": lambda converter, content: converter.image_from_bytes(content),
+}
 
 try:
     from .MyActualServerConfig import MyActualServerConfig as ActualServerConfig
@@ -23,127 +33,176 @@ except ImportError:
     print("Please copy ServerConfig.py.template to MyActualServerConfig.py and set actual values.")
     exit(1)
 
+def _convert(task):
+    """
+    変換処理を実行し、画像のデコードまで済ませる (Image.open() は読み込みを遅延するため)。
+    失敗した場合は None を返す。
+    """
+    try:
+        img = task()
+        if img is not None:
+            img.load()
+        return img
+    except Exception as e:
+        print(f"Error converting content in worker: {e}")
+        return None
+
 class FileReceiverServer:
     def __init__(self):
         self.host = ActualServerConfig().SERVER_IP
         self.port = ActualServerConfig().SERVER_PORT
-        self.output_dir = os.path.join(current_dir, "received_files") # output_dir は相対パスのままでOK
-                                                                        # os.path.join は絶対パスと結合すると絶対パスになる
-        os.makedirs(self.output_dir, exist_ok=True)
-
-        # ★追加: プリントジョブキューを初期化
-        self.print_queue = queue.Queue()
-        # ★追加: ワーカースレッドを起動
-        self.printer_worker_thread = threading.Thread(target=self._printer_worker, daemon=True)
-        self.printer_worker_thread.start()
-        print("Printer worker thread started.")
-
-    def _printer_worker(self):
+
+        # プリンタIPごとのプリントジョブキュー (キューごとに専用のワーカースレッドを起動する)
+        # 1つのキューに全接続からのジョブを集めると、そのロックを全スレッドで取り合うため分けておく
+        self.queues: dict[str, BatchQueue] = {}
+        self._queues_lock = threading.Lock()
+
+        # ジョブ内の画像変換 (テキストの描画・画像のデコード) を並行して行うスレッドプール (全プリンタで共有)
+        # Pillowはデコード・リサイズ中にGILを解放するため、画像の多いジョブほど速くなる
+        self._convert_pool = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1),
+                                                thread_name_prefix="convert")
+
+        # フォントの読み込み (.ttc の解析) は重いため一度だけ行い、全プリンタのワーカーで共有する
+        self._font = load_font(FONT_PATH, FONT_SIZE)
+        self._get_queue(DEFAULT_PRINTER_IP)
+
+        # 受信処理用のスレッドプール (接続ごとにスレッドを作らず、同時に処理する接続数に上限を設ける)
+        self._accept_pool = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4),
+                                               thread_name_prefix="recv")
+
+    def _get_queue(self, printer_ip):
+        """
+        プリンタIPに対応するキューを取得する。
+        初めて使うプリンタならキュー・ドライバ・画像コンバータを作成し、そのプリンタ専用のワーカースレッドを起動する。
+        """
+        print_queue = self.queues.get(printer_ip) # 作成済みならロックを取らずに返す
+        if print_queue is not None:
+            return print_queue
+        with self._queues_lock:
+            print_queue = self.queues.get(printer_ip)
+            if print_queue is None:
+                driver = PrinterDriver(printer_ip=printer_ip)
+                converter = ImageConverter(
+                    font_path=FONT_PATH,
+                    font_size=FONT_SIZE,
+                    default_width=driver.paper_width_dots,
+                    font=self._font
+                )
+                print_queue = self.queues[printer_ip] = BatchQueue()
+                worker = threading.Thread(target=self._printer_worker, args=(print_queue, driver, converter),
+                                          name=f"printer-{printer_ip}", daemon=True)
+                worker.start()
+                print(f"Printer worker thread for {printer_ip} started.")
+            return print_queue
+
+    def _printer_worker(self, print_queue, driver, converter):
         """
         プリントキューからジョブを取り出し、順次プリンターに送信するワーカースレッド。
         """
-        driver = PrinterDriver()
-        converter = ImageConverter(
-            font_path=FONT_PATH,
-            font_size=30,
-            default_width=driver.paper_width_dots
-        )
-        
+        jobs = ()
+
+        def remaining():
+            """取り出し済みで未処理のジョブも含めた残りのジョブ数"""
+            return len(jobs) + print_queue.qsize()
+
         while True:
-            # キューからジョブを取得。キューが空の場合は、ジョブが来るまでここで待機する。
-            job_data = self.print_queue.get() 
-            print(f"Processing print job from queue. Queue size: {self.print_queue.qsize()}")
+            # キューに溜まったジョブを1回のロックでまとめて取り出す。キューが空の場合は、ジョブが来るまでここで待機する。
+            jobs = print_queue.drain()
+            if len(jobs) > 1:
+                print(f"Drained {len(jobs)} jobs from queue.")
+            while jobs:
+                self._print_job(driver, converter, jobs.popleft(), remaining)
+
+    def _render_section(self, converter, section, label):
+        """
+        ヘッダー/フッター ({"type": "text" or "image", "content": ...}、文字列、画像のバイト列) を画像に変換する。
+        変換できない場合は None を返す (印刷時にスキップされる)。
+        """
+        if isinstance(section, dict):
+            handler = _SECTION_HANDLERS.get(section.get("type"))
+            content = section.get("content")
+            if handler and content:
+                return handler(converter, content)
+        elif isinstance(section, str):
+            return converter.text_to_bitmap_cached(section)
+        elif isinstance(section, (bytes, memoryview)):
+            return converter.image_from_bytes(section)
+        print(f"Warning: Unexpected {label}_data format in worker: {type(section)} - {section}")
+        return None
+
+    def _print_job(self, driver, converter, job_data, remaining):
+        """
+        1件のジョブ (deserialize_data の返り値) を画像に変換してプリンターに送信する。
+        remaining: 残りのジョブ数を返す関数 (ログ用)
+        """
+        print(f"Processing print job from queue. Queue size: {remaining()}")
 
-            try:
-                # job_data は deserialize_data の返り値（header_data, body_text, body_image_bytes_list, footer_data）
-                header_data, body_text, body_image_bytes_list, footer_data = job_data
-
-                imglist = []
-                
-                # ヘッダー処理
-                if header_data:
-                    if isinstance(header_data, dict) and header_data.get("type") == "text" and header_data.get("content"):
-                        imglist.append(converter.text_to_bitmap(text=header_data["content"]))
-                    elif isinstance(header_data, dict) and header_data.get("type") == "image" and header_data.get("content"):
-                        imglist.append(converter.image_from_bytes(header_data["content"]))
-                    elif isinstance(header_data, str):
-                        imglist.append(converter.text_to_bitmap(text=header_data))
-                    else:
-                        print(f"Warning: Unexpected header_data format in worker: {type(header_data)} - {header_data}")
-
-                # 本文テキスト処理
-                if body_text:
-                    imglist.append(converter.text_to_bitmap(text=body_text))
-                    print(f"Converting body text to image in worker: {body_text[:50]}...")
-
-                # 本文画像処理
-                if body_image_bytes_list:
-                    for i, image_bytes in enumerate(body_image_bytes_list):
-                        imglist.append(converter.image_from_bytes(image_bytes=image_bytes))
-                        print(f"Converting body image {i+1} to image in worker.")
-
-                # フッター処理
-                if footer_data:
-                    if isinstance(footer_data, dict) and footer_data.get("type") == "image" and footer_data.get("content"):
-                        imglist.append(converter.image_from_bytes(footer_data["content"]))
-                        print("Converting footer QR image to image in worker.")
-                    elif isinstance(footer_data, dict) and footer_data.get("type") == "text" and footer_data.get("content"):
-                        imglist.append(converter.text_to_bitmap(text=footer_data["content"]))
-                        print("Converting footer text to image in worker.")
-                    elif isinstance(footer_data, bytes):
-                        imglist.append(converter.image_from_bytes(footer_data))
-                        print("Converting raw footer image bytes to image in worker.")
-                    else:
-                        print(f"Warning: Unexpected footer_data format in worker: {type(footer_data)} - {footer_data}")
-
-                # すべての画像を結合して印刷
-                if imglist:
-                    printimg = converter.combine_images_vertically(images=imglist)
-                    if printimg:
-                        driver.print_image(printimg)
-                        driver.print_empty_lines(5)
-                        print("\n--- 紙をカット ---")
-                        driver.cut_paper(mode='full')
-                        print(f"Job completed successfully. Remaining in queue: {self.print_queue.qsize()}")
-                    else:
-                        print("Worker: No combined image to print.")
-                else:
-                    print("Worker: No content to print for this job.")
-
-            except Exception as e:
-                print(f"Error processing print job in worker: {e}")
-                import traceback
-                traceback.print_exc()
-            finally:
-                # ジョブ処理が完了したことをキューに通知
-                self.print_queue.task_done()
-                print(f"Job finished. Remaining in queue: {self.print_queue.qsize()}")
+        try:
+            # job_data は deserialize_data の返り値（header_data, body_text, body_image_bytes_list, footer_data）
+            header_data, body_text, body_image_bytes_list, footer_data = job_data
+
+            # 各部分の変換処理を印刷する順に並べる
+            tasks = []
+
+            # ヘッダー処理
+            if header_data:
+                tasks.append(functools.partial(self._render_section, converter, header_data, "header"))
+
+            # 本文テキスト処理
+            if body_text:
+                tasks.append(functools.partial(converter.text_to_bitmap, text=body_text))
+                print(f"Converting body text to image in worker: {body_text[:50]}...")
+
+            # 本文画像処理
+            if body_image_bytes_list:
+                for i, image_bytes in enumerate(body_image_bytes_list):
+                    tasks.append(functools.partial(converter.image_from_bytes, image_bytes=image_bytes))
+                    print(f"Converting body image {i+1} to image in worker.")
+
+            # フッター処理
+            if footer_data:
+                tasks.append(functools.partial(self._render_section, converter, footer_data, "footer"))
+
+            # 変換はスレッドプールで並行して行い、結果は順番どおりに受け取る
+            # リストにまとめず1枚ずつ取り出すことで、ラスターに変換し終えた画像から手放す
+            images = (img for img in self._convert_pool.map(_convert, tasks) if img is not None) # 変換に失敗したものは除く
+            first = next(images, None)
+
+            # すべての画像を上から順に印刷
+            # 結合した1枚の画像は作らず、1枚ずつラスターに変換して送る (combine_images_vertically と同じくRGBにそろえる)
+            if first is not None:
+                with driver.session():
+                    driver.print_images(img if img.mode == 'RGB' else img.convert('RGB')
+                                        for img in itertools.chain((first,), images))
+                    driver.print_empty_lines(5)
+                    print("\n--- 紙をカット ---")
+                    driver.cut_paper(mode='full')
+                print(f"Job completed successfully. Remaining in queue: {remaining()}")
+            else:
+                print("Worker: No content to print for this job.")
+
+        except Exception as e:
+            print(f"Error processing print job in worker: {e}")
+            import traceback
+            traceback.print_exc()
+        finally:
+            print(f"Job finished. Remaining in queue: {remaining()}")
 
 
     def _handle_client(self, conn, addr):
         print(f"Connected by {addr}")
         try:
-            data_buffer = b""
-            while True:
-                chunk = conn.recv(4096)
-                if not chunk:
-                    break
-                data_buffer += chunk
-                if b"<END_OF_TRANSMISSION>" in data_buffer:
-                    data_buffer = data_buffer.replace(b"<END_OF_TRANSMISSION>", b"")
-                    break
+            data_buffer = receive_message(conn)
 
             # 受信したデータをキューに追加するだけに変更
             header_data, body_text, body_image_bytes_list, footer_data = deserialize_data(data_buffer)
             
-            # 受信時刻と送信元IPは、ファイル保存などのデバッグ用途で残しておく
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-            sender_ip = addr[0].replace('.', '_')
-
-            # ジョブデータをタプルとしてキューに入れる
+            # ジョブデータをタプルとして、印刷先プリンタのキューに入れる
+            # (送信データには印刷先の指定がないため、現状はすべてデフォルトのプリンタに送る)
             job_tuple = (header_data, body_text, body_image_bytes_list, footer_data)
-            self.print_queue.put(job_tuple)
-            print(f"Received data from {addr} and added to print queue. Current queue size: {self.print_queue.qsize()}")
+            print_queue = self._get_queue(DEFAULT_PRINTER_IP)
+            print_queue.put(job_tuple)
+            print(f"Received data from {addr} and added to print queue. Current queue size: {print_queue.qsize()}")
 
         except Exception as e:
             print(f"Error handling client {addr}: {e}")
@@ -156,13 +215,20 @@ class FileReceiverServer:
     def start(self):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            configure_listen_socket(s)
             s.bind((self.host, self.port))
-            s.listen()
+            s.listen(socket.SOMAXCONN) # 印刷の送信が集中しても接続を拒否しないよう、バックログを最大にする
             print(f"Server listening on {self.host}:{self.port}")
-            while True:
-                conn, addr = s.accept()
-                thread = threading.Thread(target=self._handle_client, args=(conn, addr))
-                thread.start()
+            try:
+                while True:
+                    conn, addr = s.accept()
+                    configure_accepted_socket(conn)
+                    self._accept_pool.submit(self._handle_client, conn, addr)
+            except KeyboardInterrupt:
+                print("Shutting down server...")
+            finally:
+                # 受信待ちの接続は破棄し、処理中の接続だけ終わるのを待つ
+                self._accept_pool.shutdown(wait=True, cancel_futures=True)
 
 if __name__ == "__main__":
     server = FileReceiverServer()
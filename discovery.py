@@ -18,7 +18,9 @@ MCP31プリントサーバー自動発見ユーティリティ
         print(f"Server: {s['name']} at {s['ip']}:{s['port']}")
 """
 
+import atexit
 import socket
+import threading
 import time
 from typing import Optional
 
@@ -30,12 +32,51 @@ except ImportError:
 
 SERVICE_TYPE = "_mcp31print._tcp.local."
 
+# プロセス内で使い回すZeroconfとServiceBrowser (初回の検索時に作成し、終了時に閉じる)
+_zc = None
+_browser = None
+_listener = None
+_browser_started = 0.0 # ServiceBrowserを開始した時刻 (time.monotonic())
+_browser_lock = threading.Lock()
+
 
 class PrintServerListener(ServiceListener):
     """mDNSサービス発見用リスナー"""
 
     def __init__(self):
-        self.servers = []
+        self._servers: dict[tuple[str, int], dict] = {} # (IP, ポート) -> サーバー情報
+        self._keys: dict[str, tuple[str, int]] = {} # サービス名 -> (IP, ポート)
+        self.found = threading.Event() # サーバーが1台以上見つかっている間セット
+
+    @property
+    def servers(self) -> list:
+        """見つかっているサーバーのリスト (見つかった順)"""
+        return list(self._servers.values())
+
+    def _remove_by_name(self, name: str) -> None:
+        """サービス名が一致するサーバーを取り除く"""
+        key = self._keys.pop(name, None)
+        if key is not None:
+            self._servers.pop(key, None)
+        if not self._servers:
+            self.found.clear()
+
+    def _put(self, server_info: dict) -> None:
+        """
+        サーバーを登録する。同じサービスが再起動などで別のアドレスから通知された場合は古い方を置き換える。
+        新しい方を登録してから古い方を消すため、読み取り側が一時的に空のリストを見ることはない
+        """
+        name = server_info["name"]
+        key = (server_info["ip"], server_info["port"])
+        previous = self._servers.get(key)
+        if previous is not None and previous["name"] != name:
+            self._keys.pop(previous["name"], None) # 同じアドレスを別の名前で使っていたサービスは置き換わる
+        self._servers[key] = server_info
+        old_key = self._keys.get(name)
+        self._keys[name] = key
+        if old_key is not None and old_key != key:
+            self._servers.pop(old_key, None)
+        self.found.set()
 
     def add_service(self, zc: Zeroconf, type_: str, name: str) -> None:
         info = zc.get_service_info(type_, name)
@@ -53,21 +94,55 @@ class PrintServerListener(ServiceListener):
                     },
                     "hostname": info.server
                 }
-                self.servers.append(server_info)
+                self._put(server_info)
 
     def remove_service(self, zc: Zeroconf, type_: str, name: str) -> None:
-        pass
+        self._remove_by_name(name.replace(f".{SERVICE_TYPE}", ""))
 
     def update_service(self, zc: Zeroconf, type_: str, name: str) -> None:
-        pass
+        self.add_service(zc, type_, name)
+
+
+def _close_browser():
+    """共有しているZeroconfを閉じる"""
+    global _zc, _browser, _listener
+    with _browser_lock:
+        if _zc is not None:
+            _zc.close()
+        _zc = _browser = _listener = None
+
+atexit.register(_close_browser)
+
 
+def _get_listener(force: bool = False):
+    """
+    プロセス内で共有するリスナーを取得する (初回や force=True の場合はZeroconfとServiceBrowserを作成)
 
-def discover_print_servers(timeout: float = 3.0) -> list:
+    Returns:
+        (リスナー, ServiceBrowserを開始した時刻)
+    """
+    global _zc, _browser, _listener, _browser_started
+    if force:
+        _close_browser()
+    with _browser_lock:
+        if _zc is None:
+            _zc = Zeroconf()
+            _listener = PrintServerListener()
+            _browser = ServiceBrowser(_zc, SERVICE_TYPE, _listener)
+            _browser_started = time.monotonic()
+        return _listener, _browser_started
+
+
+def discover_print_servers(timeout: float = 3.0, first_only: bool = False, force: bool = False) -> list:
     """
     ローカルネットワーク内の全MCP31プリントサーバーを発見
+    ZeroconfとServiceBrowserはプロセス内で使い回し、検索開始から timeout 秒経過後は
+    それまでに見つかったサーバーを待たずに返す
 
     Args:
         timeout: 検索タイムアウト（秒）
+        first_only: Trueの場合、最初のサーバーが見つかった時点でタイムアウトを待たずに返す
+        force: Trueの場合、ServiceBrowserを作り直して検索し直す
 
     Returns:
         見つかったサーバーのリスト
@@ -78,28 +153,27 @@ def discover_print_servers(timeout: float = 3.0) -> list:
             "zeroconf is not installed. Install with: pip install zeroconf"
         )
 
-    zeroconf = Zeroconf()
-    listener = PrintServerListener()
-
-    try:
-        browser = ServiceBrowser(zeroconf, SERVICE_TYPE, listener)
-        time.sleep(timeout)
-        return listener.servers
-    finally:
-        zeroconf.close()
+    listener, started = _get_listener(force)
+    remaining = max(0.0, started + timeout - time.monotonic())
+    if first_only:
+        listener.found.wait(remaining)
+    else:
+        time.sleep(remaining)
+    return listener.servers
 
 
-def discover_print_server(timeout: float = 3.0) -> Optional[dict]:
+def discover_print_server(timeout: float = 3.0, force: bool = False) -> Optional[dict]:
     """
     ローカルネットワーク内の最初に見つかったMCP31プリントサーバーを返す
 
     Args:
         timeout: 検索タイムアウト（秒）
+        force: Trueの場合、ServiceBrowserを作り直して検索し直す
 
     Returns:
         サーバー情報 {"name": str, "ip": str, "port": int, ...} または None
     """
-    servers = discover_print_servers(timeout)
+    servers = discover_print_servers(timeout, first_only=True, force=force)
     return servers[0] if servers else None
 
 
@@ -166,7 +240,7 @@ if __name__ == "__main__":
     print(f"MCP31プリントサーバーを検索中... (タイムアウト: {args.timeout}秒)")
 
     try:
-        servers = discover_print_servers(timeout=args.timeout)
+        servers = discover_print_servers(timeout=args.timeout, first_only=not args.all)
 
         if not servers:
             print("サーバーが見つかりませんでした")
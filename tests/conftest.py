@@ -0,0 +1,77 @@
+# tests/conftest.py
+"""テスト全体で共有するフィクスチャ"""
+
+from io import BytesIO
+import sys
+from pathlib import Path
+
+# リポジトリのルートから各パッケージ (MCP31PRINT, WebService, AdminWebService など) を読み込めるようにする
+# (テストファイルごとではなく、ここで1回だけ追加する)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pytest
+from PIL import Image
+
+
+def _encode(mode, size, color, format, **params):
+    """単色の画像を指定した形式でエンコードしたバイト列を返す"""
+    buffer = BytesIO()
+    Image.new(mode, size, color=color).save(buffer, format=format, **params)
+    return buffer.getvalue()
+
+
+# 画像のエンコード (特にPNGのDEFLATE) は遅いため、テスト用の画像はセッションで1回だけ作って使い回す
+# デコードできれば圧縮率は問わないため、PNGは compress_level=0 (無圧縮)、JPEGは最低画質 (quality=1・4:2:0) で保存する
+
+@pytest.fixture(scope="session")
+def png_small_red():
+    """100x100 赤のPNG画像"""
+    return _encode('RGB', (100, 100), 'red', 'PNG', compress_level=0)
+
+
+@pytest.fixture(scope="session")
+def png_tiny_yellow():
+    """10x10 黄色のPNG画像"""
+    return _encode('RGB', (10, 10), 'yellow', 'PNG', compress_level=0)
+
+
+@pytest.fixture(scope="session")
+def png_rgba():
+    """100x100 半透明の赤のPNG画像 (RGBA)"""
+    return _encode('RGBA', (100, 100), (255, 0, 0, 128), 'PNG', compress_level=0)
+
+
+@pytest.fixture(scope="session")
+def png_large_green():
+    """500x500 緑のPNG画像 (プリンター幅の384ドットより大きい)"""
+    return _encode('RGB', (500, 500), 'green', 'PNG', compress_level=0)
+
+
+@pytest.fixture(scope="session")
+def png_large_white():
+    """400x400 白のPNG画像 (プリンター幅の384ドットより大きい)"""
+    return _encode('RGB', (400, 400), 'white', 'PNG', compress_level=0)
+
+
+@pytest.fixture(scope="session")
+def jpeg_blue():
+    """100x100 青のJPEG画像"""
+    return _encode('RGB', (100, 100), 'blue', 'JPEG', quality=1, optimize=False, subsampling=2)
+
+
+@pytest.fixture(scope="module")
+def solid_images():
+    """
+    画像の結合などメモリ上の画像だけを使うテスト用の単色画像 (モジュールで1回だけ作成する)。
+    読み取り専用として共有するため、変更するテストは .copy() してから使うこと。
+    """
+    return {
+        "red_100x50": Image.new('RGB', (100, 50), color='red'),
+        "blue_100x50": Image.new('RGB', (100, 50), color='blue'),
+        "green_100x50": Image.new('RGB', (100, 50), color='green'),
+        "red_50x30": Image.new('RGB', (50, 30), color='red'),
+        "blue_200x100": Image.new('RGB', (200, 100), color='blue'),
+        "green_500x50": Image.new('RGB', (500, 50), color='green'),  # 幅がdefault_widthより大きい
+        "purple_100x100": Image.new('RGB', (100, 100), color='purple'),
+        "cyan_200x150": Image.new('RGB', (200, 150), color='cyan'),
+    }
@@ -1,16 +1,15 @@
 # tests/test_admin_api.py
 """管理APIのテスト"""
 
-import sys
 import os
 import tempfile
 import shutil
-
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import uuid
+from pathlib import Path
 
 import pytest
 from PIL import Image
-import io
+from io import BytesIO
 
 from AdminWebService.admin_server import app
 from AdminWebService import database as db
@@ -19,31 +18,41 @@ from AdminWebService import database as db
 @pytest.fixture
 def client():
     """テスト用Flaskクライアント"""
-    # テスト用の一時DBを使用
-    db.DATABASE_PATH = tempfile.mktemp(suffix='.db')
+    # テストごとに別の共有インメモリDBを使用 (ディスクに書き込まない)
+    db.DATABASE_PATH = f"file:memdb_{uuid.uuid4().hex}?mode=memory&cache=shared"
     db.init_db()
 
     app.config['TESTING'] = True
     with app.test_client() as client:
         yield client
 
-    # クリーンアップ
-    if os.path.exists(db.DATABASE_PATH):
-        os.remove(db.DATABASE_PATH)
+    # クリーンアップ (接続をすべて閉じるとインメモリDBも破棄される)
+    db.close_pool()
+
+
+@pytest.fixture
+def disk_db(tmp_path):
+    """ディスク上の一時DB (WALなどDBファイルに依存する動作のテスト用)"""
+    db.DATABASE_PATH = str(tmp_path / 'admin.db')
+    db.init_db()
+
+    yield
+
+    db.close_pool()
 
 
 @pytest.fixture
 def upload_folder():
     """テスト用アップロードフォルダ"""
     from AdminWebService import admin_server
-    original_folder = admin_server.UPLOAD_FOLDER
+    original_dir = admin_server.UPLOAD_DIR
     temp_folder = tempfile.mkdtemp()
-    admin_server.UPLOAD_FOLDER = temp_folder
+    admin_server.UPLOAD_DIR = Path(temp_folder)
 
     yield temp_folder
 
     # クリーンアップ
-    admin_server.UPLOAD_FOLDER = original_folder
+    admin_server.UPLOAD_DIR = original_dir
     shutil.rmtree(temp_folder, ignore_errors=True)
 
 
@@ -156,6 +165,13 @@ class TestPrinterAction:
         # Pingは失敗するはず
         assert data['status'] == 'error' or data['ping_ms'] == 'N/A'
 
+    def test_ping_regex_windows_output(self):
+        """Windowsのping出力 (日本語/英語) から応答時間を抽出"""
+        from AdminWebService.admin_server import _PING_RE_WIN
+        assert _PING_RE_WIN.search('192.168.1.1 からの応答: バイト数 =32 時間 =12ms TTL=64').group(1) == '12'
+        assert _PING_RE_WIN.search('192.168.1.1 からの応答: バイト数 =32 時間 <1ms TTL=64').group(1) == '1'
+        assert _PING_RE_WIN.search('Reply from 192.168.1.1: bytes=32 time=7ms TTL=64').group(1) == '7'
+
     def test_ping_all_empty(self, client):
         """プリンタなしでPing All"""
         response = client.post('/admin/action/ping_all')
@@ -197,6 +213,40 @@ class TestDataEndpoints:
         assert data['jobs'] == []
         assert data['pending_count'] == 0
 
+    def test_get_batch(self, client, upload_folder):
+        """ダッシュボード用の一括取得"""
+        db.add_printer("Printer1", "192.168.1.1")
+        db.add_job("job-1", "a.png", "192.168.1.1")
+        Image.new('RGB', (10, 10)).save(os.path.join(upload_folder, 'a.png'))
+
+        response = client.get('/admin/batch')
+        assert response.status_code == 200
+        data = response.get_json()
+        assert [p['ip_address'] for p in data['printers']] == ["192.168.1.1"]
+        assert [j['job_id'] for j in data['jobs']] == ["job-1"]
+        assert data['pending_count'] == 1
+        assert data['files'] == ['a.png']
+
+    def test_json_provider_roundtrip(self, client):
+        """orjsonプロバイダでも日本語を含むレスポンスがそのまま返る"""
+        from AdminWebService import admin_server
+        if admin_server.ORJSON_AVAILABLE:
+            assert isinstance(app.json, admin_server.OrjsonProvider)
+        db.add_printer("受付プリンタ", "192.168.1.1")
+        response = client.get('/admin/config/printers')
+        assert response.mimetype == 'application/json'
+        assert response.get_json()[0]['name'] == "受付プリンタ"
+
+    def test_json_provider_sort_keys(self, client):
+        """orjsonプロバイダでもFlask標準と同じくキーをソートしたレスポンスになる"""
+        with app.test_request_context():
+            response = app.json.response({"b": 1, "a": {"d": 2, "c": 3}})
+        body = response.get_data(as_text=True)
+        assert body.endswith("\n")
+        assert body.index('"a"') < body.index('"b"')
+        assert body.index('"c"') < body.index('"d"')
+        assert response.get_json() == {"a": {"c": 3, "d": 2}, "b": 1}
+
     def test_get_thumbnail_missing_job_id(self, client):
         """job_idなしでサムネイル取得（エラー）"""
         response = client.get('/admin/data/thumbnail')
@@ -211,31 +261,20 @@ class TestDataEndpoints:
 class TestFileUpload:
     """ファイルアップロードのテスト"""
 
-    def test_upload_png(self, client, upload_folder):
+    def test_upload_png(self, client, upload_folder, png_small_red):
         """PNGファイルのアップロード"""
-        # テスト画像を作成
-        img = Image.new('RGB', (100, 100), color='red')
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        buffer.seek(0)
-
         response = client.post('/admin/action/upload_test_image',
-            data={'file': (buffer, 'test.png')},
+            data={'file': (BytesIO(png_small_red), 'test.png')},
             content_type='multipart/form-data')
 
         assert response.status_code == 200
         data = response.get_json()
         assert data['status'] == 'success'
 
-    def test_upload_jpeg(self, client, upload_folder):
+    def test_upload_jpeg(self, client, upload_folder, jpeg_blue):
         """JPEGファイルのアップロード"""
-        img = Image.new('RGB', (100, 100), color='blue')
-        buffer = io.BytesIO()
-        img.save(buffer, format='JPEG')
-        buffer.seek(0)
-
         response = client.post('/admin/action/upload_test_image',
-            data={'file': (buffer, 'test.jpg')},
+            data={'file': (BytesIO(jpeg_blue), 'test.jpg')},
             content_type='multipart/form-data')
 
         assert response.status_code == 200
@@ -243,11 +282,31 @@ class TestFileUpload:
     def test_upload_invalid_extension(self, client, upload_folder):
         """無効な拡張子のファイルアップロード（エラー）"""
         response = client.post('/admin/action/upload_test_image',
-            data={'file': (io.BytesIO(b'test'), 'test.txt')},
+            data={'file': (BytesIO(b'test'), 'test.txt')},
             content_type='multipart/form-data')
 
         assert response.status_code == 400
 
+    def test_upload_corrupt_image(self, client, upload_folder):
+        """拡張子が画像でも中身が壊れていればエラーで、ファイルは残らない"""
+        response = client.post('/admin/action/upload_test_image',
+            data={'file': (BytesIO(b'not a png'), 'broken.png')},
+            content_type='multipart/form-data')
+
+        assert response.status_code == 400
+        assert os.listdir(upload_folder) == []
+
+    def test_upload_too_large(self, client, upload_folder):
+        """サイズ上限を超えるアップロードは413"""
+        from AdminWebService import admin_server
+        payload = b'\0' * (admin_server.MAX_UPLOAD_SIZE + 1)
+        response = client.post('/admin/action/upload_test_image',
+            data={'file': (BytesIO(payload), 'huge.png')},
+            content_type='multipart/form-data')
+
+        assert response.status_code == 413
+        assert response.get_json()['status'] == 'error'
+
     def test_upload_no_file(self, client):
         """ファイルなしでアップロード（エラー）"""
         response = client.post('/admin/action/upload_test_image',
@@ -255,16 +314,11 @@ class TestFileUpload:
 
         assert response.status_code == 400
 
-    def test_get_files_after_upload(self, client, upload_folder):
+    def test_get_files_after_upload(self, client, upload_folder, png_small_red):
         """アップロード後のファイルリスト取得"""
         # ファイルをアップロード
-        img = Image.new('RGB', (50, 50), color='green')
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        buffer.seek(0)
-
         client.post('/admin/action/upload_test_image',
-            data={'file': (buffer, 'uploaded.png')},
+            data={'file': (BytesIO(png_small_red), 'uploaded.png')},
             content_type='multipart/form-data')
 
         # ファイルリスト取得
@@ -272,20 +326,27 @@ class TestFileUpload:
         data = response.get_json()
         assert 'uploaded.png' in data
 
+    def test_file_list_refreshed_when_folder_changes(self, client, upload_folder):
+        """フォルダが変更されるとファイル一覧のキャッシュが更新される"""
+        from AdminWebService import admin_server
+        Image.new('RGB', (10, 10)).save(os.path.join(upload_folder, 'a.png'))
+        first = admin_server.list_test_files()
+        assert admin_server.list_test_files() is first
+
+        Image.new('RGB', (10, 10)).save(os.path.join(upload_folder, 'b.png'))
+        # mtimeの分解能が粗いファイルシステムでも変更を検出させる
+        os.utime(upload_folder, ns=(0, os.stat(upload_folder).st_mtime_ns + 1))
+        assert admin_server.list_test_files() == ['a.png', 'b.png']
+
 
 class TestJobWorkflow:
     """ジョブワークフローのテスト"""
 
-    def test_create_and_cancel_job(self, client, upload_folder):
+    def test_create_and_cancel_job(self, client, upload_folder, png_small_red):
         """ジョブ作成とキャンセル"""
         # ファイルをアップロード
-        img = Image.new('RGB', (100, 100), color='purple')
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        buffer.seek(0)
-
         client.post('/admin/action/upload_test_image',
-            data={'file': (buffer, 'job_test.png')},
+            data={'file': (BytesIO(png_small_red), 'job_test.png')},
             content_type='multipart/form-data')
 
         # プリンタを追加
@@ -311,6 +372,58 @@ class TestJobWorkflow:
             json={"job_id": job_id})
         assert response.status_code == 200
 
+    def test_thumbnail_is_downscaled_and_cacheable(self, client, upload_folder):
+        """サムネイルは縮小画像で、再取得時は304になる"""
+        img = Image.new('RGB', (800, 400), color='green')
+        buffer = BytesIO()
+        img.save(buffer, format='PNG')
+        buffer.seek(0)
+        client.post('/admin/action/upload_test_image',
+            data={'file': (buffer, 'large.png')},
+            content_type='multipart/form-data')
+
+        # サムネイルはテストファイル一覧に出ない
+        assert client.get('/admin/data/test_files').get_json() == ['large.png']
+
+        response = client.post('/admin/action/testprint',
+            json={"ip_address": "192.168.1.100", "file_name": "large.png"})
+        job_id = response.get_json()['job_id']
+
+        response = client.get(f'/admin/data/thumbnail?job_id={job_id}')
+        assert response.status_code == 200
+        assert max(Image.open(BytesIO(response.data)).size) <= 160
+
+        response = client.get(f'/admin/data/thumbnail?job_id={job_id}',
+            headers={'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+
+    def test_testprint_rejects_path_outside_uploads(self, client, upload_folder, tmp_path, png_small_red):
+        """アップロードフォルダ外を指すファイル名は読み込まず、サムネイルも作らない"""
+        outside = tmp_path / 'outside.png'
+        outside.write_bytes(png_small_red)
+
+        for file_name in (os.path.relpath(outside, upload_folder), str(outside)):
+            response = client.post('/admin/action/testprint',
+                json={"ip_address": "192.168.1.100", "file_name": file_name})
+            assert response.status_code == 400
+
+        assert sorted(p.name for p in tmp_path.iterdir()) == ['outside.png']
+        assert not os.path.exists(os.path.join(upload_folder, 'thumbnails'))
+        assert client.get('/admin/data/queue').get_json()['pending_count'] == 0
+
+    def test_retry_failed_job(self, client, upload_folder):
+        """失敗ジョブの再実行でQUEUEDに戻る"""
+        img = Image.new('RGB', (10, 10), color='red')
+        img.save(os.path.join(upload_folder, 'retry.png'))
+        db.add_job("job-retry", "retry.png", "192.168.1.50")
+        db.update_job_status("job-retry", 'FAILED')
+
+        response = client.post('/admin/action/retry_job',
+            json={"job_id": "job-retry"})
+        assert response.status_code == 200
+        assert db.get_job("job-retry")['status'] == 'QUEUED'
+        assert db.claim_next_job()['job_id'] == 'job-retry'
+
 
 class TestEdgeCases:
     """エッジケースのテスト"""
@@ -345,5 +458,178 @@ class TestEdgeCases:
         assert printer is not None
 
 
+
+class TestDatabase:
+    """データベース層のテスト"""
+
+    def test_connection_reused_from_pool(self, client):
+        """接続がプールから再利用される"""
+        with db.db_connection() as conn1:
+            pass
+        with db.db_connection() as conn2:
+            pass
+        assert conn1 is conn2
+
+    def test_nested_connections_are_distinct(self, client):
+        """同時に借りた接続は別物"""
+        with db.db_connection() as conn1:
+            with db.db_connection() as conn2:
+                assert conn1 is not conn2
+
+    def test_shared_connection_reused_inside_block(self, client):
+        """shared_connection()内ではdb_connection()が同じ接続を返す"""
+        with db.shared_connection() as shared:
+            with db.db_connection() as conn1:
+                with db.db_connection() as conn2:
+                    assert conn1 is shared and conn2 is shared
+        with db.db_connection() as conn3:
+            with db.db_connection() as conn4:
+                assert conn3 is not conn4
+
+    def test_timestamps_stored_as_integer_ms(self, client):
+        """日時はミリ秒エポックで保存され、読み出し時に文字列化される"""
+        db.add_job("job-1", "a.png", "192.168.1.1")
+        with db.db_connection() as conn:
+            raw = conn.execute("SELECT timestamp FROM jobs").fetchone()[0]
+        assert isinstance(raw, int)
+        assert db.get_job("job-1")['timestamp'] == db._format_ms(raw, 'milliseconds')
+
+    def test_migrate_text_timestamps(self, disk_db):
+        """旧形式 (TEXT) の日時カラムがINTEGERに移行される"""
+        db.close_pool()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db.DATABASE_PATH + suffix):
+                os.remove(db.DATABASE_PATH + suffix)
+        conn = db.get_db_connection()
+        conn.execute('''CREATE TABLE jobs (job_id TEXT PRIMARY KEY, status TEXT DEFAULT 'QUEUED',
+            file_name TEXT, printer_ip TEXT, timestamp TEXT, thumbnail_path TEXT)''')
+        conn.execute("INSERT INTO jobs VALUES ('old', 'SUCCESS', 'a.png', '192.168.1.1', '2024-01-02 03:04:05.678', NULL)")
+        conn.commit()
+        conn.close()
+
+        db.init_db()
+
+        assert db.get_job('old')['timestamp'] == '2024-01-02 03:04:05.678'
+        with db.db_connection() as conn:
+            types = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(jobs)")}
+            indexes = {row[1] for row in conn.execute("PRAGMA index_list(jobs)")}
+        assert types['timestamp'] == 'INTEGER'
+        assert types['claimed_at'] == 'INTEGER'
+        assert {'idx_jobs_timestamp', 'idx_jobs_status_timestamp'} <= indexes
+
+    def test_wal_mode_enabled(self, disk_db):
+        """init_db()でWALモードが有効になる"""
+        with db.db_connection() as conn:
+            mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        assert mode == 'wal'
+
+    def test_pending_count_uses_covering_index(self, client):
+        """待機中ジョブ数の集計がカバリングインデックスを使う"""
+        with db.db_connection() as conn:
+            plan = conn.execute(
+                "EXPLAIN QUERY PLAN SELECT COUNT(*) FROM jobs WHERE status IN ('QUEUED', 'PROCESSING')"
+            ).fetchall()
+        assert any('COVERING INDEX idx_jobs_status_timestamp' in row[3] for row in plan)
+
+    def test_update_printer_statuses_batch(self, client):
+        """複数プリンタのステータス一括更新"""
+        db.add_printer("Printer A", "192.168.1.10")
+        db.add_printer("Printer B", "192.168.1.11")
+
+        db.update_printer_statuses([
+            ("192.168.1.10", "OK", "3"),
+            ("192.168.1.11", "Failure", "N/A"),
+        ])
+
+        assert db.get_printer("192.168.1.10")['status'] == 'OK'
+        assert db.get_printer("192.168.1.10")['ping_ms'] == '3'
+        assert db.get_printer("192.168.1.11")['status'] == 'Failure'
+
+    def test_claim_next_job_oldest_first(self, client):
+        """QUEUEDジョブを古い順に1件ずつ取得する"""
+        db.add_job("job-1", "a.png", "192.168.1.1")
+        db.add_job("job-2", "b.png", "192.168.1.1")
+
+        job = db.claim_next_job()
+        assert job['job_id'] == 'job-1'
+        assert job['status'] == 'PROCESSING'
+        assert db.get_job('job-1')['status'] == 'PROCESSING'
+
+        assert db.claim_next_job()['job_id'] == 'job-2'
+        assert db.claim_next_job() is None
+
+    def test_claim_next_job_reclaims_expired_lease(self, client):
+        """取得したワーカーが完了を記録しないまま期限が過ぎたジョブは取得し直す"""
+        db.add_job("job-1", "a.png", "192.168.1.1")
+        assert db.claim_next_job()['job_id'] == 'job-1'
+        # 期限内は他のワーカーに取得されない
+        assert db.claim_next_job() is None
+
+        # ワーカーが処理中に終了し、期限が過ぎた
+        with db.db_connection() as conn:
+            conn.execute("UPDATE jobs SET claimed_at = claimed_at - ?", ((db.JOB_LEASE_SECONDS + 1) * 1000,))
+        job = db.claim_next_job()
+        assert job['job_id'] == 'job-1'
+        assert job['status'] == 'PROCESSING'
+        assert db.claim_next_job() is None
+
+    def test_claim_next_job_reclaims_legacy_processing(self, client):
+        """取得日時のない (カラム追加前の) PROCESSINGのジョブも取得し直す"""
+        db.add_job("job-1", "a.png", "192.168.1.1")
+        db.update_job_status("job-1", 'PROCESSING')
+        assert db.claim_next_job()['job_id'] == 'job-1'
+        assert db.claim_next_job() is None
+
+    def test_claim_next_job_skips_deleted(self, client):
+        """キャンセル済みジョブは取得しない"""
+        db.add_job("job-1", "a.png", "192.168.1.1")
+        db.update_job_status("job-1", 'DELETED')
+        assert db.claim_next_job() is None
+
+    def test_printers_cached_between_reads(self, client):
+        """プリンタ一覧はTTL内ならDBを再読込しない"""
+        db.add_printer("Printer1", "192.168.1.1")
+        db.get_all_printers()
+        with db.db_connection() as conn:
+            conn.execute("UPDATE printers SET name = 'Changed'")
+        assert db.get_all_printers()[0]['name'] == "Printer1"
+
+    def test_printers_cache_returns_copy(self, client):
+        """返されたプリンタ一覧を変更してもキャッシュは変わらない"""
+        db.add_printer("Printer1", "192.168.1.1")
+        printers = db.get_all_printers()
+        printers[0]['name'] = "Mutated"
+        printers.clear()
+        assert db.get_all_printers()[0]['name'] == "Printer1"
+
+    def test_cache_get_during_invalidate(self):
+        """TTL内のキャッシュを読む途中で無効化されても None を返さない"""
+        cache = db._TTLCache(60)
+        cache.get(lambda: ["cached"])
+
+        class InvalidatingEntry(tuple):
+            def __getitem__(self, index):
+                cache.invalidate() # 鮮度の確認と結果の取り出しの間に無効化される
+                return tuple.__getitem__(self, index)
+
+        cache._entry = InvalidatingEntry(cache._entry)
+        assert cache.get(lambda: pytest.fail("should use cached entry")) == ["cached"]
+
+    def test_printers_cache_invalidated_on_write(self, client):
+        """書き込み関数の実行でキャッシュが破棄される"""
+        db.add_printer("Printer1", "192.168.1.1")
+        db.get_all_printers()
+        db.update_printer("192.168.1.1", name="Renamed")
+        assert db.get_all_printers()[0]['name'] == "Renamed"
+
+    def test_pending_count_cache_invalidated_on_write(self, client):
+        """ジョブ追加・状態変更で待機中ジョブ数のキャッシュが破棄される"""
+        assert db.get_pending_jobs_count() == 0
+        db.add_job("job-1", "a.png", "192.168.1.1")
+        assert db.get_pending_jobs_count() == 1
+        db.update_job_status("job-1", 'SUCCESS')
+        assert db.get_pending_jobs_count() == 0
+
+
 if __name__ == '__main__':
     pytest.main([__file__, '-v'])
@@ -0,0 +1,46 @@
+# tests/test_batch_queue.py
+import threading
+
+from WebService.common.batch_queue import BatchQueue
+
+
+class TestBatchQueue:
+    """BatchQueueのテスト"""
+
+    def test_drain_returns_all_items_in_order(self):
+        """溜まっているアイテムを追加順にまとめて取り出す"""
+        q = BatchQueue()
+        q.put(1)
+        q.put_many([2, 3])
+        assert q.qsize() == 3
+
+        assert list(q.drain()) == [1, 2, 3]
+        assert q.qsize() == 0
+
+    def test_drain_timeout_when_empty(self):
+        """空のまま timeout を過ぎたら空の deque を返す"""
+        assert len(BatchQueue().drain(timeout=0.01)) == 0
+
+    def test_drain_waits_for_put(self):
+        """空の場合は別スレッドから追加されるまで待つ"""
+        q = BatchQueue()
+        timer = threading.Timer(0.05, q.put, args=("job",))
+        timer.start()
+        try:
+            assert list(q.drain(timeout=5)) == ["job"]
+        finally:
+            timer.join()
+
+    def test_concurrent_producers(self):
+        """複数スレッドからの追加を取りこぼさない"""
+        q = BatchQueue()
+        threads = [threading.Thread(target=lambda n=n: [q.put((n, i)) for i in range(100)]) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        items = list(q.drain())
+        assert sorted(items) == [(n, i) for n in range(8) for i in range(100)]
+        for n in range(8): # 同じスレッドからの追加は順序を保つ
+            assert [i for m, i in items if m == n] == list(range(100))
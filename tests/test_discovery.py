@@ -0,0 +1,145 @@
+# tests/test_discovery.py
+import threading
+import time
+
+import pytest
+
+import discovery
+
+
+class FakeServiceInfo:
+    """zeroconf.ServiceInfo の代わり"""
+
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.properties = {b"path": b"/api/printers"}
+        self.server = "printserver.local."
+
+    def parsed_addresses(self):
+        return [self.ip]
+
+
+class FakeZeroconf:
+    """mDNSを使わずに、登録されたサービスを返すZeroconf"""
+    services = []   # [(遅延秒, 名前, FakeServiceInfo)]
+    instances = 0
+
+    def __init__(self):
+        FakeZeroconf.instances += 1
+        self.closed = False
+
+    def get_service_info(self, type_, name):
+        return next(info for _, n, info in self.services if n == name)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeServiceBrowser:
+    """登録されたサービスを遅延秒後にリスナーへ通知する"""
+
+    def __init__(self, zc, type_, listener):
+        for delay, name, _ in zc.services:
+            threading.Timer(delay, listener.add_service, args=(zc, type_, name)).start()
+
+
+@pytest.fixture
+def fake_zeroconf(monkeypatch):
+    """discovery の Zeroconf/ServiceBrowser を差し替え"""
+    FakeZeroconf.services = []
+    FakeZeroconf.instances = 0
+    monkeypatch.setattr(discovery, "Zeroconf", FakeZeroconf)
+    monkeypatch.setattr(discovery, "ServiceBrowser", FakeServiceBrowser)
+    monkeypatch.setattr(discovery, "ZEROCONF_AVAILABLE", True)
+    for name in ("_zc", "_browser", "_listener"):
+        monkeypatch.setattr(discovery, name, None)
+    return FakeZeroconf.services
+
+
+class TestDiscovery:
+    """discoveryのテスト"""
+
+    def test_first_server_returns_early(self, fake_zeroconf):
+        """最初のサーバーが見つかったらタイムアウトを待たずに返す"""
+        fake_zeroconf.append((0.01, f"server1.{discovery.SERVICE_TYPE}", FakeServiceInfo("192.168.1.10", 5000)))
+
+        start = time.monotonic()
+        server = discovery.discover_print_server(timeout=5)
+        assert time.monotonic() - start < 2
+        assert server["name"] == "server1"
+        assert server["ip"] == "192.168.1.10"
+
+    def test_no_server_waits_timeout(self, fake_zeroconf):
+        """見つからない場合はタイムアウトまで待ってNoneを返す"""
+        assert discovery.discover_print_server(timeout=0.05) is None
+
+    def test_all_servers_waits_timeout(self, fake_zeroconf):
+        """全サーバーの検索はタイムアウトまで待ってすべて返す"""
+        for i, delay in enumerate((0.01, 0.05)):
+            fake_zeroconf.append((delay, f"server{i}.{discovery.SERVICE_TYPE}", FakeServiceInfo(f"192.168.1.{i}", 5000)))
+
+        servers = discovery.discover_print_servers(timeout=0.3)
+        assert [s["name"] for s in servers] == ["server0", "server1"]
+
+    def test_zeroconf_shared(self, fake_zeroconf):
+        """Zeroconfは呼び出しごとに作らず使い回し、force=True で作り直す"""
+        fake_zeroconf.append((0, f"server1.{discovery.SERVICE_TYPE}", FakeServiceInfo("192.168.1.10", 5000)))
+
+        assert discovery.get_print_server_url(timeout=1) == "http://192.168.1.10:5000"
+        assert discovery.get_printers_api_url(timeout=1) == "http://192.168.1.10:5000/api/printers"
+        assert FakeZeroconf.instances == 1
+
+        old_zc = discovery._zc
+        assert discovery.discover_print_server(timeout=1, force=True)["ip"] == "192.168.1.10"
+        assert FakeZeroconf.instances == 2
+        assert old_zc.closed
+
+    def test_returns_immediately_after_timeout_elapsed(self, fake_zeroconf):
+        """検索開始から timeout 秒経過後は待たずに返す"""
+        fake_zeroconf.append((0.01, f"server1.{discovery.SERVICE_TYPE}", FakeServiceInfo("192.168.1.10", 5000)))
+        assert len(discovery.discover_print_servers(timeout=0.1)) == 1
+
+        start = time.monotonic()
+        time.sleep(0.1)
+        assert len(discovery.discover_print_servers(timeout=0.1)) == 1
+        assert time.monotonic() - start < 0.15
+
+    def test_listener_deduplicates_and_removes(self):
+        """同じサーバーの重複した通知は1件にまとめ、削除の通知で取り除く"""
+        zc = FakeZeroconf()
+        zc.services = [(0, f"server1.{discovery.SERVICE_TYPE}", FakeServiceInfo("192.168.1.10", 5000)),
+                       (0, f"server2.{discovery.SERVICE_TYPE}", FakeServiceInfo("192.168.1.20", 5000))]
+        listener = discovery.PrintServerListener()
+
+        for _, name, _ in zc.services + zc.services:
+            listener.add_service(zc, discovery.SERVICE_TYPE, name)
+        assert [s["ip"] for s in listener.servers] == ["192.168.1.10", "192.168.1.20"]
+
+        listener.update_service(zc, discovery.SERVICE_TYPE, zc.services[0][1])
+        assert [s["ip"] for s in listener.servers] == ["192.168.1.10", "192.168.1.20"] # 同じアドレスならその場で置き換える
+
+        zc.services[0][2].ip = "192.168.1.11" # 再起動でアドレスが変わった
+        listener.update_service(zc, discovery.SERVICE_TYPE, zc.services[0][1])
+        assert sorted(s["ip"] for s in listener.servers) == ["192.168.1.11", "192.168.1.20"]
+
+        for _, name, _ in zc.services:
+            listener.remove_service(zc, discovery.SERVICE_TYPE, name)
+        assert listener.servers == []
+        assert not listener.found.is_set()
+
+    def test_listener_update_never_empties(self, monkeypatch):
+        """アドレスが変わった更新の途中でも、サーバーの一覧が空になったり found が解除されたりしない"""
+        zc = FakeZeroconf()
+        info = FakeServiceInfo("192.168.1.10", 5000)
+        name = f"server1.{discovery.SERVICE_TYPE}"
+        zc.services = [(0, name, info)]
+        listener = discovery.PrintServerListener()
+        listener.add_service(zc, discovery.SERVICE_TYPE, name)
+
+        # 更新中にサーバーが1件もない状態になれば found が解除される
+        monkeypatch.setattr(listener.found, "clear", lambda: pytest.fail("found was cleared during update"))
+        info.ip = "192.168.1.11"
+        listener.update_service(zc, discovery.SERVICE_TYPE, name)
+        assert [s["ip"] for s in listener.servers] == ["192.168.1.11"]
+        assert listener.found.is_set()
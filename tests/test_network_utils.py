@@ -1,189 +1,361 @@
 # tests/test_network_utils.py
-import sys
-import os
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-
 import pytest
 from PIL import Image
-import io
+from io import BytesIO
+import functools
+import socket
+import threading
 
-from WebService.common.network_utils import serialize_data, deserialize_data
+import json
 
+from WebService.common import network_utils
+from WebService.common.network_utils import serialize_data, deserialize_data, receive_message, BINARY_MAGIC, END_OF_TRANSMISSION
 
-class TestNetworkUtils:
-    """network_utilsのテスト（シリアライズ/デシリアライズ）"""
+# シリアライズでは画像を中身を見ないバイト列として扱うため、送受信だけのテストではPILで作らずに済ませる
+FAKE_PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+FAKE_JPEG = b"\xff\xd8\xff\xe0" + b"\x00" * 32
 
-    # ===== シリアライズ/デシリアライズ基本テスト =====
 
-    def test_serialize_deserialize_text_only(self):
-        """テキストのみの送受信"""
-        original_body = "テスト本文です"
+# _make_tiny_png() のエンコード先 (色ごとに新しく作らず、空にして使い回す)
+_png_buffer = BytesIO()
 
-        serialized = serialize_data(body_text=original_body)
-        header, body_text, body_images, footer = deserialize_data(serialized)
 
-        assert body_text == original_body
-        assert header is None
-        assert footer is None
-        assert body_images == []
-
-    def test_serialize_deserialize_header_text(self):
-        """テキストヘッダー"""
-        header_data = {"type": "text", "content": "ヘッダーテキスト"}
+@functools.lru_cache(maxsize=None)
+def _make_tiny_png(color='red'):
+    """デコードできる最小 (1x1・無圧縮) のPNG画像。色ごとに1回だけエンコードする"""
+    _png_buffer.seek(0)
+    _png_buffer.truncate(0)
+    Image.new('RGB', (1, 1), color=color).save(_png_buffer, format='PNG', compress_level=0)
+    return _png_buffer.getvalue()
 
-        serialized = serialize_data(header=header_data)
-        header, body_text, body_images, footer = deserialize_data(serialized)
 
-        assert header["type"] == "text"
-        assert header["content"] == "ヘッダーテキスト"
+# 中身を問わないテストで使うPNG画像 (_make_tiny_png() の結果を埋め込んだもの、1x1 赤・72バイト)
+_MIN_PNG = (
+    b"\x89PNG\r\n\x1a\n"
+    b"\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x02\x00\x00\x00\x90wS\xde"
+    b"\x00\x00\x00\x0fIDATx\x01\x01\x04\x00\xfb\xff\x00\xff\x00\x00\x03\x01\x01\x00\x8d\x1d\xe5\x82"
+    b"\x00\x00\x00\x00IEND\xaeB`\x82"
+)
 
-    def test_serialize_deserialize_footer_text(self):
-        """テキストフッター"""
-        footer_data = {"type": "text", "content": "フッターテキスト"}
+# 送受信・デコードのテストで使うシリアライズ済みのデータ (中身は問わないため、モジュールで1回だけシリアライズする)
+_WIRE_IMAGE = bytes(range(256)) * 64
+_WIRE = serialize_data(body_text="本文", body_image_bytes_list=[_WIRE_IMAGE])
 
-        serialized = serialize_data(footer=footer_data)
-        header, body_text, body_images, footer = deserialize_data(serialized)
+# 長いテキスト (テストの入力と期待値で同じ文字列を使う)
+_LONG_TEXT = "あ" * 1024
 
-        assert footer["type"] == "text"
-        assert footer["content"] == "フッターテキスト"
 
-    def test_serialize_deserialize_header_image(self):
-        """画像ヘッダー"""
-        img = Image.new('RGB', (50, 50), color='red')
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        img_bytes = buffer.getvalue()
+class TestNetworkUtils:
+    """network_utilsのテスト（シリアライズ/デシリアライズ）"""
 
-        header_data = {"type": "image", "content": img_bytes}
+    # ===== シリアライズ/デシリアライズ基本テスト =====
 
-        serialized = serialize_data(header=header_data)
+    # (serialize_data の引数, deserialize_data の返り値 (header, body_text, body_images, footer))
+    ROUNDTRIP_CASES = {
+        "text_only": (
+            {"body_text": "テスト本文です"},
+            (None, "テスト本文です", [], None)),
+        "header_text": (
+            {"header": {"type": "text", "content": "ヘッダーテキスト"}},
+            ({"type": "text", "content": "ヘッダーテキスト"}, "", [], None)),
+        "footer_text": (
+            {"footer": {"type": "text", "content": "フッターテキスト"}},
+            (None, "", [], {"type": "text", "content": "フッターテキスト"})),
+        "header_image": (
+            {"header": {"type": "image", "content": FAKE_PNG + b"header"}},
+            ({"type": "image", "content": FAKE_PNG + b"header"}, "", [], None)),
+        "body_images": (
+            {"body_image_bytes_list": [FAKE_PNG + b"body1", FAKE_JPEG + b"body2"]},
+            (None, "", [FAKE_PNG + b"body1", FAKE_JPEG + b"body2"], None)),
+        "full": (
+            {"header": {"type": "text", "content": "=== ヘッダー ==="},
+             "body_text": "本文テキスト\n改行も含む",
+             "body_image_bytes_list": [_MIN_PNG],
+             "footer": {"type": "image", "content": _MIN_PNG}},
+            ({"type": "text", "content": "=== ヘッダー ==="}, "本文テキスト\n改行も含む", [_MIN_PNG],
+             {"type": "image", "content": _MIN_PNG})),
+        # ===== エッジケース =====
+        "empty": (
+            {},
+            (None, "", [], None)),
+        "empty_string": (
+            {"body_text": ""},
+            (None, "", [], None)),
+        "long_text": (
+            {"body_text": _LONG_TEXT},
+            (None, _LONG_TEXT, [], None)),
+        "special_chars": (
+            {"body_text": "Hello\tWorld\n\r特殊文字：！＠＃＄％"},
+            (None, "Hello\tWorld\n\r特殊文字：！＠＃＄％", [], None)),
+        "unicode": (
+            {"body_text": "絵文字テスト 🎉🚀✨ 中文 한국어"},
+            (None, "絵文字テスト 🎉🚀✨ 中文 한국어", [], None)),
+        # 画像は中身を見ないバイト列として扱われるため、画像ごとに異なるバイト列であればよい
+        "many_images": (
+            {"body_image_bytes_list": [FAKE_PNG + bytes([i]) * 64 for i in range(10)]},
+            (None, "", [FAKE_PNG + bytes([i]) * 64 for i in range(10)], None)),
+    }
+
+    @pytest.mark.parametrize("kwargs, expected", ROUNDTRIP_CASES.values(), ids=ROUNDTRIP_CASES.keys())
+    def test_serialize_deserialize(self, kwargs, expected):
+        """serialize_data で送ったデータが deserialize_data でそのまま復元される"""
+        assert deserialize_data(serialize_data(**kwargs)) == expected
+
+    def test_serialize_deserialize_large_image(self, png_large_white):
+        """大きい画像 (復元した画像はシリアライズ済みのデータをコピーせずに参照する)"""
+        serialized = serialize_data(body_image_bytes_list=[png_large_white])
         header, body_text, body_images, footer = deserialize_data(serialized)
 
-        assert header["type"] == "image"
-        assert header["content"] == img_bytes
-
-    def test_serialize_deserialize_body_images(self):
-        """本文画像（複数）"""
-        img1 = Image.new('RGB', (30, 30), color='blue')
-        img2 = Image.new('RGB', (40, 40), color='green')
-
-        buffer1 = io.BytesIO()
-        img1.save(buffer1, format='PNG')
-        bytes1 = buffer1.getvalue()
-
-        buffer2 = io.BytesIO()
-        img2.save(buffer2, format='JPEG')
-        bytes2 = buffer2.getvalue()
+        assert len(body_images) == 1
+        assert body_images[0].obj is serialized
+        assert body_images[0] == png_large_white
 
-        serialized = serialize_data(body_image_bytes_list=[bytes1, bytes2])
-        header, body_text, body_images, footer = deserialize_data(serialized)
+    # ===== バイナリ形式 / JSON形式 =====
 
-        assert len(body_images) == 2
-        assert body_images[0] == bytes1
-        assert body_images[1] == bytes2
+    def test_binary_is_default(self):
+        """デフォルトは画像をBase64にしないバイナリ形式"""
+        img_bytes = _MIN_PNG
 
-    def test_serialize_deserialize_full(self):
-        """全データの送受信"""
-        header_data = {"type": "text", "content": "=== ヘッダー ==="}
-        body = "本文テキスト\n改行も含む"
+        serialized = serialize_data(body_image_bytes_list=[img_bytes])
 
-        img = Image.new('RGB', (100, 100), color='purple')
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        img_bytes = buffer.getvalue()
+        assert serialized.startswith(BINARY_MAGIC)
+        assert img_bytes in serialized
+        assert len(serialized) < len(serialize_data(body_image_bytes_list=[img_bytes], binary=False))
 
-        footer_data = {"type": "image", "content": img_bytes}
+    def test_legacy_json_roundtrip(self):
+        """binary=False では従来のJSON形式で送受信できる"""
+        header_bytes = _make_tiny_png('blue')
+        body_bytes = _make_tiny_png('green')
 
         serialized = serialize_data(
-            header=header_data,
-            body_text=body,
-            body_image_bytes_list=[img_bytes],
-            footer=footer_data
+            header={"type": "image", "content": header_bytes},
+            body_text="本文",
+            body_image_bytes_list=[body_bytes],
+            footer={"type": "text", "content": "フッター"},
+            binary=False
         )
-
         header, body_text, body_images, footer = deserialize_data(serialized)
 
-        assert header["type"] == "text"
-        assert header["content"] == "=== ヘッダー ==="
-        assert body_text == body
-        assert len(body_images) == 1
-        assert body_images[0] == img_bytes
-        assert footer["type"] == "image"
-        assert footer["content"] == img_bytes
-
-    # ===== エッジケース =====
+        assert json.loads(serialized)["body_text"] == "本文"
+        assert header == {"type": "image", "content": header_bytes}
+        assert body_text == "本文"
+        assert body_images == [body_bytes]
+        assert footer == {"type": "text", "content": "フッター"}
 
-    def test_serialize_deserialize_empty(self):
-        """全て空/None"""
-        serialized = serialize_data()
-        header, body_text, body_images, footer = deserialize_data(serialized)
-
-        assert header is None
-        assert body_text == ""
-        assert body_images == []
-        assert footer is None
+    def test_binary_image_order(self):
+        """ヘッダー・本文・フッターの画像がそれぞれの位置に復元される"""
+        header_bytes = _make_tiny_png('red')
+        body_bytes = [_make_tiny_png('green'), _make_tiny_png('blue')]
+        footer_bytes = _make_tiny_png('black')
 
-    def test_serialize_deserialize_empty_string(self):
-        """空文字列"""
-        serialized = serialize_data(body_text="")
+        serialized = serialize_data(
+            header={"type": "image", "content": header_bytes},
+            body_image_bytes_list=body_bytes,
+            footer={"type": "image", "content": footer_bytes}
+        )
         header, body_text, body_images, footer = deserialize_data(serialized)
-        assert body_text == ""
 
-    def test_serialize_deserialize_long_text(self):
-        """長いテキスト"""
-        long_text = "あ" * 10000
-
-        serialized = serialize_data(body_text=long_text)
+        assert header["content"] == header_bytes
+        assert body_images == body_bytes
+        assert footer["content"] == footer_bytes
+
+    @pytest.mark.parametrize('binary', [True, False])
+    @pytest.mark.parametrize('encode_orjson, decode_orjson', [(True, True), (True, False), (False, True), (False, False)])
+    def test_json_backend_roundtrip(self, monkeypatch, binary, encode_orjson, decode_orjson):
+        """orjsonの有無が送信側と受信側で異なっても同じ内容を送受信できる"""
+        if (encode_orjson or decode_orjson) and not network_utils.ORJSON_AVAILABLE:
+            pytest.skip("orjson not installed")
+        text = "日本語テキスト 🎉\n改行"
+        img_bytes = _MIN_PNG
+
+        monkeypatch.setattr(network_utils, 'ORJSON_AVAILABLE', encode_orjson)
+        serialized = serialize_data(body_text=text, body_image_bytes_list=[img_bytes], binary=binary)
+        monkeypatch.setattr(network_utils, 'ORJSON_AVAILABLE', decode_orjson)
         header, body_text, body_images, footer = deserialize_data(serialized)
 
-        assert body_text == long_text
-
-    def test_serialize_deserialize_special_chars(self):
-        """特殊文字・制御文字"""
-        special = "Hello\tWorld\n\r特殊文字：！＠＃＄％"
+        assert body_text == text
+        assert body_images == [img_bytes]
 
-        serialized = serialize_data(body_text=special)
-        header, body_text, body_images, footer = deserialize_data(serialized)
+    @pytest.mark.parametrize('binary', [True, False])
+    def test_serialize_buffer_images(self, binary):
+        """BytesIO.getbuffer() のmemoryviewやbytearrayもbytesに変換せずに画像として送れる"""
+        view = BytesIO(_MIN_PNG).getbuffer()
+        footer_bytes = bytearray(_make_tiny_png('blue'))
 
-        assert body_text == special
+        serialized = serialize_data(
+            header={"type": "image", "content": view},
+            body_image_bytes_list=[view],
+            footer={"type": "image", "content": footer_bytes},
+            binary=binary
+        )
+        header, _, body_images, footer = deserialize_data(serialized)
 
-    def test_serialize_deserialize_unicode(self):
-        """Unicode文字（絵文字など）"""
-        unicode_text = "絵文字テスト 🎉🚀✨ 中文 한국어"
+        assert header["content"] == _MIN_PNG
+        assert body_images == [_MIN_PNG]
+        assert footer["content"] == footer_bytes
 
-        serialized = serialize_data(body_text=unicode_text)
-        header, body_text, body_images, footer = deserialize_data(serialized)
+    @pytest.mark.parametrize('binary', [True, False])
+    def test_image_path_requires_allow_paths(self, tmp_path, binary):
+        """画像ファイルパスは allow_paths=True の場合だけ読み込む"""
+        img_bytes = _MIN_PNG
+        path = tmp_path / 'header.png'
+        path.write_bytes(img_bytes)
+        header_data = {"type": "image", "content": str(path)}
 
-        assert body_text == unicode_text
+        header, _, _, _ = deserialize_data(serialize_data(header=header_data, binary=binary))
+        assert header is None
 
-    def test_serialize_deserialize_large_image(self):
-        """大きい画像"""
-        img = Image.new('RGB', (2000, 2000), color='white')
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        large_bytes = buffer.getvalue()
+        header, _, _, _ = deserialize_data(serialize_data(header=header_data, binary=binary, allow_paths=True))
+        assert header == {"type": "image", "content": img_bytes}
 
-        serialized = serialize_data(body_image_bytes_list=[large_bytes])
-        header, body_text, body_images, footer = deserialize_data(serialized)
+    def test_missing_image_path_skipped(self, tmp_path):
+        """読み込めない画像ファイルパスはスキップする"""
+        header_data = {"type": "image", "content": str(tmp_path / 'missing.png')}
 
-        assert len(body_images) == 1
-        assert body_images[0] == large_bytes
-
-    def test_serialize_deserialize_many_images(self):
-        """多数の画像"""
-        images = []
-        for i in range(10):
-            img = Image.new('RGB', (50, 50), color=(i * 25, 0, 0))
-            buffer = io.BytesIO()
-            img.save(buffer, format='PNG')
-            images.append(buffer.getvalue())
-
-        serialized = serialize_data(body_image_bytes_list=images)
-        header, body_text, body_images, footer = deserialize_data(serialized)
+        header, _, _, _ = deserialize_data(serialize_data(header=header_data, allow_paths=True))
+        assert header is None
 
-        assert len(body_images) == 10
-        for i, img_bytes in enumerate(body_images):
-            assert img_bytes == images[i]
+    def test_binary_images_share_buffer(self):
+        """バイナリ形式の画像は受信バッファをコピーせずに参照する"""
+        img_bytes = _MIN_PNG
+        buf = bytearray(serialize_data(header={"type": "image", "content": img_bytes}, body_image_bytes_list=[img_bytes]))
+
+        header, _, body_images, _ = deserialize_data(buf)
+        assert isinstance(body_images[0], memoryview)
+        assert body_images[0].obj is buf
+        assert header["content"].obj is buf
+        assert Image.open(BytesIO(body_images[0])).size == Image.open(BytesIO(img_bytes)).size
+
+    @pytest.mark.parametrize("binary", [True, False])
+    def test_deserialize_memoryview_slice(self, binary):
+        """バッファの途中を指すmemoryviewもコピーせずにデシリアライズできる"""
+        img_bytes = _MIN_PNG
+        serialized = serialize_data(body_text="本文", body_image_bytes_list=[img_bytes], binary=binary)
+        buf = bytearray(b"prefix" + serialized + b"suffix")
+
+        _, body_text, body_images, _ = deserialize_data(memoryview(buf)[6:6 + len(serialized)])
+        assert body_text == "本文"
+        assert body_images == [img_bytes]
+
+    def test_binary_truncated(self):
+        """途中で切れたバイナリデータはエラーにする"""
+        with pytest.raises(ValueError):
+            deserialize_data(_WIRE[:-10])
+
+
+
+class TestReceiveMessage:
+    """receive_message() のテスト (socketpairで送受信)"""
+
+    @staticmethod
+    def _send_in_chunks(sock, data, chunk_size):
+        def send():
+            for i in range(0, len(data), chunk_size):
+                sock.sendall(data[i:i + chunk_size])
+            sock.close()
+        thread = threading.Thread(target=send)
+        thread.start()
+        return thread
+
+    @pytest.mark.parametrize("chunk_size", [1, 7, 1 << 16])
+    def test_receives_until_marker(self, chunk_size):
+        """マーカーが受信の区切りをまたいでもマーカーの手前までを返す (バッファの拡張を含む)"""
+        payload = _WIRE
+        server, client = socket.socketpair()
+        with server:
+            thread = self._send_in_chunks(client, payload + END_OF_TRANSMISSION + b"trailing", chunk_size)
+            received = receive_message(server, initial_size=16)
+            thread.join()
+
+        assert received == payload
+        assert deserialize_data(received) == (None, "本文", [_WIRE_IMAGE], None)
+
+    @pytest.mark.parametrize("chunk_size", [1, 7, 1 << 16])
+    def test_receives_framed_message(self, chunk_size):
+        """send_message() のフレームヘッダー付きのデータをデータ長ちょうど受信する"""
+        payload = _WIRE
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            thread = threading.Thread(target=network_utils.send_message, args=(sender, payload))
+            thread.start()
+            wire = receiver.recv(len(payload) + network_utils._FRAME_HEADER.size, socket.MSG_WAITALL)
+            thread.join()
+        assert wire.startswith(network_utils.FRAME_TAG)
+
+        # 続けて送られたデータは読まない
+        server, client = socket.socketpair()
+        with server:
+            thread = self._send_in_chunks(client, wire + b"next message", chunk_size)
+            received = receive_message(server)
+            thread.join()
+
+        assert received == payload
+
+    def test_truncated_frame(self):
+        """データ長に満たないうちに閉じられたフレームはエラーにする"""
+        server, client = socket.socketpair()
+        with server:
+            thread = self._send_in_chunks(client, network_utils._FRAME_HEADER.pack(network_utils.FRAME_TAG, 100) + b"short", 64)
+            with pytest.raises(ConnectionError):
+                receive_message(server)
+            thread.join()
+
+    def test_frame_too_large(self, monkeypatch):
+        """上限を超えるデータは、上限を超えるバッファを確保する前にエラーにする"""
+        allocated = []
+        real_bytearray = bytearray
+        monkeypatch.setattr(network_utils, "bytearray",
+                            lambda *args: allocated.append(args) or real_bytearray(*args), raising=False)
+        server, client = socket.socketpair()
+        with server:
+            header = network_utils._FRAME_HEADER.pack(network_utils.FRAME_TAG, network_utils.MAX_FRAME_SIZE + 1)
+            thread = self._send_in_chunks(client, header, 64)
+            with pytest.raises(ValueError):
+                receive_message(server)
+            thread.join()
+        assert all(args[0] <= network_utils.RECV_BUFFER_SIZE for args in allocated) # ヘッダー受信用のバッファだけ
+
+        # 終端マーカーの形式でも、上限を超えて受信バッファを広げずにエラーにする
+        monkeypatch.setattr(network_utils, "MAX_FRAME_SIZE", 1024)
+        for size, error in ((1024, None), (1025, ValueError)):
+            server, client = socket.socketpair()
+            with server:
+                thread = self._send_in_chunks(client, b"x" * size + END_OF_TRANSMISSION, 64)
+                if error:
+                    with pytest.raises(error):
+                        receive_message(server, initial_size=16)
+                else:
+                    assert receive_message(server, initial_size=16) == b"x" * size
+                thread.join()
+
+    def test_receives_until_close_without_marker(self):
+        """マーカーがなくても接続が閉じられたらそこまでを返す"""
+        server, client = socket.socketpair()
+        with server:
+            thread = self._send_in_chunks(client, b"no marker", 4)
+            received = receive_message(server, initial_size=4)
+            thread.join()
+
+        assert received == b"no marker"
+
+    def test_tuned_tcp_connection(self):
+        """SO_RCVLOWAT を設定した接続でも、低水位未満のデータを接続のクローズで受け取れる"""
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+            network_utils.configure_listen_socket(listener)
+            listener.bind(("127.0.0.1", 0))
+            listener.listen(socket.SOMAXCONN)
+            if hasattr(socket, "TCP_DEFER_ACCEPT"):
+                assert listener.getsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT) > 0
+            with socket.create_connection(listener.getsockname()) as client:
+                # TCP_DEFER_ACCEPT ではデータが届くまで accept() に渡されないため、先に送る
+                network_utils.send_message(client, b"small payload")
+                client.shutdown(socket.SHUT_WR)
+                conn, _ = listener.accept()
+                with conn:
+                    network_utils.configure_accepted_socket(conn)
+                    if hasattr(socket, "SO_RCVLOWAT"):
+                        assert conn.getsockopt(socket.SOL_SOCKET, socket.SO_RCVLOWAT) == network_utils.RECV_LOWAT
+                    assert receive_message(conn) == b"small payload"
 
 
 if __name__ == '__main__':
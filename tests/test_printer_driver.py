@@ -0,0 +1,341 @@
+# tests/test_printer_driver.py
+"""プリンタドライバの画像変換処理のテスト (プリンタへの接続は行わない)"""
+
+from io import BytesIO
+import socket
+
+import pytest
+import numpy as np
+from PIL import Image
+
+from MCP31PRINT import printer_driver, _imaging
+
+
+def reference_luma(rgb: np.ndarray) -> np.ndarray:
+    """従来の画素ごとの計算 (BT.709 Luma + ガンマ補正)"""
+    return np.array([
+        round((((0.2126 * r + 0.7152 * g + 0.0722 * b) / 255) ** (1 / 2.2)) ** 1.5 * 255)
+        for r, g, b in rgb.reshape(-1, 3).tolist()
+    ], dtype=np.uint8).reshape(rgb.shape[:2])
+
+
+def reference_lut_luma(rgb: np.ndarray) -> np.ndarray:
+    """輝度を整数に丸めてからテーブルで補正する計算"""
+    return np.array([
+        _imaging.GAMMA_LUT[round(0.2126 * r + 0.7152 * g + 0.0722 * b)]
+        for r, g, b in rgb.reshape(-1, 3).tolist()
+    ], dtype=np.uint8).reshape(rgb.shape[:2])
+
+
+class TestImageConversion:
+    """画像変換のテスト"""
+
+    def test_gamma_lut_matches_formula(self):
+        """ガンマ補正テーブルは2通りの式 (指数の連鎖/合成) のどちらとも一致する"""
+        for i in range(256):
+            assert _imaging.GAMMA_LUT[i] == round((((i / 255) ** (1 / 2.2)) ** 1.5) * 255)
+            assert _imaging.GAMMA_LUT[i] == round((i / 255) ** _imaging.GAMMA_EXPONENT * 255)
+
+    @pytest.mark.parametrize('use_numba', [True, False])
+    def test_gamma_luma_matches_reference(self, monkeypatch, use_numba):
+        """画像全体をまとめて行うグレースケール変換 (Numba/Pillow) がテーブル補正の計算と一致する"""
+        if use_numba and not _imaging.NUMBA_AVAILABLE:
+            pytest.skip("numba not installed")
+        monkeypatch.setattr(_imaging, 'NUMBA_AVAILABLE', use_numba)
+        rgb = np.random.default_rng(0).integers(0, 256, (64, 96, 3), dtype=np.uint8)
+        gray = _imaging._bt709_gamma_luma(Image.fromarray(rgb, 'RGB'))
+        assert gray.mode == 'L'
+        result = np.asarray(gray)
+        if use_numba:
+            np.testing.assert_array_equal(result, reference_lut_luma(rgb))
+        else:
+            # Pillowの変換行列は輝度を単精度で丸めるため、丸めの境界で1階調ずれることがある
+            assert np.abs(result.astype(int) - reference_lut_luma(rgb)).max() <= 1
+        # 輝度の丸めによる従来の計算との差はディザリング前の2階調以内
+        assert np.abs(result.astype(int) - reference_luma(rgb)).max() <= 2
+
+    def test_gamma_luma_rgba_without_numba(self, monkeypatch):
+        """Numbaがない場合もRGBA画像をグレースケールに変換できる"""
+        monkeypatch.setattr(_imaging, 'NUMBA_AVAILABLE', False)
+        gray = _imaging._bt709_gamma_luma(Image.new('RGBA', (4, 4), (255, 255, 255, 255)))
+        assert gray.mode == 'L'
+        assert gray.getpixel((0, 0)) == 255
+
+    def test_build_raster_header(self):
+        """ラスターコマンドのヘッダに幅(バイト)と高さ(ドット)が入る"""
+        raster = printer_driver.build_raster(Image.new('RGB', (100, 30), 'white'), 576)
+        assert raster[:4] == b'\x1B\x1D\x53\x01'
+        assert raster[4:9] == b'\x0D\x00\x1E\x00\x00'  # 100dots -> 13bytes, 30dots
+        assert len(raster) == 9 + 13 * 30
+
+    def test_build_raster_large_jpeg(self):
+        """大きいJPEGは縮小デコードしても紙幅に合わせたラスターになる"""
+        buffer = BytesIO()
+        Image.new('RGB', (2400, 1200), 'white').save(buffer, format='JPEG', quality=1, optimize=False, subsampling=2) # 画質は問わない
+        raster = printer_driver.build_raster(BytesIO(buffer.getvalue()), 576)
+        assert raster[4:9] == b'\x48\x00\x20\x01\x00'  # 576dots -> 72bytes, 288dots
+        assert len(raster) == 9 + 72 * 288
+
+    def test_build_raster_padding_is_blank(self):
+        """白画像はパディング部分も含めて印字ドットなし"""
+        raster = printer_driver.build_raster(Image.new('RGB', (100, 30), 'white'), 576)
+        assert raster[9:] == bytes(13 * 30)
+
+    def test_pack_raster_black_dots(self):
+        """黒画素が1ビット (印字) になり、パディングは0になる"""
+        data, width, height = _imaging._pack_raster(Image.new('1', (4, 2), 0), 576)
+        assert (width, height) == (8, 2)
+        assert bytes(data) == b'\xF0\xF0'
+
+    @pytest.mark.parametrize('alignment, expected', [
+        (0, b'\xFF'),
+        (1, b'\x00\x00\xFF\x00\x00'),
+        (2, b'\x00\x00\x00\x00\xFF'),
+    ])
+    def test_pack_raster_alignment(self, alignment, expected):
+        """中央/右寄せの余白は印字しないビットになる"""
+        data, width, height = _imaging._pack_raster(Image.new('1', (8, 1), 0), 40, alignment)
+        assert bytes(data) == expected
+        assert width == len(expected) * 8
+
+    @pytest.mark.parametrize('alignment, offset', [(0, 0), (1, 280), (2, 560)])
+    def test_raster_layout_byte_aligned(self, alignment, offset):
+        """余白はバイト単位になるよう開始位置を8の倍数に切り捨てる"""
+        assert _imaging._raster_layout(10, 576, alignment) == (offset, 576 if alignment else 16)
+
+    def test_build_raster_debug_dump(self, tmp_path, monkeypatch):
+        """debug=True の場合のみ処理途中の画像を保存し、呼び出しごとにファイル名が異なる"""
+        monkeypatch.chdir(tmp_path)
+        img = Image.new('RGB', (16, 4), 'white')
+        printer_driver.build_raster(img, 576)
+        assert list(tmp_path.iterdir()) == []
+
+        printer_driver.build_raster(img, 576, debug=True)
+        first = {path.name for path in tmp_path.iterdir()}
+        printer_driver.build_raster(img, 576, debug=True)
+        assert len(list(tmp_path.iterdir())) == 2 * len(first)
+        assert len(list(tmp_path.glob('debug_*_01_initial.png'))) == 2
+
+
+def reference_dither_pack(rgb, total_width, offset):
+    """Floyd–Steinberg ディザリングとビットパックの素朴な実装 (カーネルの検証用)"""
+    gray = reference_lut_luma(rgb).astype(np.float32)
+    height, width = gray.shape
+    ink = np.zeros((height, total_width), dtype=bool)
+    for y in range(height):
+        for x in range(width):
+            value = gray[y, x]
+            ink[y, x + offset] = value < 128
+            e = value - (0 if value < 128 else 255)
+            for dy, dx, w in ((0, 1, 7), (1, -1, 3), (1, 0, 5), (1, 1, 1)):
+                if 0 <= y + dy < height and 0 <= x + dx < width:
+                    gray[y + dy, x + dx] += e * np.float32(w / 16)
+    return np.packbits(ink, axis=1).tobytes()
+
+
+@pytest.mark.skipif(not _imaging.NUMBA_AVAILABLE, reason="numba not installed")
+class TestFusedDither:
+    """Numbaのディザリング+ビットパック融合カーネルのテスト"""
+
+    @pytest.mark.parametrize('alignment', [0, 1, 2])
+    def test_matches_reference(self, alignment):
+        """カーネルの出力が素朴な実装と一致する"""
+        rgb = np.random.default_rng(0).integers(0, 256, (12, 21, 3), dtype=np.uint8)
+        data, width, height = _imaging._dither_pack_raster(Image.fromarray(rgb, 'RGB'), 64, alignment)
+        offset, total_width = _imaging._raster_layout(21, 64, alignment)
+        assert (width, height) == (total_width, 12)
+        assert bytes(data) == reference_dither_pack(rgb, total_width, offset)
+
+    def test_dot_density_close_to_pillow(self, monkeypatch):
+        """印字ドットの割合がPillowのディザリングとほぼ同じ"""
+        gradient = np.tile(np.linspace(0, 255, 200, dtype=np.uint8)[:, None], (1, 3))
+        img = Image.fromarray(np.broadcast_to(gradient, (50, 200, 3)).copy(), 'RGB')
+        fused = printer_driver.build_raster(img, 576)
+        monkeypatch.setattr(_imaging, 'NUMBA_AVAILABLE', False)
+        pillow = printer_driver.build_raster(img, 576)
+        assert fused[:9] == pillow[:9]
+        fused_dots = np.unpackbits(np.frombuffer(fused[9:], dtype=np.uint8)).mean()
+        pillow_dots = np.unpackbits(np.frombuffer(pillow[9:], dtype=np.uint8)).mean()
+        assert abs(fused_dots - pillow_dots) < 0.01
+
+    def test_rgba_transparent_is_blank(self):
+        """透過部分は白背景と合成され印字されない"""
+        raster = printer_driver.build_raster(Image.new('RGBA', (16, 4), (0, 0, 0, 0)), 576)
+        assert raster[9:] == bytes(2 * 4)
+
+
+class FakeNetwork:
+    """escpos.printer.Network の代わりに送信内容を記録する"""
+
+    instances = []
+
+    def __init__(self, host, port):
+        self.timeout = 60
+        self.device = None
+        self.sent = []
+        self.closed = False
+        FakeNetwork.instances.append(self)
+
+    def _raw(self, data):
+        self.sent.append(bytes(data))
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_network(monkeypatch):
+    """プリンタへの接続をFakeNetworkに差し替え"""
+    FakeNetwork.instances = []
+    monkeypatch.setattr(printer_driver, 'Network', FakeNetwork)
+    monkeypatch.setattr(printer_driver.PrinterDriver, '_open_socket', lambda self, send_timeout: None)
+    monkeypatch.setattr(printer_driver.time, 'sleep', lambda seconds: None)
+    return FakeNetwork.instances
+
+
+class TestSession:
+    """接続の使い回しのテスト"""
+
+    def test_methods_connect_individually(self, fake_network):
+        """session() の外では各メソッドが接続・切断する"""
+        driver = printer_driver.PrinterDriver("192.168.1.1")
+        driver.print_empty_lines(1)
+        driver.cut_paper()
+        assert len(fake_network) == 2
+        assert all(conn.closed for conn in fake_network)
+        assert driver.printer is None
+
+    def test_session_reuses_connection(self, fake_network):
+        """session() 中は1つの接続で送信し、初期化も1回だけ"""
+        driver = printer_driver.PrinterDriver("192.168.1.1")
+        with driver.session():
+            driver.print_raster(b'\x1B\x1D\x53\x01\x01\x00\x01\x00\x00\x00')
+            driver.print_empty_lines(1)
+            driver.cut_paper()
+            assert not fake_network[0].closed
+        assert len(fake_network) == 1
+        assert fake_network[0].closed
+        assert driver.printer is None
+
+    def test_session_sends_once(self, fake_network):
+        """session() 中のコマンドはバッファに溜めて1回で送信する"""
+        driver = printer_driver.PrinterDriver("192.168.1.1")
+        with driver.session():
+            driver.print_empty_lines(2)
+            driver.cut_paper()
+            assert fake_network[0].sent == []
+        assert fake_network[0].sent == [b'\x1B\x40' + b'\x1B\x61\x02' + b'\x1B\x64\x02']
+
+    def test_print_does_not_sleep(self, fake_network, monkeypatch):
+        """印刷・紙送り・カットで時間待ちをしない"""
+        sleeps = []
+        monkeypatch.setattr(printer_driver.time, 'sleep', sleeps.append)
+        driver = printer_driver.PrinterDriver("192.168.1.1")
+        driver.print_text_raw("test")
+        with driver.session():
+            driver.print_raster(b'\x1B\x1D\x53\x01\x01\x00\x01\x00\x00\x00')
+            driver.print_empty_lines(20)
+            driver.cut_paper()
+        assert sleeps == []
+
+    @pytest.mark.parametrize('num_lines, expected', [
+        (0, b''),
+        (3, b'\x1B\x61\x03'),
+        (300, b'\x1B\x61\x7F\x1B\x61\x7F\x1B\x61\x2E'),
+    ])
+    def test_empty_lines_single_feed_command(self, fake_network, num_lines, expected):
+        """空白行は ESC a n の紙送りコマンド (127行ごとに分割) で送る"""
+        driver = printer_driver.PrinterDriver("192.168.1.1")
+        with driver.session():
+            driver.print_empty_lines(num_lines)
+        assert fake_network[0].sent == [b'\x1B\x40' + expected]
+
+    @pytest.mark.parametrize('use_numba', [True, False])
+    def test_print_image_from_bytes_matches_build_raster(self, fake_network, monkeypatch, use_numba):
+        """バイト列からの印刷も build_raster() と同じラスターデータを送る"""
+        if use_numba and not _imaging.NUMBA_AVAILABLE:
+            pytest.skip("numba not installed")
+        monkeypatch.setattr(_imaging, 'NUMBA_AVAILABLE', use_numba)
+        rgb = np.random.default_rng(1).integers(0, 256, (20, 30, 3), dtype=np.uint8)
+        buffer = BytesIO()
+        Image.fromarray(rgb, 'RGB').save(buffer, format='PNG')
+
+        driver = printer_driver.PrinterDriver("192.168.1.1")
+        driver.print_image_from_bytes(buffer.getvalue(), alignment=1)
+
+        expected = printer_driver.build_raster(Image.fromarray(rgb, 'RGB'), driver.paper_width_dots, 1)
+        assert fake_network[0].sent[1] == expected
+
+    def test_print_images_streams_each_image(self, fake_network):
+        """複数の画像は結合せずに1枚ずつラスターに変換し、間に白の余白を挟む"""
+        rng = np.random.default_rng(2)
+        images = [Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8), 'RGB') for h, w in ((10, 30), (5, 700))]
+
+        driver = printer_driver.PrinterDriver("192.168.1.1")
+        driver.print_images(iter(images), padding=2)
+
+        width_bytes = driver.paper_width_dots // 8
+        blank = printer_driver.RASTER_HEADER.pack(printer_driver.RASTER_COMMAND_PREFIX, width_bytes, 2, 0) + bytes(width_bytes * 2)
+        expected = [printer_driver.build_raster(images[0], driver.paper_width_dots), blank,
+                    printer_driver.build_raster(images[1], driver.paper_width_dots)]
+        assert fake_network[0].sent[1:] == expected
+
+    def test_print_text_single_write(self, fake_network):
+        """テキストは改行と合わせて1回で送信し、表現できない文字は置き換える"""
+        driver = printer_driver.PrinterDriver("192.168.1.1")
+        driver.print_text_raw("テスト🎉")
+        assert fake_network[0].sent == [b'\x1B\x40', "テスト".encode('shift_jis') + b'?\x0A']
+
+    def test_session_discards_on_error(self, fake_network):
+        """例外でブロックを抜けた場合は送信せずに切断する"""
+        driver = printer_driver.PrinterDriver("192.168.1.1")
+        with pytest.raises(RuntimeError):
+            with driver.session():
+                driver.cut_paper()
+                raise RuntimeError("abort")
+        assert fake_network[0].sent == []
+        assert fake_network[0].closed
+        assert driver._tx_buf is None
+
+    def test_nested_session_keeps_connection(self, fake_network):
+        """入れ子の session() は外側のブロックが終わるまで切断しない"""
+        driver = printer_driver.PrinterDriver("192.168.1.1")
+        with driver.session():
+            with driver.session():
+                driver.cut_paper()
+            assert not fake_network[0].closed
+            driver.cut_paper()
+        assert len(fake_network) == 1
+        assert fake_network[0].closed
+
+
+class TestOpenSocket:
+    """プリンターソケットの接続のテスト"""
+
+    def test_socket_options(self):
+        """TCP_NODELAY を設定し、接続後は送信用のタイムアウトになる"""
+        with socket.create_server(('127.0.0.1', 0)) as server:
+            driver = printer_driver.PrinterDriver('127.0.0.1', server.getsockname()[1])
+            sock = driver._open_socket(60)
+            try:
+                assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY) == 1
+                assert sock.gettimeout() == 60
+                sock.sendall(b'\x1B\x40')
+                conn, _ = server.accept()
+                with conn:
+                    assert conn.recv(2) == b'\x1B\x40'
+            finally:
+                sock.close()
+
+    def test_connection_refused(self):
+        """接続できないポートではOSErrorになる"""
+        with socket.create_server(('127.0.0.1', 0)) as server:
+            port = server.getsockname()[1]
+        driver = printer_driver.PrinterDriver('127.0.0.1', port)
+        with pytest.raises(OSError):
+            driver._open_socket(60)
+        assert driver._connect() is False
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])
@@ -0,0 +1,158 @@
+# tests/test_worker.py
+"""印刷ジョブワーカーのテスト"""
+
+import os
+import tempfile
+import shutil
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+import pytest
+from PIL import Image
+
+from AdminWebService import database as db
+from AdminWebService import worker
+
+
+class FakeDriver:
+    """印刷内容を記録するだけのドライバ"""
+
+    def __init__(self, printer_ip=None):
+        self.printer_ip = printer_ip
+        self.paper_width_dots = 576
+        self.calls = []
+
+    @contextmanager
+    def session(self):
+        self.calls.append(('session', 'open'))
+        yield self
+        self.calls.append(('session', 'close'))
+
+    def print_raster(self, raster_command):
+        self.calls.append(('print_raster', raster_command[:8]))
+
+    def print_empty_lines(self, num_lines):
+        self.calls.append(('print_empty_lines', num_lines))
+
+    def cut_paper(self, mode='full'):
+        self.calls.append(('cut_paper', mode))
+
+
+@pytest.fixture
+def job_db():
+    """テスト用の一時DB"""
+    db.DATABASE_PATH = tempfile.mktemp(suffix='.db')
+    db.init_db()
+
+    yield
+
+    db.close_pool()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db.DATABASE_PATH + suffix):
+            os.remove(db.DATABASE_PATH + suffix)
+
+
+@pytest.fixture
+def upload_folder():
+    """テスト用アップロードフォルダ"""
+    temp_folder = tempfile.mkdtemp()
+    yield temp_folder
+    shutil.rmtree(temp_folder, ignore_errors=True)
+
+
+@pytest.fixture
+def fake_driver(monkeypatch):
+    """ワーカーのドライバをFakeDriverに差し替え"""
+    monkeypatch.setattr(worker, 'PrinterDriver', FakeDriver)
+    monkeypatch.setattr(worker, '_drivers', {})
+
+
+class TestWorker:
+    """ジョブワーカーのテスト"""
+
+    def test_driver_cached_per_printer(self, fake_driver):
+        """同じプリンタIPには同じドライバを使い回す"""
+        assert worker.get_driver("192.168.1.1") is worker.get_driver("192.168.1.1")
+        assert worker.get_driver("192.168.1.1") is not worker.get_driver("192.168.1.2")
+
+    def test_process_job_success(self, job_db, upload_folder, fake_driver):
+        """ジョブを印刷してSUCCESSにする"""
+        Image.new('RGB', (40, 20)).save(os.path.join(upload_folder, 'a.png'))
+        db.add_job("job-1", "a.png", "192.168.1.1")
+
+        worker.process_job(db.claim_next_job(), upload_folder)
+
+        assert db.get_job("job-1")['status'] == 'SUCCESS'
+        assert worker.get_driver("192.168.1.1").calls == [
+            ('session', 'open'),
+            ('print_raster', b'\x1B\x1D\x53\x01\x05\x00\x14\x00'),
+            ('print_empty_lines', 3),
+            ('cut_paper', 'full'),
+            ('session', 'close'),
+        ]
+
+    def test_convert_image_builds_raster(self, upload_folder):
+        """画像ファイルをESC GS S 1 ラスターコマンドに変換する"""
+        file_path = os.path.join(upload_folder, 'a.png')
+        Image.new('RGB', (36, 20), color='white').save(file_path)
+
+        raster = worker.convert_image(file_path, 576)
+
+        # 幅は8の倍数に切り上げ (36 -> 40dots = 5bytes)、高さ20dots
+        assert raster[:9] == b'\x1B\x1D\x53\x01\x05\x00\x14\x00\x00'
+        assert len(raster) == 9 + 5 * 20
+
+    def test_process_job_missing_file(self, job_db, upload_folder, fake_driver):
+        """画像が読めないジョブはFAILEDにする"""
+        db.add_job("job-1", "missing.png", "192.168.1.1")
+
+        worker.process_job(db.claim_next_job(), upload_folder)
+
+        assert db.get_job("job-1")['status'] == 'FAILED'
+
+    def test_broken_conv_pool_is_recreated(self, job_db, upload_folder, fake_driver, monkeypatch):
+        """変換プロセスが異常終了したジョブはFAILEDにし、次のジョブは新しいプロセスプールで変換する"""
+        broken = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+        with pytest.raises(BrokenProcessPool):
+            broken.submit(os._exit, 1).result()
+        monkeypatch.setattr(worker, '_conv_pool', broken)
+        Image.new('RGB', (10, 10)).save(os.path.join(upload_folder, 'a.png'))
+
+        db.add_job("job-1", "a.png", "192.168.1.1")
+        worker.process_job(db.claim_next_job(), upload_folder)
+        assert db.get_job("job-1")['status'] == 'FAILED'
+        assert worker._conv_pool is None
+
+        db.add_job("job-2", "a.png", "192.168.1.1")
+        worker.process_job(db.claim_next_job(), upload_folder)
+        assert db.get_job("job-2")['status'] == 'SUCCESS'
+        assert worker._conv_pool is not broken
+        worker.shutdown_conv_pool()
+
+    def test_notify_wakes_idle_worker(self, job_db, upload_folder, fake_driver, monkeypatch):
+        """notify()で待機中のワーカーがポーリング間隔を待たずにジョブを処理する"""
+        monkeypatch.setattr(worker, 'POLL_INTERVAL', 60)
+        Image.new('RGB', (10, 10)).save(os.path.join(upload_folder, 'a.png'))
+        stop_event = threading.Event()
+        thread = threading.Thread(target=worker.job_worker, args=(upload_folder, stop_event), daemon=True)
+        thread.start()
+        time.sleep(0.1)
+
+        db.add_job("job-1", "a.png", "192.168.1.1")
+        worker.notify()
+        deadline = time.monotonic() + 5
+        while db.get_job("job-1")['status'] != 'SUCCESS' and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert db.get_job("job-1")['status'] == 'SUCCESS'
+
+        worker.stop(stop_event)
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+
+
+if __name__ == '__main__':
+    pytest.main([__file__, '-v'])